@@ -0,0 +1,334 @@
+"""
+Single event loop entry point for CrossChat.
+
+Serves the same /webhook GET/POST contract as webhook.py, but the HTTP handlers, Graph API lookups, media
+downloads, the event workers and the Discord client all run as coroutines on one asyncio loop, with aiohttp
+as both server and client. There are no gevent patches, no per-task threads and no second event loop for
+Discord; the only work handed to a thread is waiting on ffmpeg when oversized media is shrunk.
+
+Run it with `python aio_server.py` (listens on $PORT, default 8080) or under gunicorn with
+`gunicorn -k aiohttp.GunicornWebWorker aio_server:app`. It uses the same secrets file and event queue
+settings as webhook.py, so run one server or the other against a given EVENT_QUEUE_PATH, not both.
+"""
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+from caching import AsyncSingleFlight
+from components import ServerIO, build_components
+from dedup import queue_new_events
+from event_queue import AsyncEventWorkerPool
+from forwarding import MediaDownload, media_buffer, media_filename, messaging_events
+from metrics import CONTENT_TYPE, EVENT_PROCESSING, MEDIA_DOWNLOAD, REGISTRY, USERNAME_LOOKUP, authorized
+from relay import username_from_response
+from resilience import CircuitOpenError, UpstreamError, async_retry_call, is_retryable_status
+from settings import (
+    GRAPH_API_TIMEOUT, LOG_FORMAT, LOG_LEVEL, LOG_RATE_LIMIT, LOG_RATE_WINDOW, MAX_DISCORD_FILE_SIZE,
+    MEDIA_DOWNLOAD_TIMEOUT, METRICS_TOKEN, SECRETS_PATH, SECRETS_POLL_INTERVAL, load_config,
+)
+from structured_logging import configure_logging
+
+# Log lines are written by a background thread, so a slow stdout never stalls the event loop
+configure_logging(LOG_FORMAT, LOG_LEVEL, rate_limit=LOG_RATE_LIMIT, rate_window=LOG_RATE_WINDOW)
+logger = logging.getLogger(__name__)
+
+# Only the startup configuration; the live one is relay.config, which is replaced when the secrets file changes
+initial_config = load_config(logger)
+
+HTTP_CONNECTIONS = int(os.environ.get('HTTP_CONNECTIONS', 64))  # outbound connections shared by all requests
+
+# Created on the event loop in start_background()
+http_session = None
+discord_task = None
+background_tasks = []
+
+
+def client_timeout(timeouts):
+    """Converts a (connect, read) timeout pair from settings into an aiohttp.ClientTimeout."""
+    connect, read = timeouts
+    return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+
+async def verify_webhook(request):
+    """Verifies the webhook subscription by responding to Instagram's challenge request."""
+    challenge = request.query.get('hub.challenge')
+    verify_token = request.query.get('hub.verify_token')
+
+    cfg = relay.config
+    if cfg.verify_token and verify_token == cfg.verify_token:
+        return web.Response(text=challenge or '')
+    else:
+        return web.Response(text='Verification failed', status=403)
+
+
+async def metrics_endpoint(request):
+    """Serves stage latencies, delivery counters and queue depths in the Prometheus text format."""
+    if not METRICS_TOKEN:
+        return web.Response(text='Not found', status=404)
+    if not authorized(request.headers.get('Authorization'), METRICS_TOKEN):
+        return web.Response(text='Unauthorized', status=401, headers={'WWW-Authenticate': 'Bearer'})
+    return web.Response(body=REGISTRY.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def handle_webhook(request):
+    """
+    Accepts incoming webhook events from Instagram and queues them for delivery to Discord.
+
+    Same contract as webhook.handle_webhook: events are validated, checked against recently received ones and
+    written to the durable event queue before responding, the response carries one status per event, in
+    payload order, and the POST is refused with a 503 and Retry-After while the service is overloaded.
+    """
+    try:
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        try:
+            events = messaging_events(data)
+        except ValueError as e:
+            return web.json_response({'status': 'error', 'message': str(e)}, status=400)
+
+        reason = load_shedder.check(events)
+        if reason:
+            return web.json_response({'status': 'overloaded', 'message': reason}, status=503,
+                                     headers=load_shedder.refusal_headers())
+
+        results = queue_new_events(event_queue, dedup_store, events, sequencer)
+        event_workers.notify()
+        return web.json_response({'status': 'queued', 'events': results})
+
+    except Exception as e:
+        logger.error("Error in webhook: %s", e)
+        return web.json_response({'status': 'error', 'message': str(e)}, status=500)
+
+
+async def get_instagram_username(sender_id):
+    """Cached Instagram username lookup (see Relay.store_username); concurrent misses share one request."""
+    username = relay.cached_username(sender_id)
+    if username is not None:
+        return username
+    return await username_lookups.do(sender_id, lambda: _lookup_instagram_username(sender_id))
+
+
+async def _lookup_instagram_username(sender_id):
+    with USERNAME_LOOKUP.time():
+        username = await _fetch_instagram_username(sender_id)
+    return relay.store_username(sender_id, username)
+
+
+async def _fetch_instagram_username(sender_id):
+    """Fetches the username from the Graph API, returning None if the lookup fails or the API is unavailable."""
+    url, params = relay.username_request(sender_id)
+
+    async def get():
+        async with http_session.get(url, params=params, timeout=client_timeout(GRAPH_API_TIMEOUT)) as response:
+            if is_retryable_status(response.status):
+                raise UpstreamError(f"HTTP {response.status}")
+            body = await response.json(content_type=None) if response.status == 200 else None
+            return username_from_response(response.status, body)
+
+    try:
+        return await async_retry_call(graph_breaker, http_retries, get)
+    except CircuitOpenError:
+        return None
+    except Exception as e:
+        # Only the type: request errors quote the URL, and with it the access token
+        logger.error("Error getting username: %s", type(e).__name__)
+        return None
+
+
+async def fetch_media(url, media_type="reel", budget=None):
+    """
+    Returns media for url from the media cache, downloading (and caching) it on a miss.
+    Returns: the same (buffer, file_size) tuple as download_reel
+    Raises: on a miss, the same errors as download_reel
+    """
+    cached = relay.cached_media(url, media_type, budget)
+    if cached is not None:
+        return cached
+    with MEDIA_DOWNLOAD.time():
+        buffer, file_size = await download_reel(url, media_type, budget)
+    return relay.store_media(url, media_type, buffer, file_size)
+
+
+async def open_media(url):
+    """
+    Starts a GET for media through the CDN's breaker, retrying connection errors, timeouts and 5xx replies
+    before any of the body is read.
+    Returns: the aiohttp.ClientResponse, to be used as an async context manager
+    """
+    async def get():
+        response = await http_session.get(url, timeout=client_timeout(MEDIA_DOWNLOAD_TIMEOUT))
+        if is_retryable_status(response.status):
+            response.release()
+            raise UpstreamError(f"HTTP {response.status}")
+        return response
+
+    return await async_retry_call(cdn_breaker, http_retries, get)
+
+
+async def download_reel(url, media_type="reel", budget=None):
+    """
+    Downloads a reel or post into memory if its size is under 10MB, abandoning it once the limit is crossed
+    (see forwarding.MediaDownload).
+    Returns: (buffer, file_size), (None, file_size) if the file is too large or budget (a ByteBudget) runs out,
+             or (None, None) if download failed
+    Raises: CircuitOpenError while the CDN's breaker is open, or the last connection error, timeout or
+            UpstreamError once its retries are used up, so the caller can fall back to a link
+    """
+    download = MediaDownload(url, media_type, budget=budget)
+    try:
+        async with await open_media(url) as response:
+            if not download.start(response.status, response.headers.get('content-length')):
+                return None, download.size or None
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                if not download.write(chunk):
+                    return None, download.size
+        return download.result()
+    except CircuitOpenError:
+        raise
+    except http_retries.retry_on as e:
+        logger.error("Error downloading %s, CDN unavailable: %s: %s", media_type, type(e).__name__, e)
+        raise
+    except Exception as e:
+        logger.error("Error downloading %s: %s", media_type, e)
+        return None, None
+
+
+async def shrink_oversize_media(url, media_type, file_size):
+    """
+    Downloads media that is over Discord's limit to a scratch file and shrinks it with ffmpeg.
+    Returns: an in-memory buffer ready for discord.File, or None to fall back to sending a link
+    """
+    if not media_shrinker.accepts(file_size):
+        return None
+
+    suffix = os.path.splitext(media_filename(url, media_type))[1]
+    try:
+        # The slot is taken before downloading, so only jobs about to run have a scratch file.
+        # ffmpeg needs a seekable input file, so this path (unlike download_reel) goes through /tmp
+        async with media_shrinker.async_slot():
+            with tempfile.NamedTemporaryFile(suffix=suffix, prefix="oversize_") as scratch:
+                download = MediaDownload(url, media_type, max_size=media_shrinker.max_input_size, out=scratch)
+                async with await open_media(url) as response:
+                    if not download.start(response.status, response.headers.get('content-length')):
+                        return None
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        if not download.write(chunk):
+                            return None
+                scratch.flush()
+                # MediaShrinker blocks on its ffmpeg children, so wait for it on a thread
+                shrunk = await asyncio.to_thread(media_shrinker.shrink, scratch.name, media_type,
+                                                 MAX_DISCORD_FILE_SIZE)
+    except Exception as e:
+        logger.error("Error preparing %s for shrinking: %s", media_type, e)
+        return None
+
+    if shrunk is None:
+        return None
+    # Named from the shrinker's output format, not the URL: an oversized PNG comes back as a JPEG
+    data, ext = shrunk
+    return media_buffer(url, media_type, data, ext=ext)
+
+
+async def handle_queued_event(messaging):
+    """
+    Worker pool entry point: processes one queued messaging event.
+
+    Returns:
+        concurrent.futures.Future: The event's delivery, which the pool waits on before acking the event,
+                                   or None if there is nothing to deliver.
+    """
+    started = time.perf_counter()
+    with EVENT_PROCESSING.time():
+        status, delivery = await process_messaging_event(messaging)
+    relay.record_event(messaging, status, started)
+    return delivery
+
+
+async def process_messaging_event(messaging):
+    """
+    Processes a single Instagram messaging event.
+
+    Returns:
+        tuple: (status, delivery), see Relay.dispatch_event.
+    """
+    # Skip our bot's own messages before spending a username lookup on them
+    status = relay.screen_event(messaging)
+    if status is not None:
+        return status, None
+    return relay.dispatch_event(messaging, await get_instagram_username(messaging['sender']['id']))
+
+
+async def watch_secrets():
+    """Polls the mounted secrets file on the loop; the file is tiny, so it's read inline."""
+    while True:
+        await asyncio.sleep(SECRETS_POLL_INTERVAL)
+        try:
+            secrets_watcher.check()
+        except Exception as e:
+            logger.error("Error reloading secrets from %s: %s", SECRETS_PATH, e)
+
+
+# Caches, breakers, queues and the Relay, built as in webhook.py; this module adds the I/O
+components = build_components(initial_config, ServerIO(
+    fetch_media=fetch_media, shrink_media=shrink_oversize_media, handle_event=handle_queued_event,
+    worker_pool=AsyncEventWorkerPool, single_flight=AsyncSingleFlight,
+    retry_on=(aiohttp.ClientConnectionError, asyncio.TimeoutError), asynchronous=True,
+))
+# The live configuration is relay.config, which is replaced when the secrets file changes
+relay = components.relay
+discord_sender = components.discord_sender
+media_shrinker = components.media_shrinker
+username_lookups = components.username_lookups
+graph_breaker, cdn_breaker, http_retries = components.graph_breaker, components.cdn_breaker, components.http_retries
+dedup_store, event_queue, sequencer = components.dedup_store, components.event_queue, components.sequencer
+load_shedder, event_workers, secrets_watcher = components.load_shedder, components.event_workers, components.secrets_watcher
+
+
+async def start_background(app):
+    global http_session, discord_task
+    loop = asyncio.get_running_loop()
+    http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=HTTP_CONNECTIONS))
+    discord_task = discord_sender.run_on(loop)
+    background_tasks.append(loop.create_task(watch_secrets()))
+    event_workers.start()
+
+
+async def stop_background(app):
+    for task in background_tasks:
+        task.cancel()
+    await event_workers.stop()
+    event_queue.close()
+    if discord_task is not None:
+        # Closing the client makes the sender's main task return
+        await discord_sender.client.close()
+        try:
+            await asyncio.wait_for(discord_task, timeout=5)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await http_session.close()
+
+
+def create_app():
+    app = web.Application()
+    app.router.add_get('/webhook', verify_webhook)
+    app.router.add_post('/webhook', handle_webhook)
+    app.router.add_get('/metrics', metrics_endpoint)
+    app.on_startup.append(start_background)
+    app.on_cleanup.append(stop_background)
+    return app
+
+
+app = create_app()
+
+
+if __name__ == '__main__':
+    web.run_app(app, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
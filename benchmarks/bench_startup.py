@@ -0,0 +1,127 @@
+"""
+Cold-start benchmark for webhook.py.
+
+Measures, in fresh interpreter processes:
+  * import time of the webhook module, and
+  * time from launching the server until the first /webhook GET verification succeeds.
+
+The server is launched the way the Dockerfile runs it (gunicorn with the gevent worker) when gunicorn is
+installed, otherwise with `python webhook.py`. A throwaway secrets file and event queue are used and the
+bot token is left empty, so no network access is needed. Run from the repository root:
+
+    python benchmarks/bench_startup.py [--runs 5] [--importtime]
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+VERIFY_TOKEN = "bench-verify-token"
+
+
+def make_env(workdir):
+    secrets_path = os.path.join(workdir, "mysecrets.json")
+    with open(secrets_path, "w") as f:
+        json.dump({
+            "DISCORD_BOT_TOKEN": "",
+            "DISCORD_CHANNEL_ID": 0,
+            "INSTAGRAM_BOT_USER_ID": 0,
+            "INSTAGRAM_ACCESS_TOKEN": "",
+            "VERIFY_TOKEN": VERIFY_TOKEN,
+            "DISCORD_USER_IDS": {},
+        }, f)
+    env = dict(os.environ)
+    env["SECRETS_PATH"] = secrets_path
+    env["EVENT_QUEUE_PATH"] = os.path.join(workdir, "events.db")
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    return env
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def measure_import(env):
+    code = "import time; t = time.perf_counter(); import webhook; print(time.perf_counter() - t)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def heaviest_imports(env, top=15):
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import webhook"],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = (part.strip() for part in line.split(":", 1)[1].split("|"))
+        rows.append((int(cumulative_us), int(self_us), name))
+    return sorted(rows, reverse=True)[:top]
+
+
+def server_command(port):
+    try:
+        import gunicorn  # noqa: F401
+        import gevent  # noqa: F401
+        return [sys.executable, "-m", "gunicorn", "-k", "gevent", "-b", f"127.0.0.1:{port}", "webhook:app"]
+    except ImportError:
+        return [sys.executable, "webhook.py"]
+
+
+def measure_first_request(env, timeout=30.0):
+    port = free_port()
+    env = dict(env, PORT=str(port))
+    url = f"http://127.0.0.1:{port}/webhook?hub.verify_token={VERIFY_TOKEN}&hub.challenge=ping"
+    started = time.perf_counter()
+    proc = subprocess.Popen(server_command(port), cwd=REPO_ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200 and response.read() == b"ping":
+                        return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.005)
+        raise RuntimeError("server did not answer the verification request in time")
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def summarize(name, samples):
+    print(f"{name:<28} min {min(samples) * 1000:8.1f} ms   median {statistics.median(samples) * 1000:8.1f} ms   "
+          f"max {max(samples) * 1000:8.1f} ms   (n={len(samples)})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5, help="number of cold starts to measure")
+    parser.add_argument("--importtime", action="store_true", help="also list the slowest imports")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        env = make_env(workdir)
+        summarize("import webhook", [measure_import(env) for _ in range(args.runs)])
+        summarize("first verification GET", [measure_first_request(env) for _ in range(args.runs)])
+        print(f"server command: {' '.join(server_command(0)[1:])}")
+
+        if args.importtime:
+            print("\nslowest imports (cumulative / self, ms):")
+            for cumulative, self_time, name in heaviest_imports(env):
+                print(f"  {cumulative / 1000:8.1f} {self_time / 1000:8.1f}  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Micro-benchmark for the zero-width sender-ID codec.
+
+Compares the table-driven encoder with the previous dict-per-call version and measures decoding across a
+synthetic channel history. Correctness is covered by test_zero_width.py. Run from the repository root:
+
+    python benchmarks/bench_zero_width.py [--messages 100000]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from zero_width import (  # noqa: E402
+    decode_invisible, decode_many, encode_invisible, encode_sender_tag, find_sender_ids,
+)
+
+
+def encode_invisible_legacy(text):
+    """The original implementation, which rebuilt its mapping on every call."""
+    mapping = {
+        '0': '\u200b', '1': '\u200c', '2': '\u200d', '3': '\u2060', '4': '\u2061',
+        '5': '\u2062', '6': '\u2063', '7': '\u2064', '8': '\u206a', '9': '\u206b',
+    }
+    return ''.join(mapping[d] for d in str(text) if d in mapping)
+
+
+def decode_invisible_legacy(text):
+    """A straight port of decodeInvisible from discord_handler_go/function.go."""
+    decode = {'\u200b': '0', '\u200c': '1', '\u200d': '2', '\u2060': '3', '\u2061': '4',
+              '\u2062': '5', '\u2063': '6', '\u2064': '7', '\u206a': '8', '\u206b': '9'}
+    idx = text.find('\u200b\u200b\u200b')
+    if idx == -1:
+        return ''
+    digits = []
+    for char in text[idx + 3:]:
+        if char not in decode:
+            break
+        digits.append(decode[char])
+    return ''.join(digits)
+
+
+def build_history(count, tagged_ratio=0.5, seed=1):
+    """Builds fake channel messages; roughly tagged_ratio of them are forwarded messages with a sender tag."""
+    rng = random.Random(seed)
+    messages = []
+    for i in range(count):
+        if rng.random() < tagged_ratio:
+            sender_id = str(rng.randrange(10 ** 15, 10 ** 17))
+            messages.append(f"> **From**: user{i}{encode_sender_tag(sender_id)}\n> **Message**: hello there {i}")
+        else:
+            messages.append(f"just chatting in the channel, message number {i} " * 2)
+    return messages
+
+
+def report(name, seconds, operations):
+    print(f"{name:<38} {seconds * 1e9 / operations:10.1f} ns/op")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=100_000, help="size of the synthetic history")
+    parser.add_argument("--repeat", type=int, default=3, help="best-of repetitions")
+    args = parser.parse_args()
+
+    messages = build_history(args.messages)
+
+    ids = [str(random.Random(2).randrange(10 ** 15, 10 ** 17)) for _ in range(1000)]
+    blob = "\n".join(messages)
+
+    def best(fn, number=1):
+        return min(timeit.repeat(fn, number=number, repeat=args.repeat))
+
+    report("encode (legacy dict per call)", best(lambda: [encode_invisible_legacy(i) for i in ids], 50), 50_000)
+    report("encode (str.translate)", best(lambda: [encode_invisible(i) for i in ids], 50), 50_000)
+    report("decode per message (Go port)", best(lambda: [decode_invisible_legacy(m) for m in messages]), len(messages))
+    report("decode per message", best(lambda: [decode_invisible(m) for m in messages]), len(messages))
+    report("decode_many", best(lambda: decode_many(messages)), len(messages))
+    report("find_sender_ids over joined history", best(lambda: find_sender_ids(blob)), len(messages))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,427 @@
+"""
+Offline load test for the webhook service.
+
+Starts the local Instagram/Discord stand-ins from stub_services.py, launches webhook.py (gunicorn -k gevent,
+as deployed) or aio_server.py against them, and replays webhook payloads at a fixed rate. Every Discord
+message the bot posts is matched back to the event that caused it through the zero-width sender tag, so
+the report covers end-to-end latency as well as throughput, webhook response times and server memory.
+
+Synthetic traffic is a weighted mix of:
+  text     a single text message
+  dm       a text message addressed to a configured user, so it goes out as a DM
+  reel     an ig_reel followed by its caption
+  share    a shared post with no caption (sent once the caption window expires)
+  carousel one message with --carousel-size photos and a caption
+  burst    --burst-size text messages back to back from one sender
+
+Recorded payloads (one webhook JSON body per line) can be replayed with --payloads; their media URLs are
+rewritten to the stub CDN. Run from the repository root, e.g.:
+
+    python benchmarks/loadtest.py --server flask --rate 50 --events 1000 --mix text=6,reel=2,share=1,burst=1
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+
+import aiohttp
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_ROOT)
+
+from stub_services import CHANNEL_ID, DM_USER_ID, StubServices  # noqa: E402
+from zero_width import decode_invisible  # noqa: E402
+
+VERIFY_TOKEN = "loadtest-verify-token"
+METRICS_TOKEN = "loadtest-metrics-token"
+DM_NAME = "benchdm"
+UNIT_EVENTS = {"text": 1, "dm": 1, "reel": 2, "share": 1, "carousel": 2}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(samples, pct):
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def process_tree_rss(pid):
+    """Resident memory in bytes of pid and all its descendants (gunicorn master plus workers)."""
+    total, stack = 0, [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    stack.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return total
+
+
+def parse_mix(text):
+    weights = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        if name not in UNIT_EVENTS and name != "burst":
+            raise SystemExit(f"unknown traffic type in --mix: {name}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.stubs = StubServices(args.graph_latency / 1000, args.cdn_latency / 1000, args.discord_latency / 1000,
+                                  on_message=self.on_discord_message, error_rate=args.error_rate, seed=args.seed)
+        self.outstanding = defaultdict(deque)  # sender id -> post times of events still owed a delivery
+        self.e2e = []
+        self.e2e_by_kind = defaultdict(list)
+        self.post_latency = []
+        self.post_errors = 0
+        self.shed = 0
+        self.events_posted = 0
+        self.deliveries = 0
+        self.unmatched = 0
+        self.first_post = None
+        self.last_delivery = None
+        self.rss = []
+        self.recording = True
+        self.senders = iter(range(10 ** 15, 10 ** 16))
+
+    # --- Discord side ---
+
+    def on_discord_message(self, channel_id, content, upload_bytes):
+        now = time.perf_counter()
+        sender_id = decode_invisible(content)
+        queue = self.outstanding.get(sender_id)
+        if not queue:
+            self.unmatched += 1
+            return
+        # The service may merge a burst of texts into one Discord message; each counts as delivered
+        for _ in range(min(len(queue), max(1, content.count("burst text")))):
+            posted, kind = queue.popleft()
+            if self.recording:
+                self.deliveries += 1
+                self.e2e.append(now - posted)
+                self.e2e_by_kind[kind].append(now - posted)
+                self.last_delivery = now
+
+    # --- Webhook side ---
+
+    def server_command(self, port):
+        if self.args.server == "aio":
+            return [sys.executable, "aio_server.py"]
+        try:
+            import gunicorn  # noqa: F401
+            return [sys.executable, "-m", "gunicorn", "-k", "gevent", "-w", "1", "-b", f"127.0.0.1:{port}",
+                    "--log-level", "warning", "webhook:app"]
+        except ImportError:
+            return [sys.executable, "webhook.py"]
+
+    def start_server(self, workdir, port):
+        secrets_path = os.path.join(workdir, "mysecrets.json")
+        with open(secrets_path, "w") as f:
+            json.dump({
+                "DISCORD_BOT_TOKEN": "loadtest-token",
+                "DISCORD_CHANNEL_ID": CHANNEL_ID,
+                "INSTAGRAM_BOT_USER_ID": 1,
+                "INSTAGRAM_ACCESS_TOKEN": "loadtest",
+                "VERIFY_TOKEN": VERIFY_TOKEN,
+                "DISCORD_USER_IDS": {DM_NAME: str(DM_USER_ID)},
+            }, f)
+        env = dict(os.environ, SECRETS_PATH=secrets_path, EVENT_QUEUE_PATH=os.path.join(workdir, "events.db"),
+                   PORT=str(port), METRICS_TOKEN=METRICS_TOKEN, **self.stubs.stub_env())
+        log = open(os.path.join(workdir, "server.log"), "w")
+        return subprocess.Popen(self.server_command(port), cwd=REPO_ROOT, env=env, stdout=log, stderr=log)
+
+    async def wait_until_up(self, session, base, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                params = {"hub.verify_token": VERIFY_TOKEN, "hub.challenge": "up"}
+                async with session.get(f"{base}/webhook", params=params) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.05)
+        raise RuntimeError("server did not come up")
+
+    def media_url(self, name, media_type):
+        ext = "mp4" if media_type == "reel" else "jpg"
+        return f"{self.stubs.base_url}/cdn/{name}.{ext}?size={self.args.media_size}"
+
+    def unit_events(self, kind, n):
+        """Returns (sender id, events, number of Discord messages expected, kind) for one unit of traffic."""
+        sender = str(next(self.senders))
+        if kind == "text":
+            return sender, [{"text": f"load test message {n}"}], 1, kind
+        if kind == "dm":
+            return sender, [{"text": f"{DM_NAME} direct message {n}"}], 1, kind
+        if kind == "reel":
+            attachment = {"type": "ig_reel", "payload": {"url": self.media_url(f"reel{n % self.args.distinct_media}",
+                                                                               "reel")}}
+            return sender, [{"attachments": [attachment]}, {"text": f"caption {n}"}], 1, kind
+        if kind == "share":
+            attachment = {"type": "share", "payload": {"url": self.media_url(f"post{n % self.args.distinct_media}",
+                                                                             "post")}}
+            return sender, [{"attachments": [attachment]}], 1, kind
+        if kind == "carousel":
+            names = [f"photo{n % self.args.distinct_media}.{i}" for i in range(self.args.carousel_size)]
+            photos = [{"type": "image", "payload": {"url": self.media_url(name, "post")}} for name in names]
+            return sender, [{"attachments": photos}, {"text": f"carousel {n}"}], 1, kind
+        count = self.args.burst_size
+        return sender, [{"text": f"burst text {n}.{i}"} for i in range(count)], count, kind
+
+    def recorded_units(self):
+        """Turns recorded webhook bodies into units; each messaging event is expected to yield a message."""
+        with open(self.args.payloads) as f:
+            bodies = [json.loads(line) for line in f if line.strip()]
+        for body in bodies:
+            for entry in body.get("entry", []):
+                for messaging in entry.get("messaging", []):
+                    for attachment in messaging.get("message", {}).get("attachments", []):
+                        url = attachment.get("payload", {}).get("url")
+                        if url:
+                            name = re.sub(r"\W", "", url)[-24:] or "media"
+                            attachment["payload"]["url"] = self.media_url(name, "reel")
+                    yield (messaging["sender"]["id"], [messaging["message"]] if "message" in messaging else [{}], 1,
+                           "recorded")
+
+    async def post_unit(self, session, base, sender, messages, expected, kind):
+        """
+        Posts a unit's events in order; the unit's deliveries are timed from its first event.
+
+        Like Instagram, an event refused with a 503 is redelivered after its Retry-After (capped at
+        --max-retry-after seconds to keep runs short).
+        """
+        for i, message in enumerate(messages):
+            body = {"object": "instagram", "entry": [{"id": "0", "time": int(time.time() * 1000), "messaging": [
+                {"sender": {"id": sender}, "recipient": {"id": "1"}, "timestamp": int(time.time() * 1000),
+                 "message": dict(message, mid=f"m{sender}.{i}")}
+            ]}]}
+            started = time.perf_counter()
+            if i == 0:
+                self.outstanding[sender].extend([(started, kind)] * expected)
+                if self.first_post is None and self.recording:
+                    self.first_post = started
+            while True:
+                attempt_started = time.perf_counter()
+                retry_after = None
+                try:
+                    async with session.post(f"{base}/webhook", json=body) as response:
+                        await response.read()
+                        if response.status == 503 and response.headers.get("Retry-After"):
+                            retry_after = float(response.headers["Retry-After"])
+                            self.shed += 1
+                        elif response.status != 200:
+                            self.post_errors += 1
+                except aiohttp.ClientError:
+                    self.post_errors += 1
+                if self.recording:
+                    self.post_latency.append(time.perf_counter() - attempt_started)
+                if retry_after is None:
+                    break
+                await asyncio.sleep(min(retry_after, self.args.max_retry_after))
+            if self.recording:
+                self.events_posted += 1
+
+    async def drive(self, session, base, units, total_events):
+        """Open-loop load: units start on schedule no matter how slowly earlier ones are answered."""
+        interval = 1.0 / self.args.rate
+        started = time.perf_counter()
+        tasks, sent = [], 0
+        for sender, messages, expected, kind in units:
+            if sent >= total_events:
+                break
+            delay = started + sent * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(self.post_unit(session, base, sender, messages, expected, kind)))
+            sent += len(messages)
+        await asyncio.gather(*tasks)
+
+    async def drain(self):
+        """Waits until every expected delivery arrived or nothing has arrived for --drain seconds."""
+        last_count, last_change = -1, time.perf_counter()
+        while any(self.outstanding.values()):
+            count = self.deliveries + self.unmatched
+            if count != last_count:
+                last_count, last_change = count, time.perf_counter()
+            elif time.perf_counter() - last_change > self.args.drain:
+                break
+            await asyncio.sleep(0.1)
+
+    async def sample_memory(self, pid):
+        while True:
+            self.rss.append(process_tree_rss(pid))
+            await asyncio.sleep(0.5)
+
+    def synthetic_units(self, weights, start=0):
+        rng = random.Random(self.args.seed + start)
+        kinds, cumulative = list(weights), list(weights.values())
+        n = start
+        while True:
+            yield self.unit_events(rng.choices(kinds, cumulative)[0], n)
+            n += 1
+
+    async def scrape_metrics(self, session, base):
+        """Returns the stage means, per-dependency retry counts and per-route queue wait means from /metrics."""
+        try:
+            async with session.get(f"{base}/metrics", headers={"Authorization": f"Bearer {METRICS_TOKEN}"}) as response:
+                text = await response.text()
+        except aiohttp.ClientError:
+            return {}, {}, {}
+        sums, counts, retries = {}, {}, {}
+        route_sums, route_counts = {}, {}
+        for line in text.splitlines():
+            match = re.match(r'crosschat_stage_seconds_(sum|count)\{stage="(\w+)"\} (\S+)', line)
+            if match:
+                (sums if match.group(1) == "sum" else counts)[match.group(2)] = float(match.group(3))
+            match = re.match(r'crosschat_upstream_retries_total\{dependency="(\w+)"\} (\S+)', line)
+            if match:
+                retries[match.group(1)] = int(float(match.group(2)))
+            match = re.match(r'crosschat_discord_queue_wait_seconds_(sum|count)\{route="([^"]+)"\} (\S+)', line)
+            if match:
+                (route_sums if match.group(1) == "sum" else route_counts)[match.group(2)] = float(match.group(3))
+        route_waits = {route: route_sums[route] / route_counts[route]
+                       for route in route_sums if route_counts.get(route)}
+        return {stage: sums[stage] / counts[stage] for stage in sums if counts.get(stage)}, retries, route_waits
+
+    async def run(self):
+        await self.stubs.start()
+        port = free_port()
+        base = f"http://127.0.0.1:{port}"
+        with tempfile.TemporaryDirectory() as workdir:
+            server = self.start_server(workdir, port)
+            memory = None
+            try:
+                connector = aiohttp.TCPConnector(limit=self.args.connections)
+                async with aiohttp.ClientSession(connector=connector) as session:
+                    await self.wait_until_up(session, base)
+                    memory = asyncio.create_task(self.sample_memory(server.pid))
+                    idle_rss = process_tree_rss(server.pid)
+
+                    if self.args.payloads:
+                        units = self.recorded_units()
+                        total = sum(len(messages) for _, messages, _, _ in self.recorded_units())
+                    else:
+                        weights = parse_mix(self.args.mix)
+                        units = self.synthetic_units(weights)
+                        total = self.args.events
+
+                    # Warm up (Discord login, connection pools) outside the measurement window
+                    if self.args.warmup:
+                        self.recording = False
+                        warmup_units = self.synthetic_units({"text": 1}, start=10 ** 6)
+                        await self.drive(session, base, warmup_units, self.args.warmup)
+                        await self.drain()
+                        self.outstanding.clear()
+                        self.recording = True
+
+                    await self.drive(session, base, units, total)
+                    posted_at = time.perf_counter()
+                    await self.drain()
+                    stages, retries, route_waits = await self.scrape_metrics(session, base)
+            finally:
+                if memory:
+                    memory.cancel()
+                server.terminate()
+                try:
+                    server.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    server.kill()
+                await self.stubs.stop()
+            self.report(idle_rss, posted_at, stages, retries, route_waits)
+            if self.args.server_log:
+                with open(os.path.join(workdir, "server.log")) as f:
+                    print("\n--- server log ---\n" + f.read())
+
+    def report(self, idle_rss, posted_at, stages, retries, route_waits):
+        args = self.args
+        missing = sum(len(queue) for queue in self.outstanding.values())
+        duration = (self.last_delivery or posted_at) - self.first_post if self.first_post else 0.0
+        offered = self.events_posted / (posted_at - self.first_post) if self.first_post else 0.0
+        ms = [value * 1000 for value in self.e2e]
+        post_ms = [value * 1000 for value in self.post_latency]
+        mb = 1024 * 1024
+
+        print(f"server              {' '.join(self.server_command(0)[1:]).replace('-b 127.0.0.1:0 ', '')}")
+        print(f"events posted       {self.events_posted} ({offered:.1f}/s offered, target {args.rate}/s), "
+              f"{self.post_errors} errors, {self.shed} refused with 503")
+        print(f"webhook response    p50 {percentile(post_ms, 50):.1f} ms   p99 {percentile(post_ms, 99):.1f} ms")
+        print(f"discord messages    {self.deliveries} delivered, {missing} missing, {self.unmatched} unmatched, "
+              f"{self.stubs.counts['messages']} Discord posts")
+        print(f"throughput          {self.deliveries / duration if duration else 0.0:.1f} messages/s")
+        print(f"end-to-end latency  p50 {percentile(ms, 50):.1f} ms   p99 {percentile(ms, 99):.1f} ms   "
+              f"max {max(ms) if ms else float('nan'):.1f} ms   mean {statistics.fmean(ms) if ms else float('nan'):.1f} ms")
+        if len(self.e2e_by_kind) > 1:
+            print("latency by type     " + ",   ".join(
+                f"{kind} p50 {percentile(values, 50) * 1000:.0f} ms p99 {percentile(values, 99) * 1000:.0f} ms"
+                for kind, values in sorted(self.e2e_by_kind.items())))
+        if self.rss:
+            print(f"server RSS          idle {idle_rss / mb:.1f} MB   peak {max(self.rss) / mb:.1f} MB   "
+                  f"end {self.rss[-1] / mb:.1f} MB")
+        counts = self.stubs.counts
+        print(f"upstream calls      graph {counts['graph']}, cdn {counts['cdn']} ({counts['cdn_bytes'] / mb:.1f} MB), "
+              f"uploads {counts['uploads']} ({counts['upload_bytes'] / mb:.1f} MB), logins {counts['identifies']}, "
+              f"Discord user/DM lookups {counts['discord_lookups']}")
+        if args.error_rate or retries:
+            print(f"upstream failures   {counts['errors']} injected 503s, retries "
+                  + (", ".join(f"{name} {count}" for name, count in retries.items()) or "none"))
+        if stages:
+            print("stage means         " + ", ".join(f"{stage} {mean * 1000:.1f} ms" for stage, mean in stages.items()))
+        if route_waits:
+            # The slowest lanes; a DM recipient's lane should stay fast while the channel backs up
+            slowest = sorted(route_waits.items(), key=lambda item: item[1], reverse=True)[:4]
+            print("queue wait by route " + ", ".join(f"{route} {mean * 1000:.0f} ms" for route, mean in slowest))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--server", choices=["flask", "aio"], default="flask",
+                        help="webhook.py under gunicorn -k gevent, or aio_server.py")
+    parser.add_argument("--rate", type=float, default=50, help="webhook events per second")
+    parser.add_argument("--events", type=int, default=500, help="number of synthetic events to post")
+    parser.add_argument("--mix", default="text=6,dm=1,reel=2,share=1,burst=1", help="weighted traffic types")
+    parser.add_argument("--burst-size", type=int, default=4, help="messages per burst")
+    parser.add_argument("--carousel-size", type=int, default=3, help="photos per carousel")
+    parser.add_argument("--payloads", help="replay recorded webhook bodies (JSON lines) instead of synthetic traffic")
+    parser.add_argument("--media-size", type=int, default=2 * 1024 * 1024, help="bytes per reel/post on the stub CDN")
+    parser.add_argument("--distinct-media", type=int, default=50, help="how many different media files to cycle")
+    parser.add_argument("--graph-latency", type=float, default=50, help="ms per Graph API lookup")
+    parser.add_argument("--cdn-latency", type=float, default=20, help="ms before the CDN starts a response")
+    parser.add_argument("--discord-latency", type=float, default=50, help="ms per Discord message post")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of Graph/CDN requests failing with 503")
+    parser.add_argument("--max-retry-after", type=float, default=2.0,
+                        help="cap in seconds on honouring Retry-After when redelivering refused events")
+    parser.add_argument("--warmup", type=int, default=5, help="text events sent before measuring")
+    parser.add_argument("--drain", type=float, default=10, help="seconds without progress before giving up")
+    parser.add_argument("--connections", type=int, default=100, help="concurrent webhook connections")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--server-log", action="store_true", help="print the server's output afterwards")
+    asyncio.run(LoadTest(parser.parse_args()).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""
+Local stand-ins for the services CrossChat talks to, for load tests without network access.
+
+One aiohttp app serves:
+  * /graph/{sender_id}       the Graph API username lookup (username is "user<sender_id>")
+  * /cdn/{name}?size=N       a media CDN returning N deterministic bytes for each name
+  * /api/v10/...             the Discord REST endpoints the bot uses (login, users, DMs, messages)
+  * /gateway                 a Discord gateway websocket that identifies the bot into one guild/channel
+
+Point the service at it with GRAPH_API_URL, DISCORD_API_BASE and DISCORD_GATEWAY_URL (see stub_env()).
+benchmarks/loadtest.py runs it in-process; it can also be started on its own for manual testing:
+
+    python benchmarks/stub_services.py --port 9000
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import random
+import time
+from datetime import datetime, timezone
+
+from aiohttp import WSMsgType, web
+
+GUILD_ID = 100000000000000000
+CHANNEL_ID = 100000000000000001
+BOT_USER_ID = 100000000000000002
+DM_USER_ID = 100000000000000003
+
+
+def _json(data, status=200):
+    # discord.py only parses bodies whose Content-Type is exactly application/json (no charset)
+    return web.Response(body=json.dumps(data).encode(), status=status, headers={"Content-Type": "application/json"})
+
+
+class StubServices:
+    """
+    The stub app plus what it has seen. on_message(channel_id, content, upload_bytes) is called for every
+    message the bot posts, after the emulated Discord latency. error_rate is the fraction of Graph API and CDN
+    requests answered with a 503, to exercise the service's retries and circuit breakers.
+    """
+
+    def __init__(self, graph_latency=0.05, cdn_latency=0.02, discord_latency=0.05, on_message=None, error_rate=0.0,
+                 seed=1):
+        self.graph_latency = graph_latency
+        self.cdn_latency = cdn_latency
+        self.discord_latency = discord_latency
+        self.on_message = on_message
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self.counts = {"graph": 0, "cdn": 0, "cdn_bytes": 0, "messages": 0, "uploads": 0, "upload_bytes": 0,
+                       "identifies": 0, "errors": 0, "discord_lookups": 0}
+        self.identified = asyncio.Event()
+        self._ids = itertools.count(int(time.time() * 1000) << 22)
+        self.base_url = None
+
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.router.add_get('/graph/{sender_id}', self.graph_user)
+        self.app.router.add_get('/cdn/{name}', self.cdn_media)
+        self.app.router.add_get('/gateway', self.gateway)
+        self.app.router.add_get('/api/v10/users/@me', self.me)
+        self.app.router.add_get('/api/v10/oauth2/applications/@me', self.application)
+        self.app.router.add_get('/api/v10/users/{user_id}', self.user)
+        self.app.router.add_post('/api/v10/users/@me/channels', self.create_dm)
+        self.app.router.add_post('/api/v10/channels/{channel_id}/messages', self.create_message)
+        self.app.router.add_route('*', '/api/v10/{tail:.*}', self.not_found)
+        self._runner = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def stub_env(self):
+        """Environment variables that point webhook.py / aio_server.py at these stubs."""
+        return {
+            "GRAPH_API_URL": f"{self.base_url}/graph",
+            "DISCORD_API_BASE": f"{self.base_url}/api/v10",
+            "DISCORD_GATEWAY_URL": self.base_url.replace("http://", "ws://") + "/gateway",
+        }
+
+    def _fail(self):
+        if self.error_rate and self._rng.random() < self.error_rate:
+            self.counts["errors"] += 1
+            return True
+        return False
+
+    # --- Instagram ---
+
+    async def graph_user(self, request):
+        self.counts["graph"] += 1
+        await asyncio.sleep(self.graph_latency)
+        if self._fail():
+            return _json({"error": {"message": "Service temporarily unavailable"}}, status=503)
+        sender_id = request.match_info['sender_id']
+        return _json({"username": f"user{sender_id}", "id": sender_id})
+
+    async def cdn_media(self, request):
+        name = request.match_info['name']
+        size = int(request.query.get('size', 1024 * 1024))
+        await asyncio.sleep(self.cdn_latency)
+        if self._fail():
+            return web.Response(status=503)
+        block = hashlib.sha256(name.encode()).digest() * 2048  # 64 KiB, distinct per name
+        response = web.StreamResponse(headers={"Content-Type": "application/octet-stream"})
+        response.content_length = size
+        await response.prepare(request)
+        remaining = size
+        while remaining > 0:
+            chunk = block[:min(remaining, len(block))]
+            await response.write(chunk)
+            remaining -= len(chunk)
+        self.counts["cdn"] += 1
+        self.counts["cdn_bytes"] += size
+        return response
+
+    # --- Discord REST ---
+
+    def _user(self, user_id, bot=False):
+        return {"id": str(user_id), "username": "crosschat" if bot else f"member{user_id}", "discriminator": "0",
+                "global_name": None, "avatar": None, "bot": bot, "public_flags": 0}
+
+    async def not_found(self, request):
+        return _json({"message": "Unknown endpoint", "code": 0}, status=404)
+
+    async def me(self, request):
+        return _json(dict(self._user(BOT_USER_ID, bot=True), verified=True, mfa_enabled=False, flags=0))
+
+    async def application(self, request):
+        return _json({
+            "id": str(BOT_USER_ID), "name": "crosschat", "icon": None, "description": "", "bot_public": True,
+            "bot_require_code_grant": False, "owner": self._user(DM_USER_ID), "verify_key": "", "flags": 0,
+            "summary": "", "team": None,
+        })
+
+    async def user(self, request):
+        self.counts["discord_lookups"] += 1
+        return _json(self._user(int(request.match_info['user_id'])))
+
+    async def create_dm(self, request):
+        self.counts["discord_lookups"] += 1
+        data = await request.json()
+        recipient = int(data["recipient_id"])
+        return _json({"id": str(recipient + 1), "type": 1, "last_message_id": None,
+                      "recipients": [self._user(recipient)]})
+
+    async def create_message(self, request):
+        channel_id = int(request.match_info['channel_id'])
+        upload_bytes = 0
+        attachments = []
+        if request.content_type.startswith("multipart/"):
+            payload = {}
+            reader = await request.multipart()
+            async for part in reader:
+                if part.name == "payload_json":
+                    payload = json.loads(await part.text())
+                else:
+                    size = len(await part.read())
+                    upload_bytes += size
+                    attachment_id = next(self._ids)
+                    expires = int(time.time()) + 24 * 60 * 60
+                    attachments.append({
+                        "id": str(attachment_id), "filename": part.filename, "size": size,
+                        "url": f"{self.base_url}/attachments/{channel_id}/{attachment_id}/{part.filename}?ex={expires:x}",
+                        "proxy_url": f"{self.base_url}/attachments/{channel_id}/{attachment_id}/{part.filename}",
+                    })
+        else:
+            payload = await request.json()
+
+        await asyncio.sleep(self.discord_latency)
+        self.counts["messages"] += 1
+        if attachments:
+            self.counts["uploads"] += len(attachments)
+            self.counts["upload_bytes"] += upload_bytes
+        content = payload.get("content") or ""
+        if self.on_message:
+            self.on_message(channel_id, content, upload_bytes)
+
+        message = {
+            "id": str(next(self._ids)), "channel_id": str(channel_id), "type": 0, "content": content,
+            "author": self._user(BOT_USER_ID, bot=True), "attachments": attachments, "embeds": [], "mentions": [],
+            "mention_roles": [], "mention_everyone": False, "pinned": False, "tts": False, "flags": 0,
+            "components": [], "timestamp": datetime.now(timezone.utc).isoformat(), "edited_timestamp": None,
+        }
+        if channel_id == CHANNEL_ID:
+            message["guild_id"] = str(GUILD_ID)
+        return _json(message)
+
+    # --- Discord gateway ---
+
+    def _guild(self):
+        now = datetime.now(timezone.utc).isoformat()
+        return {
+            "id": str(GUILD_ID), "name": "CrossChat bench", "icon": None, "owner_id": str(DM_USER_ID),
+            "roles": [{"id": str(GUILD_ID), "name": "@everyone", "permissions": "68608", "position": 0, "color": 0,
+                       "hoist": False, "managed": False, "mentionable": False}],
+            "channels": [{"id": str(CHANNEL_ID), "type": 0, "name": "crosschat", "position": 0,
+                          "permission_overwrites": [], "nsfw": False, "topic": None, "last_message_id": None}],
+            "emojis": [], "stickers": [], "features": [], "members": [], "voice_states": [], "presences": [],
+            "threads": [], "stage_instances": [], "guild_scheduled_events": [], "member_count": 2, "large": False,
+            "unavailable": False, "joined_at": now, "premium_tier": 0, "verification_level": 0,
+            "default_message_notifications": 0, "explicit_content_filter": 0, "mfa_level": 0,
+            "system_channel_flags": 0, "afk_timeout": 300, "nsfw_level": 0, "preferred_locale": "en-US",
+        }
+
+    async def gateway(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json({"op": 10, "d": {"heartbeat_interval": 41250}})
+        sequence = 0
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            op = json.loads(msg.data).get("op")
+            if op == 1:
+                await ws.send_json({"op": 11})
+            elif op in (2, 6):
+                self.counts["identifies"] += 1
+                sequence += 1
+                await ws.send_json({"op": 0, "t": "READY", "s": sequence, "d": {
+                    "v": 10, "user": self._user(BOT_USER_ID, bot=True),
+                    "guilds": [{"id": str(GUILD_ID), "unavailable": True}],
+                    "session_id": "bench-session", "resume_gateway_url": str(request.url.with_query(None)),
+                    "application": {"id": str(BOT_USER_ID), "flags": 0}, "private_channels": [],
+                }})
+                sequence += 1
+                await ws.send_json({"op": 0, "t": "GUILD_CREATE", "s": sequence, "d": self._guild()})
+                self.identified.set()
+        return ws
+
+
+async def _serve(port, args):
+    stubs = StubServices(args.graph_latency / 1000, args.cdn_latency / 1000, args.discord_latency / 1000,
+                         on_message=lambda channel, content, size: print(f"[{channel}] {size:>9} B  {content!r}"),
+                         error_rate=args.error_rate)
+    await stubs.start(port=port)
+    for name, value in stubs.stub_env().items():
+        print(f"{name}={value}")
+    print(f"Discord channel id: {CHANNEL_ID}, DM user id: {DM_USER_ID}")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--graph-latency", type=float, default=50, help="ms per Graph API lookup")
+    parser.add_argument("--cdn-latency", type=float, default=20, help="ms before the CDN starts a response")
+    parser.add_argument("--discord-latency", type=float, default=50, help="ms per Discord message post")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of Graph/CDN requests failing with 503")
+    args = parser.parse_args()
+    try:
+        asyncio.run(_serve(args.port, args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
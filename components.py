@@ -0,0 +1,134 @@
+"""
+Builds the long-lived parts of a CrossChat server.
+
+webhook.py and aio_server.py wire up the same caches, breakers, queues and Relay; they differ only in how
+they do I/O, which they describe in a ServerIO. Nothing is started here: the Flask app starts its threads at
+import, and the asyncio server on its loop.
+"""
+from dataclasses import dataclass
+
+from caching import TTLCache
+from discord_sender import DiscordSender
+from dm_channels import DMChannelCache
+from event_queue import EventQueue
+from load_shedding import LoadShedder
+from media_cache import MediaCache
+from metrics import register_server_gauges
+from relay import Relay
+from resilience import CircuitBreaker, RetryPolicy
+from secrets_watcher import SecretsWatcher
+from settings import (
+    BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT, COALESCE_WINDOW, DEDUP_MAX_ENTRIES, DEDUP_PATH, DEDUP_TTL,
+    DISCORD_API_BASE, DISCORD_GATEWAY_URL, DM_CHANNEL_CACHE_PATH, EVENT_ORDER_TIMEOUT, EVENT_QUEUE_PATH,
+    EVENT_WORKERS, HTTP_RETRIES, MAX_BACKLOG, MAX_PENDING_MEDIA, MEDIA_BACKLOG, MEDIA_CACHE_BYTES,
+    MEDIA_SEND_CONCURRENCY, PENDING_REEL_DELAY, RETRY_BASE_DELAY, RETRY_MAX_DELAY, SECRETS_PATH,
+    SECRETS_POLL_INTERVAL, SHED_RETRY_AFTER, SHRINK_MAX_INPUT_BYTES, SHRINK_TIME_BUDGET, SHRINK_WORKERS,
+    STATE_BACKEND_URL, STATE_KEY_PREFIX, USERNAME_CACHE_TTL, get_secrets_from_file,
+)
+from shared_state import create_state
+from shrink import MediaShrinker
+
+
+@dataclass
+class ServerIO:
+    """
+    A server's side of build_components.
+
+    fetch_media and shrink_media are the coroutine functions the Forwarder calls (see forwarding.py), and
+    handle_event is the worker pool's handler. worker_pool and single_flight are the blocking or asyncio
+    flavours of EventWorkerPool and SingleFlight, and retry_on the HTTP client's errors worth retrying.
+    """
+    fetch_media: object
+    shrink_media: object
+    handle_event: object
+    worker_pool: type
+    single_flight: type
+    retry_on: tuple
+    asynchronous: bool = False
+
+
+@dataclass
+class Components:
+    """Everything build_components made; the servers keep the parts their handlers use as module globals."""
+    relay: Relay
+    discord_sender: DiscordSender
+    media_shrinker: MediaShrinker
+    username_lookups: object
+    graph_breaker: CircuitBreaker
+    cdn_breaker: CircuitBreaker
+    http_retries: RetryPolicy
+    secrets_watcher: SecretsWatcher
+    dedup_store: object
+    event_queue: EventQueue
+    sequencer: object
+    event_workers: object
+    load_shedder: LoadShedder
+
+
+def build_components(config, io):
+    """Builds a server's components from its startup Config and ServerIO, and registers their gauges."""
+    # Fail fast while Instagram is struggling; idempotent GETs are retried with jittered backoff first
+    graph_breaker = CircuitBreaker("graph_api", BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+    cdn_breaker = CircuitBreaker("instagram_cdn", BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+    http_retries = RetryPolicy(HTTP_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY, retry_on=io.retry_on)
+
+    # Recently forwarded media and the Discord attachment URLs it was uploaded as
+    media_cache = MediaCache(max_bytes=MEDIA_CACHE_BYTES)
+
+    # Re-encodes media over MAX_DISCORD_FILE_SIZE with a bounded number of ffmpeg processes
+    media_shrinker = MediaShrinker(workers=SHRINK_WORKERS, time_budget=SHRINK_TIME_BUDGET,
+                                   max_input_size=SHRINK_MAX_INPUT_BYTES)
+
+    # Instagram username cache; concurrent lookups for one sender share a single Graph API request
+    username_cache = TTLCache(maxsize=1024, ttl=USERNAME_CACHE_TTL)
+    username_lookups = io.single_flight()
+
+    # Single long-lived Discord client shared by every outbound message. webhook.py starts it (and imports
+    # discord.py) with the first send, so a cold start can answer webhook verification without the Discord
+    # login; aio_server.py runs it on its own loop.
+    discord_sender = DiscordSender(
+        config.discord_bot_token, api_base=DISCORD_API_BASE, gateway_url=DISCORD_GATEWAY_URL,
+        breaker=CircuitBreaker("discord", BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT),
+        heavy_concurrency=MEDIA_SEND_CONCURRENCY
+    )
+
+    # DM channel ids of the configured recipients, so DMs skip the user and channel lookups
+    dm_channels = DMChannelCache(DM_CHANNEL_CACHE_PATH)
+
+    # In-process, or in Redis when several instances have to pair reels and spot retries together
+    state = create_state(STATE_BACKEND_URL, STATE_KEY_PREFIX)
+
+    # Configuration, caches and event handling; the server only adds the I/O
+    relay = Relay(config, discord_sender, media_cache, username_cache, dm_channels, io.fetch_media, io.shrink_media,
+                  state, PENDING_REEL_DELAY, coalesce_window=COALESCE_WINDOW, asynchronous=io.asynchronous)
+
+    # Pick up rotated tokens and user map edits from the mounted secrets file without a restart
+    secrets_watcher = SecretsWatcher(
+        SECRETS_PATH, get_secrets_from_file, relay.apply_secrets, interval=SECRETS_POLL_INTERVAL
+    )
+
+    # Recently received webhook events, so Instagram's retries aren't forwarded twice
+    dedup_store = state.dedup_store(maxsize=DEDUP_MAX_ENTRIES, ttl=DEDUP_TTL, path=DEDUP_PATH)
+
+    # Durable queue of accepted webhook events, drained by a bounded worker pool. With Redis, a sequencer
+    # keeps each sender's events in order across instances.
+    event_queue = EventQueue(EVENT_QUEUE_PATH)
+    sequencer = state.sequencer()
+    event_workers = io.worker_pool(event_queue, io.handle_event, workers=EVENT_WORKERS, sequencer=sequencer,
+                                   turn_timeout=EVENT_ORDER_TIMEOUT)
+
+    # Answers 503 instead of accepting more work than the instance can hold
+    load_shedder = LoadShedder(event_queue, discord_sender, relay.pending_reels, max_backlog=MAX_BACKLOG,
+                               media_backlog=MEDIA_BACKLOG, max_pending_media=MAX_PENDING_MEDIA,
+                               retry_after=SHED_RETRY_AFTER)
+
+    register_server_gauges(relay.pending_reels, event_queue, discord_sender, media_cache, dedup_store,
+                           breakers=(graph_breaker, cdn_breaker, discord_sender.breaker),
+                           username_cache=username_cache, username_lookups=username_lookups)
+
+    return Components(
+        relay=relay, discord_sender=discord_sender, media_shrinker=media_shrinker,
+        username_lookups=username_lookups, graph_breaker=graph_breaker, cdn_breaker=cdn_breaker,
+        http_retries=http_retries, secrets_watcher=secrets_watcher, dedup_store=dedup_store,
+        event_queue=event_queue, sequencer=sequencer, event_workers=event_workers, load_shedder=load_shedder,
+    )
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from forwarding import is_valid_event
+from metrics import DROPPED, DUPLICATES
+
+logger = logging.getLogger(__name__)
+
+
+def event_key(messaging):
+    """
+    Returns the identity of a messaging event: its Instagram message id, or a hash of the event if it has none.
+
+    Returns:
+        tuple: (kind, key) where kind is "mid" or "hash".
+    """
+    mid = (messaging.get('message') or {}).get('mid')
+    if mid:
+        return "mid", f"mid:{mid}"
+    digest = hashlib.sha256(json.dumps(messaging, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+    return "hash", f"hash:{digest}"
+
+
+class DedupStore:
+    """
+    Bounded set of recently seen webhook event keys, so Instagram's retries are only queued once.
+
+    Keys are remembered for ttl seconds, and the least recently added key is forgotten once maxsize is
+    reached. With a path, keys are also written to a SQLite database and reloaded on start, so a retry
+    that arrives after a restart is still recognised. clock returns the current wall clock time (time.time by
+    default; tests pass their own).
+    """
+
+    def __init__(self, maxsize=50000, ttl=24 * 60 * 60, path=None, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.clock = clock
+        self._keys = OrderedDict()  # key -> expires_at (time.time(), so it survives restarts)
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            self._open(path)
+
+    def _open(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+        now = self.clock()
+        self._conn.execute("DELETE FROM seen WHERE expires_at <= ?", (now,))
+        rows = self._conn.execute(
+            "SELECT key, expires_at FROM seen ORDER BY expires_at DESC LIMIT ?", (self.maxsize,)
+        ).fetchall()
+        for key, expires_at in reversed(rows):
+            self._keys[key] = expires_at
+        if rows:
+            logger.info("Loaded %d recently seen webhook event(s) from %s", len(rows), path)
+
+    def add_many(self, keys):
+        """
+        Records keys as seen.
+
+        Args:
+            keys (list): Event keys, e.g. from event_key().
+
+        Returns:
+            list: One bool per key, True if the key is new and False if it was already seen (a duplicate).
+                  A key repeated within the same call counts as a duplicate after its first occurrence.
+        """
+        now = self.clock()
+        expires_at = now + self.ttl
+        fresh = []
+        added = []
+        with self._lock:
+            for key in keys:
+                seen_until = self._keys.get(key)
+                if seen_until is not None and seen_until > now:
+                    fresh.append(False)
+                    continue
+                self._keys[key] = expires_at
+                self._keys.move_to_end(key)
+                fresh.append(True)
+                added.append(key)
+            # Every key has the same ttl, so the oldest keys are at the front and expire first
+            evicted = []
+            while self._keys and (len(self._keys) > self.maxsize or next(iter(self._keys.values())) <= now):
+                evicted.append(self._keys.popitem(last=False)[0])
+            if self._conn is not None and (added or evicted):
+                self._persist(added, evicted, expires_at)
+        return fresh
+
+    def discard_many(self, keys):
+        """Forgets keys again, e.g. when the events they belong to could not be queued."""
+        with self._lock:
+            for key in keys:
+                self._keys.pop(key, None)
+            if self._conn is not None:
+                self._conn.executemany("DELETE FROM seen WHERE key = ?", [(key,) for key in keys])
+
+    def _persist(self, added, evicted, expires_at):
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO seen (key, expires_at) VALUES (?, ?)", [(key, expires_at) for key in added]
+            )
+            self._conn.executemany("DELETE FROM seen WHERE key = ?", [(key,) for key in evicted])
+            self._conn.execute("COMMIT")
+        except Exception as e:
+            self._conn.execute("ROLLBACK")
+            # The in-memory set still catches retries; only restart survival is lost
+            logger.error("Error persisting seen webhook events to %s: %s", self.path, e)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def queue_new_events(event_queue, dedup_store, events, sequencer=None):
+    """
+    Queues the messaging events that haven't been received before and reports a status for each.
+
+    Instagram redelivers a whole POST when we answer slowly, so this runs before anything is downloaded or
+    sent. If queueing fails the events are forgotten again, so Instagram's next retry isn't mistaken for
+    a duplicate. A sequencer (see shared_state.RedisSequencer) numbers the new events per sender so that
+    workers on every instance process them in order.
+
+    Returns:
+        list: One {'sender_id', 'event_id', 'status'} dict per event, in payload order. Duplicates have
+              status 'duplicate' and no event_id. Malformed events (see is_valid_event) aren't queued and
+              have status 'invalid'; answering 200 for them keeps Instagram from redelivering the POST forever.
+    """
+    valid = [messaging for messaging in events if is_valid_event(messaging)]
+    if len(valid) < len(events):
+        DROPPED.labels("invalid_event").inc(len(events) - len(valid))
+        logger.warning("Skipping %d malformed webhook event(s)", len(events) - len(valid))
+
+    keys = [event_key(messaging) for messaging in valid]
+    fresh = dedup_store.add_many([key for _, key in keys])
+    new_keys = [key for (_, key), is_new in zip(keys, fresh) if is_new]
+    new_events = [(messaging['sender']['id'], messaging) for messaging, is_new in zip(valid, fresh) if is_new]
+    try:
+        if sequencer is not None and new_events:
+            sequencer.assign([messaging for _, messaging in new_events])
+        ids = iter(event_queue.put_many(new_events) if new_events else [])
+    except Exception:
+        dedup_store.discard_many(new_keys)
+        raise
+
+    outcomes = iter(zip(keys, fresh))
+    results = []
+    for messaging in events:
+        if not is_valid_event(messaging):
+            sender = messaging.get('sender') if isinstance(messaging, dict) else None
+            sender_id = sender.get('id') if isinstance(sender, dict) else None
+            results.append({'sender_id': sender_id, 'event_id': None, 'status': 'invalid'})
+            continue
+        (kind, _), is_new = next(outcomes)
+        if is_new:
+            results.append({'sender_id': messaging['sender']['id'], 'event_id': next(ids), 'status': 'queued'})
+        else:
+            DUPLICATES.labels(kind).inc()
+            results.append({'sender_id': messaging['sender']['id'], 'event_id': None, 'status': 'duplicate'})
+    return results
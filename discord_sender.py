@@ -0,0 +1,313 @@
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import DISCORD_LOGIN, DISCORD_QUEUE_WAIT, DISCORD_ROUTE_WAIT, DROPPED
+from resilience import CircuitBreaker
+from structured_logging import bind_log_context, log_context
+
+logger = logging.getLogger(__name__)
+
+
+def route_kind(route):
+    """The metrics label of a route: its kind ("channel" or "dm"), so label values don't grow with recipients."""
+    return route[0] if isinstance(route, tuple) and route else str(route)
+
+
+class LaneStats:
+    """Queue wait accounting for a single Discord route."""
+
+    __slots__ = ("sent", "queued", "total_wait", "max_wait", "last_wait")
+
+    def __init__(self):
+        self.sent = 0
+        self.queued = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+
+    def record(self, wait):
+        self.sent += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.last_wait = wait
+
+    def as_dict(self):
+        return {
+            "sent": self.sent,
+            "queued": self.queued,
+            "avg_wait": self.total_wait / self.sent if self.sent else 0.0,
+            "max_wait": self.max_wait,
+            "last_wait": self.last_wait,
+        }
+
+
+class DiscordSender:
+    """
+    Keeps a single Discord client logged in on a background event loop and dispatches queued sends.
+
+    Jobs are coroutine functions that receive the connected client. Each job belongs to a route (a channel
+    or a DM recipient); jobs on the same route run in order, while different routes run in parallel up to
+    max_concurrency. discord.py tracks the X-RateLimit-Bucket headers for every route and holds requests
+    while a bucket is exhausted, so a busy channel only backs up its own lane instead of every DM.
+
+    Heavy jobs (uploads with media downloads) also take one of heavy_concurrency slots, half of
+    max_concurrency by default and always fewer than max_concurrency, so they can never occupy every slot
+    and light jobs such as text messages always have slots left to run in.
+
+    A job can depend on another job's future (see submit's `after`). Its lane waits for that future before
+    taking any slot, so a job waiting on one queued in another lane never holds the slot that lane needs.
+
+    Jobs make their API calls through call(), which applies a timeout and feeds the sender's circuit breaker.
+    While the breaker is open (Discord is timing out or failing with 5xx), lanes hold their jobs instead of
+    running them, then resume with a single probe once it half-opens; sends are delayed, not dropped.
+    """
+
+    RECONNECT_DELAY = 5.0  # seconds to wait before retrying a failed login
+
+    def __init__(self, token, max_concurrency=8, api_base=None, gateway_url=None, breaker=None,
+                 heavy_concurrency=None):
+        self.token = token
+        self.max_concurrency = max_concurrency
+        self.heavy_concurrency = min(heavy_concurrency or max(1, max_concurrency // 2), max(1, max_concurrency - 1))
+        self.breaker = breaker or CircuitBreaker("discord")
+        # Override Discord's REST and gateway URLs, e.g. to run against local stand-ins in a load test
+        self.api_base = api_base
+        self.gateway_url = gateway_url
+        self.loop = None
+        self.client = None
+        self._lanes = {}
+        self._stats = {}
+        self._slots = None
+        self._heavy_slots = None
+        self._token_changed = None
+        self._connected = None
+        self._thread = None
+        self._loop_ready = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Starts the background client thread once; later calls are no-ops."""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="discord-sender", daemon=True)
+                self._thread.start()
+        self._loop_ready.wait()
+
+    def submit(self, job, route="default", heavy=False, after=None):
+        """
+        Queues a job for the Discord client.
+
+        Args:
+            job (callable): Coroutine function taking the connected discord.Client.
+            route (hashable): Destination key, e.g. ("channel", id) or ("dm", user_id). Jobs sharing a
+                              route are delivered in submission order.
+            heavy (bool): Whether the job downloads and uploads media (see heavy_concurrency).
+            after (concurrent.futures.Future): Optional future (e.g. of a job on another route) that must
+                                               be done, successfully or not, before the job runs.
+
+        Returns:
+            concurrent.futures.Future: Resolves with the job's return value once it has run.
+        """
+        self.start()
+        future = Future()
+        # Log records from the job carry the submitter's event_id
+        job = bind_log_context(job)
+        self.loop.call_soon_threadsafe(self._enqueue, route, job, future, time.monotonic(), heavy, after)
+        return future
+
+    def set_token(self, token):
+        """Switches to a new bot token, logging in again without dropping queued sends."""
+        if token == self.token:
+            return
+        self.token = token
+        if self._thread is not None:
+            self.loop.call_soon_threadsafe(self._switch_token)
+
+    def _switch_token(self):
+        self._token_changed.set()
+        # Hold new sends until the client has logged in with the new token
+        self._connected.clear()
+        if not self.client.is_closed():
+            self.loop.create_task(self.client.close())
+
+    async def call(self, awaitable, timeout):
+        """
+        Awaits a Discord API call from a job, giving up after timeout seconds.
+
+        Timeouts, connection errors and 5xx replies count against the breaker; other errors (403, 404, ...)
+        mean Discord is up. Nothing is retried here: discord.py already retries 5xx and 429 replies, and a
+        send that timed out may still have been posted.
+        """
+        import aiohttp
+        import discord
+
+        try:
+            result = await asyncio.wait_for(awaitable, timeout)
+        except (asyncio.TimeoutError, aiohttp.ClientError, OSError, discord.DiscordServerError):
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def queued(self):
+        """Returns the number of jobs waiting in all lanes."""
+        return sum(stats.queued for stats in list(self._stats.values()))
+
+    def queued_by_kind(self):
+        """Returns the number of jobs waiting per route kind (see route_kind)."""
+        counts = {}
+        for route, stats in list(self._stats.items()):
+            counts[route_kind(route)] = counts.get(route_kind(route), 0) + stats.queued
+        return counts
+
+    def queue_stats(self):
+        """Returns per-route queue depth and wait times in seconds."""
+        return {str(route): stats.as_dict() for route, stats in list(self._stats.items())}
+
+    def run_on(self, loop):
+        """
+        Runs the client on an event loop the caller already owns instead of a background thread.
+
+        Used by the asyncio server, which keeps everything on one loop. submit() works the same afterwards.
+
+        Returns:
+            asyncio.Task: The task keeping the client connected; cancel it to stop the sender.
+        """
+        with self._start_lock:
+            if self._thread is not None:
+                raise RuntimeError("Discord sender is already running")
+            self._thread = threading.current_thread()
+            self._setup(loop)
+        return loop.create_task(self._main())
+
+    def _setup(self, loop):
+        # discord.py is the heaviest import in the service; load it on first use, after startup
+        import discord
+
+        if self.api_base:
+            discord.http.Route.BASE = self.api_base
+        if self.gateway_url:
+            import yarl
+            discord.gateway.DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(self.gateway_url)
+
+        self.loop = loop
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._heavy_slots = asyncio.Semaphore(self.heavy_concurrency)
+        self._token_changed = asyncio.Event()
+        self._connected = asyncio.Event()
+        self.client = self._new_client()
+        self._loop_ready.set()
+
+    def _new_client(self):
+        import discord
+
+        intents = discord.Intents.default()
+        intents.message_content = True
+        return discord.Client(intents=intents)
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._setup(loop)
+        loop.run_until_complete(self._main())
+
+    async def _main(self):
+        import discord
+
+        while True:
+            self._token_changed.clear()
+            if not self.token:
+                # Logging in can't succeed, so don't retry it: sends stay queued until set_token supplies one
+                logger.error("No Discord bot token configured, waiting for one")
+                await self._token_changed.wait()
+                continue
+            if self.client.is_closed():
+                # A closed discord.Client can't log in again (its HTTP connector is gone), so start a fresh one
+                self.client = self._new_client()
+            login_watch = self.loop.create_task(self._watch_login(self.client))
+            try:
+                # client.start() reconnects on its own after gateway drops; it only returns on close or login failure
+                await self.client.start(self.token)
+            except discord.LoginFailure as e:
+                logger.error("Discord login failed, waiting for a new token: %s", e)
+                await self.client.close()
+                await self._token_changed.wait()
+            except Exception as e:
+                logger.error("Discord client stopped unexpectedly: %s", e)
+                await self.client.close()
+                await asyncio.sleep(self.RECONNECT_DELAY)
+            else:
+                if not self._token_changed.is_set():
+                    break
+            finally:
+                # Queued lanes wait on _connected, so they resume once the next session is up
+                login_watch.cancel()
+                self._connected.clear()
+
+        for queue in list(self._lanes.values()):
+            while not queue.empty():
+                _, future, _, _, _ = queue.get_nowait()
+                DROPPED.labels("sender_stopped").inc()
+                future.set_exception(RuntimeError("Discord sender stopped"))
+
+    async def _watch_login(self, client):
+        started = time.perf_counter()
+        await client.wait_until_ready()
+        DISCORD_LOGIN.observe(time.perf_counter() - started)
+        self._connected.set()
+
+    def _enqueue(self, route, job, future, queued_at, heavy, after):
+        stats = self._stats.setdefault(route, LaneStats())
+        stats.queued += 1
+        queue = self._lanes.get(route)
+        if queue is None:
+            queue = self._lanes[route] = asyncio.Queue()
+            self.loop.create_task(self._run_lane(route, queue))
+        queue.put_nowait((job, future, queued_at, heavy, after))
+
+    async def _run_lane(self, route, queue):
+        """Delivers one route's jobs in order, then retires the lane once it runs dry."""
+        stats = self._stats[route]
+        route_wait = DISCORD_ROUTE_WAIT.labels(route_kind(route))
+        try:
+            while not queue.empty():
+                job, future, queued_at, heavy, after = queue.get_nowait()
+                if after is not None:
+                    # Before taking slots: the job it waits for may need one of them
+                    await asyncio.wait([asyncio.wrap_future(after)])
+                await self._connected.wait()
+                await self._wait_for_breaker()
+                async with self._heavy_slots if heavy else contextlib.nullcontext(), self._slots:
+                    wait = time.monotonic() - queued_at
+                    stats.queued -= 1
+                    stats.record(wait)
+                    DISCORD_QUEUE_WAIT.observe(wait)
+                    route_wait.observe(wait)
+                    try:
+                        with log_context(route=str(route), queue_wait_ms=round(wait * 1000)):
+                            future.set_result(await job(self.client))
+                    except Exception as e:
+                        logger.error("Error running Discord job for %s: %s", route, e)
+                        future.set_exception(e)
+                    finally:
+                        # Frees the half-open probe slot if the job made no call through call()
+                        self.breaker.release()
+                if wait > 1.0:
+                    logger.info("Discord send for %s waited %.2fs in queue", route, wait)
+        finally:
+            self._lanes.pop(route, None)
+
+    async def _wait_for_breaker(self):
+        """Holds the lane while the breaker is open; in half-open only one lane gets to send the probe."""
+        while True:
+            delay = self.breaker.retry_after()
+            if delay <= 0 and self.breaker.allow():
+                return
+            await asyncio.sleep(delay or 0.1)
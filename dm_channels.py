@@ -0,0 +1,73 @@
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class DMChannelCache:
+    """
+    Discord DM channel id per recipient user id, so DMs go straight to the channel.
+
+    Without it every DM costs a fetch_user round trip, and opening the DM channel costs another whenever
+    discord.py has forgotten it. DM recipients come from DISCORD_USER_IDS, so the cache stays small and
+    needs no eviction. It is dropped when that map or the bot token changes, and an entry is forgotten when
+    a send to its channel fails. With a path, entries are also written to a SQLite database and reloaded on
+    start.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._channels = {}  # user_id -> channel_id
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            self._open(path)
+
+    def _open(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS dm_channels (user_id INTEGER PRIMARY KEY, channel_id INTEGER NOT NULL)"
+        )
+        self._channels = dict(self._conn.execute("SELECT user_id, channel_id FROM dm_channels").fetchall())
+        if self._channels:
+            logger.info("Loaded %d DM channel(s) from %s", len(self._channels), path)
+
+    def get(self, user_id):
+        """Returns the cached DM channel id for user_id, or None."""
+        with self._lock:
+            return self._channels.get(int(user_id))
+
+    def set(self, user_id, channel_id):
+        with self._lock:
+            self._channels[int(user_id)] = channel_id
+            self._write("INSERT OR REPLACE INTO dm_channels (user_id, channel_id) VALUES (?, ?)",
+                        (int(user_id), channel_id))
+
+    def discard(self, user_id):
+        """Forgets user_id's channel, e.g. after a send to it failed."""
+        with self._lock:
+            if self._channels.pop(int(user_id), None) is not None:
+                self._write("DELETE FROM dm_channels WHERE user_id = ?", (int(user_id),))
+
+    def clear(self):
+        with self._lock:
+            self._channels.clear()
+            self._write("DELETE FROM dm_channels", ())
+
+    def _write(self, statement, params):
+        if self._conn is None:
+            return
+        try:
+            self._conn.execute(statement, params)
+        except sqlite3.Error as e:
+            # The in-memory entries still work; only restart survival is lost
+            logger.error("Error persisting DM channels to %s: %s", self.path, e)
+
+    def __len__(self):
+        return len(self._channels)
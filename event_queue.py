@@ -0,0 +1,419 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from metrics import DROPPED
+from structured_logging import log_context
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks whether another instance has finished a sender's previous event
+TURN_POLL_INTERVAL = 0.05
+
+
+class EventQueue:
+    """
+    Durable FIFO of webhook events backed by a SQLite database in WAL mode.
+
+    Events stay in the database until they are acknowledged, so anything that was queued or in progress when
+    the process stopped is picked up again on the next start. Events from the same sender are handed out
+    strictly one at a time and in arrival order; events from different senders can be claimed in parallel.
+
+    An event whose processing is done but whose Discord send is still in memory (queued in a lane, or a reel
+    waiting for its caption) is handed off: the sender's next event can be claimed, but the row stays until
+    the send succeeds (ack) or fails (release). A restart therefore redelivers sends that were lost with the
+    process, possibly after the sender's later events. Delivery is at least once: a send that failed halfway,
+    or finished just before a restart, can be repeated. A released event waits retry_delay seconds, doubling
+    with each failed attempt, before it can be claimed again.
+
+    Several processes can share the file (gunicorn with more than one worker). Each one holds an exclusive
+    lock on its own file in the <path>.owners directory while it runs and records itself as the owner of the
+    events it claims; on start, only events whose owner's lock is free (the owner has stopped) are resumed.
+    """
+
+    def __init__(self, path, max_attempts=3, retry_delay=5.0, max_retry_delay=300.0):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # Other processes sharing the file hold its write lock only briefly
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        # claimed is 0 while an event is queued, 1 while it's being processed and 2 once it's handed off.
+        # owner is the process that claimed it, and not_before the time.time() a released event may be retried at
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " sender_id TEXT,"
+            " payload TEXT NOT NULL,"
+            " claimed INTEGER NOT NULL DEFAULT 0,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL,"
+            " owner TEXT,"
+            " not_before REAL NOT NULL DEFAULT 0)"
+        )
+        # Files from before owner and not_before existed
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(events)")}
+        if "owner" not in columns:
+            self._conn.execute("ALTER TABLE events ADD COLUMN owner TEXT")
+        if "not_before" not in columns:
+            self._conn.execute("ALTER TABLE events ADD COLUMN not_before REAL NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS events_sender ON events (sender_id, id)")
+
+        self._owners_dir = path + ".owners"
+        os.makedirs(self._owners_dir, exist_ok=True)
+        self.owner = uuid.uuid4().hex
+        self._owner_lock = self._lock_owner_file(os.path.join(self._owners_dir, self.owner))
+
+        # Anything claimed by a stopped process never finished or was never delivered, so make it available again
+        resumed = self._resume_stopped_owners()
+        if resumed:
+            logger.info("Resuming %d unfinished webhook event(s) from %s", resumed, path)
+
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def _resume_stopped_owners(self):
+        owners = [row[0] for row in self._conn.execute("SELECT DISTINCT owner FROM events WHERE claimed != 0")]
+        resumed = 0
+        for owner in owners:
+            if owner and not self._stopped(os.path.join(self._owners_dir, owner)):
+                continue
+            resumed += self._conn.execute(
+                "UPDATE events SET claimed = 0, owner = NULL WHERE claimed != 0 AND owner IS ?", (owner,)
+            ).rowcount
+        # Lock files of stopped processes have nothing left to guard
+        for name in os.listdir(self._owners_dir):
+            if name != self.owner:
+                self._stopped(os.path.join(self._owners_dir, name), remove=True)
+        return resumed
+
+    @staticmethod
+    def _lock_owner_file(lock_path):
+        while True:
+            lock = open(lock_path, "w")
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another process may have removed the file before we locked it, taking it for a stopped owner's
+            try:
+                if os.stat(lock_path).st_ino == os.fstat(lock.fileno()).st_ino:
+                    return lock
+            except FileNotFoundError:
+                pass
+            lock.close()
+
+    @staticmethod
+    def _stopped(lock_path, remove=False):
+        """Whether the process that created lock_path has let go of it (or it doesn't exist); optionally removes it."""
+        try:
+            with open(lock_path, "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if remove:
+                    os.remove(lock_path)
+        except FileNotFoundError:
+            return True
+        except BlockingIOError:
+            return False
+        return True
+
+    def put_many(self, events):
+        """
+        Appends events to the queue in a single transaction.
+
+        Args:
+            events (list): (sender_id, payload) tuples, where payload is JSON-serialisable.
+
+        Returns:
+            list: The queue ids assigned to the events, in order.
+        """
+        now = time.time()
+        with self._cond:
+            ids = []
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sender_id, payload in events:
+                    cursor = self._conn.execute(
+                        "INSERT INTO events (sender_id, payload, created_at) VALUES (?, ?, ?)",
+                        (sender_id, json.dumps(payload), now)
+                    )
+                    ids.append(cursor.lastrowid)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._cond.notify_all()
+        return ids
+
+    def claim(self, timeout=None):
+        """
+        Waits for the next event whose sender has no earlier event still queued or in progress (handed-off
+        events don't count).
+
+        Returns:
+            tuple: (event_id, payload), or None if the timeout expired or the queue was closed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not self._closed:
+                claimed = self._claim_next()
+                if claimed:
+                    return claimed
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                retry = self.next_retry()
+                if retry is not None and (remaining is None or retry < remaining):
+                    remaining = retry
+                self._cond.wait(remaining)
+        return None
+
+    def _claim_next(self):
+        # Immediate, so another process sharing the file can't claim the same row in between
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute(
+                "SELECT id, payload FROM events e WHERE claimed = 0 AND not_before <= ? AND NOT EXISTS ("
+                " SELECT 1 FROM events p WHERE p.sender_id IS e.sender_id AND p.id < e.id AND p.claimed < 2)"
+                " ORDER BY id LIMIT 1",
+                (time.time(),)
+            ).fetchone()
+            if row:
+                self._conn.execute(
+                    "UPDATE events SET claimed = 1, owner = ?, attempts = attempts + 1 WHERE id = ?", (self.owner, row[0])
+                )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return (row[0], json.loads(row[1])) if row else None
+
+    def next_retry(self):
+        """Returns the seconds until the earliest released event may be retried, or None if none is waiting."""
+        with self._cond:
+            retry_at = self._conn.execute(
+                "SELECT MIN(not_before) FROM events WHERE claimed = 0 AND not_before > ?", (time.time(),)
+            ).fetchone()[0]
+        return None if retry_at is None else max(retry_at - time.time(), 0)
+
+    def hand_off(self, event_id):
+        """Marks a processed event as waiting on its delivery, unblocking the sender's next event."""
+        with self._cond:
+            self._conn.execute("UPDATE events SET claimed = 2 WHERE id = ?", (event_id,))
+            self._cond.notify_all()
+
+    def ack(self, event_id):
+        """Removes a finished (or delivered) event, unblocking the sender's next event."""
+        with self._cond:
+            self._conn.execute("DELETE FROM events WHERE id = ?", (event_id,))
+            self._cond.notify_all()
+
+    def release(self, event_id):
+        """
+        Returns a failed event to the queue after a backoff delay, or drops it once it has used up its attempts.
+        """
+        with self._cond:
+            attempts = self._conn.execute("SELECT attempts FROM events WHERE id = ?", (event_id,)).fetchone()
+            if attempts and attempts[0] >= self.max_attempts:
+                logger.error("Dropping webhook event %s after %d failed attempts", event_id, attempts[0])
+                DROPPED.labels("retries_exhausted").inc()
+                self._conn.execute("DELETE FROM events WHERE id = ?", (event_id,))
+            elif attempts:
+                delay = min(self.retry_delay * 2 ** (attempts[0] - 1), self.max_retry_delay)
+                self._conn.execute(
+                    "UPDATE events SET claimed = 0, owner = NULL, not_before = ? WHERE id = ?",
+                    (time.time() + delay, event_id)
+                )
+            self._cond.notify_all()
+
+    def depth(self):
+        """Returns the number of queued and in-progress events."""
+        with self._cond:
+            return self._conn.execute("SELECT COUNT(*) FROM events WHERE claimed < 2").fetchone()[0]
+
+    def handed_off(self):
+        """Returns the number of events waiting on their delivery."""
+        with self._cond:
+            return self._conn.execute("SELECT COUNT(*) FROM events WHERE claimed = 2").fetchone()[0]
+
+    def close(self):
+        """Stops claims and gives up the owner lock, so a later EventQueue on the file resumes this one's events."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._owner_lock.close()
+
+
+def settle(queue, event_id, delivery, on_release=None):
+    """
+    Acks a processed event, or if its handler returned a delivery future, hands it off and acks it once the
+    future succeeds. A failed delivery releases the event for another attempt and then calls on_release.
+    """
+    if delivery is None:
+        queue.ack(event_id)
+        return
+    queue.hand_off(event_id)
+
+    def done(future):
+        error = future.exception() if not future.cancelled() else "cancelled"
+        if error is None:
+            queue.ack(event_id)
+            return
+        logger.error("Delivery of webhook event %s failed: %s", event_id, error)
+        queue.release(event_id)
+        if on_release is not None:
+            on_release()
+
+    delivery.add_done_callback(done)
+
+
+def _turn_overdue(event_id, started, timeout):
+    if time.monotonic() - started < timeout:
+        return False
+    logger.warning("Processing webhook event %s before its sender's previous event finished elsewhere", event_id)
+    return True
+
+
+def _finish_turn(sequencer, event_id, payload):
+    try:
+        sequencer.finish(payload)
+    except Exception as e:
+        logger.error("Error marking webhook event %s as finished: %s", event_id, e)
+
+
+class EventWorkerPool:
+    """
+    A fixed number of worker threads draining an EventQueue through a handler function.
+
+    The handler returns None once it is done with an event, or a concurrent.futures.Future that resolves
+    when the event's Discord send is delivered; the event is acked then (see settle()).
+
+    With a sequencer (shared_state.RedisSequencer), an event waits up to turn_timeout seconds for the sender's
+    previous event to be processed by whichever instance queued it.
+    """
+
+    def __init__(self, queue, handler, workers=4, sequencer=None, turn_timeout=15.0):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.sequencer = sequencer
+        self.turn_timeout = turn_timeout
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"event-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            claimed = self.queue.claim()
+            if claimed is None:
+                return
+            event_id, payload = claimed
+            try:
+                with log_context(event_id=event_id):
+                    if self.sequencer is not None:
+                        self._wait_turn(event_id, payload)
+                    delivery = self.handler(payload)
+            except Exception as e:
+                logger.error("Error processing webhook event %s: %s", event_id, e)
+                self.queue.release(event_id)
+            else:
+                if self.sequencer is not None:
+                    _finish_turn(self.sequencer, event_id, payload)
+                settle(self.queue, event_id, delivery)
+
+    def _wait_turn(self, event_id, payload):
+        started = time.monotonic()
+        while not self.sequencer.ready(payload) and not _turn_overdue(event_id, started, self.turn_timeout):
+            time.sleep(TURN_POLL_INTERVAL)
+
+
+class AsyncEventWorkerPool:
+    """
+    Drains an EventQueue with coroutine workers on the calling event loop (used by aio_server.py).
+
+    Queue operations are short local SQLite statements, so they run inline instead of on threads. Workers
+    sleep on an asyncio.Event while nothing is claimable; call notify() after put_many() to wake them. The
+    handler is a coroutine function with the same return value as EventWorkerPool's; sequencer and
+    turn_timeout are as for EventWorkerPool.
+    """
+
+    def __init__(self, queue, handler, workers=8, sequencer=None, turn_timeout=15.0):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.sequencer = sequencer
+        self.turn_timeout = turn_timeout
+        self._tasks = []
+        self._loop = None
+        self._ready = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+        self._ready.set()
+        for i in range(self.workers):
+            self._tasks.append(asyncio.get_running_loop().create_task(self._work(), name=f"event-worker-{i}"))
+
+    def notify(self):
+        if self._ready is not None:
+            self._ready.set()
+
+    def _notify_threadsafe(self):
+        # Delivery futures can complete on another thread (e.g. the pending media expiry thread)
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self.notify)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _work(self):
+        while True:
+            claimed = self.queue.claim(timeout=0)
+            if claimed is None:
+                # Nothing claimable right now; wait until an event is queued, a sender is unblocked or a released
+                # event's backoff is over
+                self._ready.clear()
+                try:
+                    await asyncio.wait_for(self._ready.wait(), self.queue.next_retry())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            event_id, payload = claimed
+            try:
+                with log_context(event_id=event_id):
+                    if self.sequencer is not None:
+                        await self._wait_turn(event_id, payload)
+                    delivery = await self.handler(payload)
+            except Exception as e:
+                logger.error("Error processing webhook event %s: %s", event_id, e)
+                self.queue.release(event_id)
+            else:
+                if self.sequencer is not None:
+                    _finish_turn(self.sequencer, event_id, payload)
+                # A released event is claimable again, so wake a worker for it
+                settle(self.queue, event_id, delivery, on_release=self._notify_threadsafe)
+            # Finishing an event can make the same sender's next event claimable
+            self._ready.set()
+
+    async def _wait_turn(self, event_id, payload):
+        started = time.monotonic()
+        while not self.sequencer.ready(payload) and not _turn_overdue(event_id, started, self.turn_timeout):
+            await asyncio.sleep(TURN_POLL_INTERVAL)
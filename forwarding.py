@@ -0,0 +1,679 @@
+"""
+Turning Instagram messaging events into Discord messages.
+
+Shared by the Flask/gevent app (webhook.py) and the asyncio server (aio_server.py); each of them supplies
+its own way of downloading and shrinking media, the rest of the pipeline is identical.
+"""
+import asyncio
+import io
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from dm_channels import DMChannelCache
+from metrics import BYTES_DOWNLOADED, BYTES_UPLOADED, COALESCED, DISCORD_SEND, DM_CHANNEL_LOOKUPS, DROPPED, MESSAGES_SENT
+from settings import (
+    DISCORD_API_TIMEOUT, DISCORD_MESSAGE_LIMIT, DISCORD_SEND_TIMEOUT, MAX_DISCORD_FILE_SIZE, MAX_DISCORD_FILES,
+    MAX_DISCORD_UPLOAD_SIZE, MEDIA_BATCH_BYTES, MEDIA_BATCH_TIMEOUT,
+)
+from structured_logging import stage_extra
+from zero_width import encode_sender_tag
+
+logger = logging.getLogger(__name__)
+
+# Attachment types we forward, and the media type each is handled as
+SUPPORTED_ATTACHMENTS = {"ig_reel": "reel", "share": "post", "image": "post", "video": "reel"}
+
+
+def media_filename(url, media_type="reel", index=None, ext=None):
+    """
+    Picks the upload filename (and so the extension Discord renders) for a reel or post.
+
+    index numbers the files of a message with several attachments (reel1.mp4, post2.jpg, ...). ext overrides
+    the extension guessed from the URL, e.g. for media re-encoded by the shrinker.
+    """
+    if ext:
+        return f"{media_type}{'' if index is None else index}{ext}"
+    # Determine extension and filename based on media_type
+    ext = ".mp4"
+    if media_type == "post":
+        ext = None
+        for possible in [".jpg", ".jpeg", ".png"]:
+            if url.lower().endswith(possible):
+                ext = possible
+                break
+        if not ext:
+            ext = ".jpg"
+    return f"{media_type}{'' if index is None else index}{ext}"
+
+
+def media_buffer(url, media_type, data, ext=None):
+    """
+    Wraps downloaded, cached or shrunk media bytes in a named in-memory file, ready for discord.File; ext is
+    the extension of shrunk media (see media_filename).
+    """
+    buffer = io.BytesIO(data)
+    buffer.name = media_filename(url, media_type, ext=ext)
+    return buffer
+
+
+class MediaDownload:
+    """
+    The checks both servers make while downloading media, whatever their HTTP client.
+
+    The server passes the response's status and Content-Length to start(), then each chunk of the body to
+    write() until it returns False. The download is abandoned once it reaches max_size bytes or budget (a
+    ByteBudget shared with the message's other media) runs out. Chunks go to out, an in-memory buffer unless
+    a file is given.
+    """
+
+    def __init__(self, url, media_type="reel", max_size=MAX_DISCORD_FILE_SIZE, budget=None, out=None):
+        self.url = url
+        self.media_type = media_type
+        self.max_size = max_size
+        self.budget = budget
+        self.out = io.BytesIO() if out is None else out
+        self.size = 0
+
+    def start(self, status, content_length=None):
+        """Returns whether the body of a response with this status and Content-Length should be read."""
+        if status == 404:
+            # Private or deleted content comes back as 404
+            logger.info("%s URL returned 404 (likely private/deleted): %s", self.media_type.capitalize(), self.url)
+            return False
+        if status != 200:
+            logger.error("Failed to download %s. Status code: %s", self.media_type, status)
+            return False
+        if content_length and int(content_length) >= self.max_size:
+            self.size = int(content_length)
+            logger.info("%s too large: %d bytes", self.media_type.capitalize(), self.size)
+            return False
+        return True
+
+    def write(self, chunk):
+        """Keeps a chunk of the body; returns False (without keeping it) once the download has to stop."""
+        self.size += len(chunk)
+        BYTES_DOWNLOADED.inc(len(chunk))
+        if self.size >= self.max_size:
+            logger.info("%s too large: over %d bytes", self.media_type.capitalize(), self.size)
+            return False
+        if self.budget is not None and not self.budget.take(len(chunk)):
+            logger.info("%s is over the message's download budget", self.media_type.capitalize())
+            return False
+        self.out.write(chunk)
+        return True
+
+    def result(self):
+        """Returns download_reel's (buffer, file_size) for a finished in-memory download."""
+        self.out.seek(0)
+        self.out.name = media_filename(self.url, self.media_type)
+        return self.out, self.size
+
+
+class ByteBudget:
+    """
+    Bytes that a group of concurrent downloads may hold between them.
+
+    Downloads take() every chunk before keeping it and stop once the budget is spent. Thread-safe, since the
+    gevent server downloads on worker threads.
+    """
+
+    def __init__(self, limit):
+        self.remaining = limit
+        self.exhausted = False
+        self._lock = threading.Lock()
+
+    def take(self, size):
+        """Reserves size bytes; returns False (and marks the budget exhausted) if they aren't available."""
+        with self._lock:
+            if size > self.remaining:
+                self.exhausted = True
+                return False
+            self.remaining -= size
+            return True
+
+
+def messaging_events(data):
+    """
+    Flattens a webhook payload into its messaging events, in payload order.
+
+    Events aren't validated here, so one malformed event can't cost the rest of the POST; see is_valid_event.
+    An entry that isn't a dict with a list of messaging events is passed through as a single (invalid) event.
+
+    Raises:
+        ValueError: If the payload isn't an Instagram webhook body.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('entry'), list):
+        raise ValueError('invalid payload')
+    events = []
+    for entry in data['entry']:
+        messaging = entry.get('messaging', []) if isinstance(entry, dict) else None
+        if isinstance(messaging, list):
+            events.extend(messaging)
+        else:
+            events.append(entry)
+    return events
+
+
+def is_valid_event(messaging):
+    """Whether a messaging event can be queued: a dict with a sender id and, if it has one, a message dict."""
+    if not isinstance(messaging, dict) or not isinstance(messaging.get('sender'), dict):
+        return False
+    sender_id = messaging['sender'].get('id')
+    if isinstance(sender_id, bool) or not isinstance(sender_id, (str, int)) or sender_id == '':
+        return False
+    return isinstance(messaging.get('message', {}), dict)
+
+
+def extract_message(messaging):
+    """
+    Pulls the text and every shared reel/post/photo/video out of a messaging event.
+
+    Returns:
+        tuple: (message_text, media) where media is a list of [url, media_type] pairs in attachment order
+               (lists rather than tuples so they survive a JSON round trip), or None if the event isn't a
+               type we forward.
+    """
+    message_text = None
+    media = []
+
+    if 'message' in messaging:
+        message = messaging['message']
+        message_text = message.get('text', '')
+        if not isinstance(message_text, str):
+            message_text = ''
+
+        attachments = message.get('attachments', [])
+        for attachment in attachments if isinstance(attachments, list) else []:
+            # Malformed attachments are skipped rather than failing the whole message
+            if not isinstance(attachment, dict):
+                continue
+            media_type = SUPPORTED_ATTACHMENTS.get(attachment.get('type'))
+            payload = attachment.get('payload')
+            url = payload.get('url') if isinstance(payload, dict) else None
+            if media_type and isinstance(url, str) and url:
+                media.append([url, media_type])
+
+    # Text only messages and reels/posts are supported, everything else is skipped
+    if not media and not message_text:
+        return None
+    return message_text, media
+
+
+def dispatch_message(sender_id, username, message_text, media, pending, send, mentions):
+    """
+    Pairs reels/posts with the caption that follows them and hands finished messages to send.
+
+    Args:
+        media (list): [url, media_type] pairs from extract_message; every item goes out in the same message.
+        pending: Store of reels waiting for a caption (see shared_state.py for the implementations).
+        send (callable): send(username, message_text, media, sender_id), returning a delivery Future.
+        mentions (MentionResolver): Used to tell DMs from channel messages for the returned status.
+
+    Returns:
+        tuple: (status, delivery). status is a short description of what was done with the event. delivery
+               is a concurrent.futures.Future that resolves once the event's message is delivered; for a
+               reel held for its caption, once it has gone out with the caption or on its own.
+    """
+    # Handle reel/post logic
+    if media:
+        # If there's already a pending reel from this sender and we got a message text,
+        # send that reel with the message text
+        if message_text:
+            current_pending_reel = pending.take(sender_id)
+            if current_pending_reel:
+                return 'sent with text', send_pending(current_pending_reel, send, pending, message_text)
+
+        # Hold the new reel briefly in case a caption follows
+        delivered = pending.add({
+            'media': media,
+            'username': username,
+            'sender_id': sender_id,
+            'message_text': None,
+        })
+        return 'pending reel/post', delivered
+
+    # Take the oldest pending reel for this sender (if any) and send this text as its caption
+    current_pending_reel = pending.take(sender_id)
+    if current_pending_reel:
+        delivery = send_pending(current_pending_reel, send, pending, message_text)
+        # Check if it's addressed to a user
+        return ('sent to user' if mentions.route(message_text) else 'sent to server'), delivery
+
+    # Just a regular text message without a reel
+    return 'success', send(username, message_text, [], sender_id)
+
+
+def send_pending(reel, send, pending, message_text=None):
+    """
+    Sends a reel/post taken from (or expired by) the pending store, with message_text as its caption, and
+    reports the send back to the store, which settles the delivery of the reel's own event.
+
+    Returns:
+        concurrent.futures.Future: The send's delivery.
+    """
+    try:
+        delivery = send(reel['username'], message_text, reel['media'], reel['sender_id'])
+    except Exception as e:
+        failed = Future()
+        failed.set_exception(e)
+        pending.sent(reel, failed)
+        raise
+    pending.sent(reel, delivery)
+    return delivery
+
+
+def media_label(media):
+    """The media_type metrics label for a message: the items' shared type, or "mixed"."""
+    types = {media_type for _, media_type in media}
+    return types.pop() if len(types) == 1 else "mixed"
+
+
+def pack_files(files, max_files=MAX_DISCORD_FILES, max_bytes=MAX_DISCORD_UPLOAD_SIZE):
+    """
+    Groups files into as few Discord messages as the per-message file count and upload size allow.
+
+    Args:
+        files (list): Items with a 'size' key, in the order they should appear.
+
+    Returns:
+        list: Lists of files, one per message, preserving order.
+    """
+    batches = []
+    current, current_size = [], 0
+    for item in files:
+        if current and (len(current) >= max_files or current_size + item['size'] > max_bytes):
+            batches.append(current)
+            current, current_size = [], 0
+        current.append(item)
+        current_size += item['size']
+    if current:
+        batches.append(current)
+    return batches
+
+
+def quote(message_parts):
+    """Prefixes every line with '> ' to make it a quote in Discord."""
+    return '> ' + '\n> '.join('\n'.join(message_parts).split('\n')) if message_parts else None
+
+
+def format_message_parts(username, message_text, sender_id, context_type, mentions):
+    """Builds the **From**/**Message** lines for a forwarded message."""
+    message_parts = []
+    if username:
+        if sender_id:
+            message_parts.append(f"**From**: {username}{encode_sender_tag(sender_id)}")
+        else:
+            message_parts.append(f"**From**: {username}")
+    # A reel sent to the server without a caption carries no message line
+    if message_text and context_type != "server_no_message":
+        # Parse message for @mentions
+        parsed_message = mentions.replace_mentions(message_text)
+        message_parts.append(f"**Message**: {parsed_message}")
+    return message_parts
+
+
+class _TextBatch:
+    """Consecutive text messages from one sender to one destination, waiting to go out as one Discord message."""
+
+    __slots__ = ("texts", "last_added", "future")
+
+    def __init__(self, text):
+        self.texts = [text]
+        self.last_added = time.monotonic()
+        self.future = None
+
+
+class Forwarder:
+    """
+    Delivers forwarded messages through a DiscordSender.
+
+    fetch_media(url, media_type, budget) and shrink_media(url, media_type, file_size) are coroutine functions
+    provided by the server: the first returns the same (buffer, file_size) tuple as webhook.download_reel and
+    charges what it keeps to the ByteBudget (or raises if the CDN is unavailable, which sends the item as a
+    link), the second an in-memory buffer below Discord's upload limit or None.
+
+    Text-only messages are coalesced: while a sender's text message is still queued for a destination, further
+    texts from that sender to that destination (each within coalesce_window seconds of the previous one) are
+    appended to it instead of queueing another Discord post, up to Discord's message length. Nothing waits for
+    followers, so an isolated message goes out as soon as its lane is free; bursts merge only while sends are
+    backed up, which is when saving posts matters. A reel/post from the sender ends the batch to keep order.
+
+    Messages with media go through a separate lane per destination, submitted as heavy jobs, so a backlog
+    of downloads and uploads never holds up text. A sender's own messages still go out in order: their media
+    waits for their earlier texts, and texts sent while their media is queued follow it in the media lane.
+
+    DMs go to the recipient's channel from dm_channels (a DMChannelCache), which is only resolved through
+    the API on a miss.
+    """
+
+    def __init__(self, sender, media_cache, fetch_media, shrink_media, coalesce_window=0.0, dm_channels=None):
+        self.sender = sender
+        self.media_cache = media_cache
+        self.dm_channels = dm_channels if dm_channels is not None else DMChannelCache()
+        self.fetch_media = fetch_media
+        self.shrink_media = shrink_media
+        self.coalesce_window = coalesce_window
+        self._batches = {}  # (lane, sender_id) -> _TextBatch still waiting in its lane
+        self._tails = {}  # (route, sender_id) -> (lane, future) of the sender's last message to the route
+        # Reentrant: a done callback may run right away on the submitting thread
+        self._lock = threading.RLock()
+
+    def submit(self, cfg, username, message_text, media=(), sender_id=None):
+        """
+        Queues a message for Discord with the Instagram username, message content and any media.
+
+        Returns:
+            concurrent.futures.Future: Resolves once the message has been delivered (or failed). Texts merged
+                                       into an earlier queued message share its future.
+        """
+        # Work out the destination up front so the dispatcher can run each channel/DM in its own lane
+        dm_route = cfg.mentions.route(message_text)
+        if dm_route:
+            route = ("dm", dm_route[1])
+        else:
+            route = ("channel", cfg.discord_channel_id)
+        media_route = route + ("media",)
+        text = dm_route[2] if dm_route else message_text
+
+        with self._lock:
+            tail = self._tails.get((route, sender_id)) if sender_id else None
+            behind_media = tail is not None and tail[0] == media_route and not tail[1].done()
+            lane = media_route if media or behind_media else route
+
+            if media or not text or not sender_id or self.coalesce_window <= 0:
+                if sender_id:
+                    # Anything else from the sender ends their text batches, so later texts can't overtake it
+                    self._batches.pop((route, sender_id), None)
+                    self._batches.pop((media_route, sender_id), None)
+                # Media goes out after the sender's texts still queued in the text lane
+                earlier = tail[1] if media and tail is not None and tail[0] == route else None
+
+                async def deliver(client):
+                    await self.deliver(client, cfg, dm_route, username, message_text, list(media), sender_id)
+
+                future = self.sender.submit(deliver, route=lane, heavy=bool(media), after=earlier)
+            else:
+                future = self._submit_text(cfg, dm_route, lane, username, text, sender_id)
+
+            if sender_id and (tail is None or tail[1] is not future):
+                self._track(route, sender_id, lane, future)
+            return future
+
+    def _submit_text(self, cfg, dm_route, lane, username, text, sender_id):
+        """Appends text to the sender's open batch in lane, or queues it as a new batch; called with the lock."""
+        key = (lane, sender_id)
+        batch = self._batches.get(key)
+        if batch is not None and self._can_append(batch, cfg, username, text, sender_id):
+            batch.texts.append(text)
+            batch.last_added = time.monotonic()
+            COALESCED.inc()
+            return batch.future
+
+        batch = self._batches[key] = _TextBatch(text)
+
+        async def deliver_batch(client):
+            with self._lock:
+                # Closed from here on: texts arriving while this one is sent start a new message
+                if self._batches.get(key) is batch:
+                    del self._batches[key]
+                merged = '\n'.join(batch.texts)
+            if dm_route:
+                await self.deliver(client, cfg, dm_route[:2] + (merged,), username, None, [], sender_id)
+            else:
+                await self.deliver(client, cfg, None, username, merged, [], sender_id)
+
+        batch.future = self.sender.submit(deliver_batch, route=lane)
+        return batch.future
+
+    def _track(self, route, sender_id, lane, future):
+        key = (route, sender_id)
+        self._tails[key] = (lane, future)
+
+        def forget(_):
+            with self._lock:
+                if self._tails.get(key, (None, None))[1] is future:
+                    del self._tails[key]
+
+        future.add_done_callback(forget)
+
+    def _can_append(self, batch, cfg, username, text, sender_id):
+        if time.monotonic() - batch.last_added > self.coalesce_window:
+            return False
+        merged = '\n'.join(batch.texts + [text])
+        parts = format_message_parts(username, merged, sender_id, "server_text_only", cfg.mentions)
+        return len(quote(parts)) <= DISCORD_MESSAGE_LIMIT
+
+    async def deliver(self, client, cfg, dm_route, username, message_text, media, sender_id):
+        started = time.perf_counter()
+        try:
+            # --- CASE 1: DM to a user by specifying their name ---
+            if dm_route:
+                recipient_name, recipient_id, actual_message = dm_route
+                # If message is just the name, actual_message is None and no message text is sent
+                await self.send_dm(client, recipient_id, username, actual_message, media, cfg.mentions, sender_id)
+                logger.info("Sent DM to %s", recipient_name, extra=stage_extra("discord_delivery", started))
+                return
+
+            channel = client.get_channel(cfg.discord_channel_id)
+            if not channel:
+                return
+
+            # --- CASE 2: Server, reel only (no message) ---
+            if media and not message_text:
+                context_type, sent = "server_no_message", "Sent reel only to server"
+            # --- CASE 3: Server, reel with message ---
+            elif media:
+                context_type, sent = "server_with_message", "Sent reel + message to server"
+            # --- REGULAR MESSAGE (no reel, just text) ---
+            else:
+                context_type, sent = "server_text_only", "Sent regular message to server"
+
+            await self.send_media_with_context(
+                channel, username, message_text, media, cfg.mentions,
+                context_type=context_type,
+                sender_id=sender_id
+            )
+            logger.info(sent, extra=stage_extra("discord_delivery", started))
+        except Exception as e:
+            # Raised into the send's future, so the webhook event is released and retried (see event_queue.py)
+            logger.error("Error sending Discord message: %s", e, extra=stage_extra("discord_delivery", started))
+            raise
+
+    async def send_dm(self, client, recipient_id, username, message_text, media, mentions, sender_id):
+        """
+        Sends a message and its media to a user's DMs, through their cached DM channel when there is one.
+
+        On a miss the user is fetched and the DM channel opened, and the channel id is cached. A send that
+        fails drops the cached channel; if Discord rejected it as unknown or forbidden (the channel is gone,
+        or belongs to a previous bot), the channel is resolved again and the message sent once more.
+        """
+        import discord
+
+        channel_id = self.dm_channels.get(recipient_id)
+        if channel_id is not None:
+            DM_CHANNEL_LOOKUPS.labels("cached").inc()
+            channel = client.get_partial_messageable(channel_id, type=discord.ChannelType.private)
+            try:
+                await self.send_media_with_context(channel, username, message_text, media, mentions,
+                                                   context_type="dm", sender_id=sender_id)
+                return
+            except (discord.NotFound, discord.Forbidden) as e:
+                logger.info("Cached DM channel %s was rejected (HTTP %s), opening it again", channel_id, e.status)
+                self.dm_channels.discard(recipient_id)
+            except Exception:
+                self.dm_channels.discard(recipient_id)
+                raise
+
+        DM_CHANNEL_LOOKUPS.labels("resolved").inc()
+        user = await self.sender.call(client.fetch_user(recipient_id), DISCORD_API_TIMEOUT)
+        channel = await self.sender.call(user.create_dm(), DISCORD_API_TIMEOUT)
+        self.dm_channels.set(recipient_id, channel.id)
+        try:
+            await self.send_media_with_context(channel, username, message_text, media, mentions,
+                                               context_type="dm", sender_id=sender_id)
+        except Exception:
+            self.dm_channels.discard(recipient_id)
+            raise
+
+    async def _send(self, target, context_type, media_type, delivery, content, files=(), size=0):
+        """Sends one Discord message, recording send latency, the delivery counter and uploaded bytes."""
+        with DISCORD_SEND.time():
+            if not files:
+                sent = await self.sender.call(target.send(content), DISCORD_SEND_TIMEOUT)
+            else:
+                sent = await self.sender.call(target.send(content=content, files=list(files)), DISCORD_SEND_TIMEOUT)
+        MESSAGES_SENT.labels(context_type, media_type, delivery).inc()
+        if size:
+            BYTES_UPLOADED.inc(size)
+        return sent
+
+    async def _fetch_all(self, items):
+        """
+        Downloads items concurrently, sharing MEDIA_BATCH_BYTES between them and giving up on whatever isn't
+        done after MEDIA_BATCH_TIMEOUT seconds.
+
+        Returns:
+            list: (buffer, file_size, link_instead) per item, in order; see fetch_media for buffer/file_size.
+                  link_instead is True for items that timed out or whose download raised (the CDN kept failing,
+                  or its breaker is open): a temporary link may still work for whoever reads the message.
+        """
+        budget = ByteBudget(MEDIA_BATCH_BYTES)
+        tasks = [asyncio.ensure_future(self.fetch_media(url, media_type, budget)) for url, media_type in items]
+        if not tasks:
+            return []
+        done, pending = await asyncio.wait(tasks, timeout=MEDIA_BATCH_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        results = []
+        for task in tasks:
+            if task in done and task.exception() is None:
+                buffer, file_size = task.result()
+                results.append((buffer, file_size, False))
+            else:
+                if task in done:
+                    logger.info("Sending media as a link after %s: %s", type(task.exception()).__name__, task.exception())
+                results.append((None, None, True))
+        return results
+
+    async def send_media_with_context(self, target, username, message_text, media, mentions,
+                                      context_type="server_with_message", sender_id=None):
+        """
+        Sends the message and all of its media, as one Discord message when Discord's limits allow.
+
+        Media that was uploaded before is linked through its cached attachment URL, the rest is downloaded
+        concurrently and attached as files. Files are only split over several messages when they exceed
+        the per-message file count or upload size; the text goes with the first one. Media that can't be
+        attached (too large even after shrinking, over the download budget, or a failed upload) is sent as
+        a temporary link instead, and media that can't be downloaded at all is left out.
+        """
+        # Only needed once the Discord sender is running, so it stays out of the cold-start import path
+        import discord
+
+        message_parts = format_message_parts(username, message_text, sender_id, context_type, mentions)
+
+        # For regular messages without reel/post
+        if not media:
+            started = time.perf_counter()
+            await self._send(target, context_type, "text", "text", quote(message_parts))
+            logger.info("Sent regular message [%s]", context_type, extra=stage_extra("discord_send", started))
+            return
+
+        label = media_label(media)
+        numbered = len(media) > 1
+        cached_links = []  # Discord attachment URLs of earlier uploads, posted bare so Discord embeds them
+        link_notes = []  # temporary links for media that couldn't be attached
+        files = []
+
+        # Reuse earlier Discord uploads of the same media while their links are still valid
+        to_fetch = []
+        for index, (url, media_type) in enumerate(media, 1):
+            attachment_url = self.media_cache.attachment_url(url)
+            if attachment_url:
+                cached_links.append(attachment_url)
+            else:
+                to_fetch.append((index, url, media_type))
+
+        started = time.perf_counter()
+        fetched = await self._fetch_all([(url, media_type) for _, url, media_type in to_fetch])
+        if to_fetch:
+            logger.debug("Fetched %d media item(s) [%s]", len(to_fetch), context_type,
+                         extra=stage_extra("media_fetch", started))
+        for (index, url, media_type), (buffer, file_size, link_instead) in zip(to_fetch, fetched):
+            filename = media_filename(url, media_type, index if numbered else None)
+            # If download failed (post is private, deleted, etc)
+            if file_size is None and not link_instead:
+                DROPPED.labels("download_failed").inc()
+                continue
+            if buffer:
+                # A different URL may have carried identical content that we've already uploaded
+                attachment_url = self.media_cache.attachment_url(url)
+                if attachment_url:
+                    buffer.close()
+                    cached_links.append(attachment_url)
+                else:
+                    files.append({'url': url, 'media_type': media_type, 'buffer': buffer, 'size': file_size,
+                                  'filename': filename})
+                continue
+
+            # Try to bring oversized media under the limit before settling for a temporary link
+            if file_size and file_size >= MAX_DISCORD_FILE_SIZE:
+                shrunk = await self.shrink_media(url, media_type, file_size)
+                if shrunk:
+                    # Shrunk media has the shrinker's format, which the buffer's name carries
+                    filename = media_filename(url, media_type, index if numbered else None,
+                                              ext=os.path.splitext(shrunk.name)[1])
+                    files.append({'url': url, 'media_type': media_type, 'buffer': shrunk,
+                                  'size': shrunk.getbuffer().nbytes, 'filename': filename, 'shrunk': True})
+                    logger.info("Shrunk %s for upload (original size: %s bytes)", media_type, file_size)
+                    continue
+                link_notes.append(f"-# File is bigger than 10MB, sending [__temporary link__]({url}) instead")
+            else:
+                # Over the batch's byte or time budget, or the CDN is unavailable
+                link_notes.append(f"-# Sending [__temporary link__]({url}) instead of a file")
+            logger.info("Sending %s as link (size: %s bytes) [%s]", media_type, file_size, context_type)
+
+        # Every item failed to download
+        if not files and not cached_links and not link_notes:
+            return
+
+        # The text (with any links) goes with the first message; later ones only carry more files
+        content = '\n'.join(filter(None, [quote(message_parts + link_notes)] + cached_links))
+        batches = pack_files(files)
+        if not batches:
+            started = time.perf_counter()
+            await self._send(target, context_type, label, "link" if link_notes else "cached_link", content)
+            logger.info("Sent %d media item(s) as links [%s]", len(media), context_type,
+                        extra=stage_extra("discord_send", started))
+            return
+
+        for batch_number, batch in enumerate(batches):
+            batch_size = sum(item['size'] for item in batch)
+            delivery = "shrunk_file" if any(item.get('shrunk') for item in batch) else "file"
+            started = time.perf_counter()
+            try:
+                sent = await self._send(
+                    target, context_type, label, delivery, content if batch_number == 0 else None,
+                    files=[discord.File(item['buffer'], filename=item['filename']) for item in batch],
+                    size=batch_size
+                )
+                if sent and sent.attachments:
+                    for item, attachment in zip(batch, sent.attachments):
+                        if not item.get('shrunk'):
+                            self.media_cache.remember_attachment(item['url'], attachment.url)
+                logger.info("Sent %d file(s) (%d bytes) with context [%s]", len(batch), batch_size, context_type,
+                            extra=stage_extra("discord_send", started))
+            except Exception as e:
+                logger.error("Error sending file: %s", e, extra=stage_extra("discord_send", started))
+                fallback = [f"File is bigger than 10MB, sending [__temporary link__]({item['url']}) instead"
+                            for item in batch]
+                if batch_number == 0:
+                    fallback = '\n'.join(filter(None, [quote(message_parts + link_notes + fallback)] + cached_links))
+                else:
+                    fallback = quote(fallback)
+                await self._send(target, context_type, label, "link", fallback)
+            finally:
+                for item in batch:
+                    item['buffer'].close()
@@ -1,71 +1,141 @@
-import requests
-from google.cloud import secretmanager
-import json
-import os
-from flask import Request
-
-
-def refresh_instagram_token(request: Request):
-    """Refreshes the Instagram access token stored in Secret Manager.
-    Args:
-        request (flask.Request): The Flask request object.
-                                 Although we don't directly use it,
-                                 HTTP-triggered Cloud Functions receive this.
-    """
-    project_id = os.environ.get("GCP_PROJECT")
-    secret_name = "mysecrets-json"
-
-    if not project_id:
-        print("Error: GCP_PROJECT environment variable not set.")
-        return
-
-    # Initialize Secret Manager client
-    client = secretmanager.SecretManagerServiceClient()
-    secret_version_name = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
-
-    try:
-        # Get the current secret data from Secret Manager
-        response = client.access_secret_version(name=secret_version_name)
-        current_secret_json = response.payload.data.decode("utf-8")
-        current_secrets = json.loads(current_secret_json)
-
-        # Get the current access token
-        current_access_token = current_secrets.get("INSTAGRAM_ACCESS_TOKEN")
-        if not current_access_token:
-            print("Error: 'INSTAGRAM_ACCESS_TOKEN' not found in the secret.")
-            return
-
-        # Instagram API endpoint for refreshing the token
-        refresh_url = "https://graph.instagram.com/refresh_access_token"
-        params = {
-            "grant_type": "ig_refresh_token",
-            "access_token": current_access_token
-        }
-
-        # Make the refresh request
-        refresh_response = requests.get(refresh_url, params=params)
-        refresh_response.raise_for_status()  # Raise an exception for bad status codes
-        new_token_data = refresh_response.json()
-        new_access_token = new_token_data.get("access_token")
-
-        if new_access_token:
-            # Update the access token in the dictionary
-            current_secrets["INSTAGRAM_ACCESS_TOKEN"] = new_access_token
-
-            # Convert the updated dictionary back to JSON
-            updated_secret_json = json.dumps(current_secrets)
-            payload = updated_secret_json.encode("utf-8")
-
-            # Add a new version of the secret in Secret Manager
-            update_response = client.add_secret_version(
-                parent=f"projects/{project_id}/secrets/{secret_name}",
-                payload={"data": payload}
-            )
-            print(f"Successfully refreshed Instagram access token. New version: {update_response.name}")
-        else:
-            print(f"Error: Could not retrieve new access token from Instagram API response: {refresh_response.json()}")
-
-    except Exception as e:
-        print(f"An error occurred: {e}")
-
-    return "OK"
+import requests
+from google.cloud import secretmanager
+import json
+import os
+import time
+from flask import Request
+
+SECRET_NAME = os.environ.get("SECRET_NAME", "mysecrets-json")
+GRAPH_API_URL = os.environ.get("GRAPH_API_URL", "https://graph.instagram.com")
+# Refresh once the token is within this many seconds of expiring. Long-lived tokens last 60 days and can
+# only be refreshed once they are a day old, so a daily schedule refreshes about once every 53 days.
+REFRESH_WINDOW = int(os.environ.get("REFRESH_WINDOW", 7 * 24 * 60 * 60))
+# Lifetime of a refreshed long-lived token, assumed when Instagram's response omits expires_in
+TOKEN_LIFETIME = 60 * 24 * 60 * 60
+SECRET_MANAGER_TIMEOUT = 10  # seconds per Secret Manager call
+REFRESH_TIMEOUT = (5, 15)  # (connect, read) seconds for the Graph API refresh call
+
+# Kept at module level so warm invocations reuse the gRPC channel and HTTP connection pool
+_client = None
+_http_session = requests.Session()
+
+
+def get_client():
+    """Returns the Secret Manager client, creating it on the first invocation of this instance."""
+    global _client
+    if _client is None:
+        _client = secretmanager.SecretManagerServiceClient()
+    return _client
+
+
+def refresh_instagram_token(request: Request):
+    """Refreshes the Instagram access token stored in Secret Manager when it is close to expiring.
+    The token's expiry (INSTAGRAM_TOKEN_EXPIRES_AT, epoch seconds) is stored in the secret next to it, so
+    frequent runs only read the secret and leave it alone until the token is within REFRESH_WINDOW of
+    expiring. A secret without an expiry is refreshed once to learn it. Pass ?force=true to refresh anyway.
+    Args:
+        request (flask.Request): The Flask request object.
+                                 Although we only read the optional force flag,
+                                 HTTP-triggered Cloud Functions receive this.
+    Returns:
+        tuple: (result dict, HTTP status). The result has a status ("refreshed", "skipped" or "error"),
+               a reason, the token's expires_at, the new secret version if one was written, and
+               per-step timings in milliseconds. Errors return 500 so the scheduler sees and retries them.
+    """
+    force = request is not None and request.args.get("force", "").lower() in ("1", "true", "yes")
+    result = run_refresh(os.environ.get("GCP_PROJECT"), force=force)
+    print(json.dumps(result))
+    return result, 500 if result["status"] == "error" else 200
+
+
+def run_refresh(project_id, force=False, client=None, http_session=None, now=None):
+    """
+    Does the work of refresh_instagram_token.
+
+    Args:
+        project_id (str): GCP project holding the secret.
+        force (bool): Refresh even if the token isn't near expiry.
+        client: Secret Manager client; defaults to the shared one.
+        http_session: requests-compatible session for the Graph API call.
+        now (float): Current epoch time, for deciding whether the token is near expiry.
+
+    Returns:
+        dict: See refresh_instagram_token.
+    """
+    started = time.perf_counter()
+    timings = {}
+    result = {"status": "error", "reason": None, "expires_at": None, "secret_version": None, "timings_ms": timings}
+
+    def timed(step, fn, *args, **kwargs):
+        step_started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            timings[step] = round((time.perf_counter() - step_started) * 1000, 1)
+
+    if not project_id:
+        result["reason"] = "GCP_PROJECT environment variable not set"
+        return result
+
+    client = client or get_client()
+    http_session = http_session or _http_session
+    now = time.time() if now is None else now
+    secret_path = f"projects/{project_id}/secrets/{SECRET_NAME}"
+
+    try:
+        # Get the current secret data from Secret Manager
+        response = timed("read_secret", client.access_secret_version,
+                         name=f"{secret_path}/versions/latest", timeout=SECRET_MANAGER_TIMEOUT)
+        current_secrets = json.loads(response.payload.data.decode("utf-8"))
+
+        # Get the current access token
+        current_access_token = current_secrets.get("INSTAGRAM_ACCESS_TOKEN")
+        if not current_access_token:
+            result["reason"] = "'INSTAGRAM_ACCESS_TOKEN' not found in the secret"
+            return result
+
+        expires_at = current_secrets.get("INSTAGRAM_TOKEN_EXPIRES_AT")
+        result["expires_at"] = expires_at
+        if not force and expires_at and expires_at - now > REFRESH_WINDOW:
+            result["status"] = "skipped"
+            result["reason"] = f"token expires in {(expires_at - now) / 86400:.1f} days"
+            return result
+
+        # Make the refresh request
+        refresh_response = timed("refresh_token", http_session.get, f"{GRAPH_API_URL}/refresh_access_token",
+                                 params={"grant_type": "ig_refresh_token", "access_token": current_access_token},
+                                 timeout=REFRESH_TIMEOUT)
+        refresh_response.raise_for_status()  # Raise an exception for bad status codes
+        new_token_data = refresh_response.json()
+        new_access_token = new_token_data.get("access_token")
+        if not new_access_token:
+            result["reason"] = f"no access token in Instagram API response: {new_token_data}"
+            return result
+
+        # Update the token and its expiry, then add a new version of the secret in Secret Manager
+        current_secrets["INSTAGRAM_ACCESS_TOKEN"] = new_access_token
+        # Without expires_in, keeping the old (near) expiry would refresh again on every run
+        expires_in = new_token_data.get("expires_in") or TOKEN_LIFETIME
+        current_secrets["INSTAGRAM_TOKEN_EXPIRES_AT"] = int(now + expires_in)
+        payload = json.dumps(current_secrets).encode("utf-8")
+        update_response = timed("write_secret", client.add_secret_version,
+                                parent=secret_path, payload={"data": payload}, timeout=SECRET_MANAGER_TIMEOUT)
+
+        if force:
+            reason = "forced"
+        else:
+            reason = "near expiry" if expires_at else "no stored expiry"
+        result.update(status="refreshed", reason=reason, expires_at=current_secrets.get("INSTAGRAM_TOKEN_EXPIRES_AT"),
+                      secret_version=update_response.name)
+        return result
+
+    except requests.RequestException as e:
+        # Not str(e): it includes the request URL, which carries the access token
+        status = getattr(e.response, "status_code", None)
+        result["reason"] = f"Graph API refresh failed: {type(e).__name__}" + (f" (HTTP {status})" if status else "")
+        return result
+    except Exception as e:
+        result["reason"] = f"{type(e).__name__}: {e}"
+        return result
+    finally:
+        timings["total"] = round((time.perf_counter() - started) * 1000, 1)
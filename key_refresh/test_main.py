@@ -0,0 +1,149 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import main
+
+NOW = 1_700_000_000
+DAY = 24 * 60 * 60
+TOKEN = "OLD_SECRET_TOKEN"
+
+
+class FakeSecretManager:
+    """Stands in for SecretManagerServiceClient: versions of one secret, newest last."""
+
+    def __init__(self, secrets):
+        self.versions = [json.dumps(secrets).encode("utf-8")]
+
+    def access_secret_version(self, name, timeout=None):
+        assert name.endswith("/versions/latest")
+        return SimpleNamespace(payload=SimpleNamespace(data=self.versions[-1]))
+
+    def add_secret_version(self, parent, payload, timeout=None):
+        self.versions.append(payload["data"])
+        return SimpleNamespace(name=f"{parent}/versions/{len(self.versions)}")
+
+    def latest(self):
+        return json.loads(self.versions[-1])
+
+
+class FakeGraph:
+    """Stands in for the requests session: answers refresh_access_token with a canned status and body."""
+
+    def __init__(self, status=200, body=None, error=None):
+        self.status = status
+        self.body = body if body is not None else {"access_token": "NEW_TOKEN", "expires_in": 60 * DAY}
+        self.error = error
+        self.calls = []
+
+    def get(self, url, params=None, timeout=None):
+        self.calls.append((url, params))
+        if self.error:
+            raise self.error
+        response = requests.Response()
+        response.status_code = self.status
+        response._content = json.dumps(self.body).encode("utf-8")
+        # Like a real response, the URL carries the token, so it ends up in raise_for_status's message
+        response.url = f"{url}?grant_type=ig_refresh_token&access_token={params['access_token']}"
+        return response
+
+
+def refresh(secrets, graph=None, force=False):
+    client = FakeSecretManager(secrets)
+    graph = graph or FakeGraph()
+    result = main.run_refresh("project", force=force, client=client, http_session=graph, now=NOW)
+    return result, client, graph
+
+
+def test_skipped_outside_refresh_window():
+    expires_at = NOW + main.REFRESH_WINDOW + DAY
+    result, client, graph = refresh({"INSTAGRAM_ACCESS_TOKEN": TOKEN, "INSTAGRAM_TOKEN_EXPIRES_AT": expires_at})
+    assert result["status"] == "skipped"
+    assert result["expires_at"] == expires_at
+    assert graph.calls == []
+    assert len(client.versions) == 1
+
+
+def test_refreshed_near_expiry():
+    result, client, graph = refresh({"INSTAGRAM_ACCESS_TOKEN": TOKEN, "INSTAGRAM_TOKEN_EXPIRES_AT": NOW + 2 * DAY,
+                                     "OTHER": "kept"})
+    assert result["status"] == "refreshed"
+    assert result["reason"] == "near expiry"
+    assert graph.calls == [(f"{main.GRAPH_API_URL}/refresh_access_token",
+                            {"grant_type": "ig_refresh_token", "access_token": TOKEN})]
+    stored = client.latest()
+    assert stored["INSTAGRAM_ACCESS_TOKEN"] == "NEW_TOKEN"
+    assert stored["OTHER"] == "kept"
+    assert result["secret_version"] == "projects/project/secrets/mysecrets-json/versions/2"
+
+
+def test_refreshed_without_stored_expiry():
+    result, client, _ = refresh({"INSTAGRAM_ACCESS_TOKEN": TOKEN})
+    assert result["status"] == "refreshed"
+    assert result["reason"] == "no stored expiry"
+    assert client.latest()["INSTAGRAM_ACCESS_TOKEN"] == "NEW_TOKEN"
+
+
+def test_force_refreshes_a_fresh_token():
+    expires_at = NOW + 50 * DAY
+    result, client, graph = refresh({"INSTAGRAM_ACCESS_TOKEN": TOKEN, "INSTAGRAM_TOKEN_EXPIRES_AT": expires_at},
+                                    force=True)
+    assert result["status"] == "refreshed"
+    assert result["reason"] == "forced"
+    assert len(graph.calls) == 1
+    assert len(client.versions) == 2
+
+
+def test_missing_token():
+    result, client, graph = refresh({"SOMETHING_ELSE": "x"})
+    assert result["status"] == "error"
+    assert "INSTAGRAM_ACCESS_TOKEN" in result["reason"]
+    assert graph.calls == []
+    assert len(client.versions) == 1
+
+
+@pytest.mark.parametrize("graph, detail", [
+    (FakeGraph(status=400, body={"error": {"message": "Invalid OAuth access token"}}), "HTTPError (HTTP 400)"),
+    (FakeGraph(error=requests.ConnectionError(
+        f"Max retries exceeded with url: /refresh_access_token?access_token={TOKEN}")), "ConnectionError"),
+])
+def test_graph_error_keeps_token_out_of_reason(graph, detail):
+    result, client, _ = refresh({"INSTAGRAM_ACCESS_TOKEN": TOKEN}, graph=graph)
+    assert result["status"] == "error"
+    assert result["reason"] == f"Graph API refresh failed: {detail}"
+    assert TOKEN not in json.dumps(result)
+    assert len(client.versions) == 1
+
+
+def test_expires_in_written_back():
+    graph = FakeGraph(body={"access_token": "NEW_TOKEN", "token_type": "bearer", "expires_in": 5_184_000})
+    result, client, _ = refresh({"INSTAGRAM_ACCESS_TOKEN": TOKEN, "INSTAGRAM_TOKEN_EXPIRES_AT": NOW + DAY},
+                                graph=graph)
+    assert client.latest()["INSTAGRAM_TOKEN_EXPIRES_AT"] == NOW + 5_184_000
+    assert result["expires_at"] == NOW + 5_184_000
+
+
+def test_response_without_expires_in_assumes_60_days():
+    graph = FakeGraph(body={"access_token": "NEW_TOKEN"})
+    result, client, _ = refresh({"INSTAGRAM_ACCESS_TOKEN": TOKEN, "INSTAGRAM_TOKEN_EXPIRES_AT": NOW + DAY},
+                                graph=graph)
+    assert result["status"] == "refreshed"
+    assert client.latest()["INSTAGRAM_TOKEN_EXPIRES_AT"] == NOW + 60 * DAY
+    # So the next run skips instead of refreshing again
+    result, _, graph = refresh(client.latest())
+    assert result["status"] == "skipped"
+    assert graph.calls == []
+
+
+def test_response_without_access_token():
+    result, client, _ = refresh({"INSTAGRAM_ACCESS_TOKEN": TOKEN}, graph=FakeGraph(body={"expires_in": 100}))
+    assert result["status"] == "error"
+    assert len(client.versions) == 1
+
+
+def test_missing_project():
+    result = main.run_refresh(None, client=FakeSecretManager({}), http_session=FakeGraph(), now=NOW)
+    assert result["status"] == "error"
+    assert "GCP_PROJECT" in result["reason"]
@@ -0,0 +1,88 @@
+"""
+Admission control for webhook POSTs, so a flood of events degrades into 503s instead of unbounded memory use.
+
+Accepted events cost memory until they are delivered: rows in the event queue, jobs in the Discord lanes,
+reels waiting for a caption, and for media the downloads themselves. Once that backlog is too deep the
+webhook answers 503 with a Retry-After header, so Instagram redelivers the POST later instead of us holding
+it. Media is refused first: POSTs carrying reels/posts are shed at a lower backlog than text-only ones, so
+cheap text keeps flowing while the expensive work catches up. Shed events are refused before the dedup
+store sees them, so the redelivery isn't mistaken for a duplicate.
+
+Shedding is logged once per episode: a WARNING when the first POST is refused and an INFO line with the
+total once a POST is accepted again, so a flood doesn't also flood the logs.
+"""
+import logging
+import threading
+
+from forwarding import extract_message, is_valid_event
+from metrics import SHED
+
+logger = logging.getLogger(__name__)
+
+
+class LoadShedder:
+    """
+    Decides whether a webhook POST is accepted, from the event queue, the Discord lanes and the pending media.
+
+    Args:
+        max_backlog (int): Queued events plus queued Discord sends at which every POST is refused.
+        media_backlog (int): The same backlog at which POSTs carrying reels/posts are refused.
+        max_pending_media (int): Reels/posts waiting for a caption at which POSTs carrying more are refused.
+        retry_after (int): Seconds to suggest in the Retry-After header.
+    """
+
+    def __init__(self, event_queue, discord_sender, pending_media, max_backlog=2000, media_backlog=500,
+                 max_pending_media=200, retry_after=30):
+        self.event_queue = event_queue
+        self.discord_sender = discord_sender
+        self.pending_media = pending_media
+        self.max_backlog = max_backlog
+        self.media_backlog = media_backlog
+        self.max_pending_media = max_pending_media
+        self.retry_after = retry_after
+        # Events refused since shedding started, or None while POSTs are accepted
+        self._shed_events = None
+        self._lock = threading.Lock()
+
+    def backlog(self):
+        """Events queued or in progress plus Discord sends waiting in their lanes."""
+        return self.event_queue.depth() + self.discord_sender.queued()
+
+    def refusal_headers(self):
+        """Headers for the 503 answering a refused POST: Retry-After asks Instagram to hold its redelivery."""
+        return {'Retry-After': str(self.retry_after)}
+
+    def check(self, events):
+        """
+        Returns None if the POST's messaging events should be accepted, or the reason it is refused.
+
+        A refusal counts every event in the POST, since Instagram redelivers all of them.
+        """
+        if not events:
+            return None
+        backlog = self.backlog()
+        reason = None
+        if backlog >= self.max_backlog:
+            reason = "backlog"
+        elif any(is_valid_event(messaging) and (extract_message(messaging) or (None, None))[1] for messaging in events):
+            if backlog >= self.media_backlog:
+                reason = "media_backlog"
+            elif len(self.pending_media) >= self.max_pending_media:
+                reason = "pending_media"
+        if reason:
+            SHED.labels(reason).inc(len(events))
+        self._log_episode(reason, len(events), backlog)
+        return reason
+
+    def _log_episode(self, reason, count, backlog):
+        with self._lock:
+            shed_events, started = self._shed_events, False
+            if reason:
+                started = shed_events is None
+                self._shed_events = (shed_events or 0) + count
+            else:
+                self._shed_events = None
+        if started:
+            logger.warning("Shedding webhook events: %s (backlog %d)", reason, backlog)
+        elif not reason and shed_events is not None:
+            logger.info("Stopped shedding webhook events after refusing %d (backlog %d)", shed_events, backlog)
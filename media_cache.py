@@ -0,0 +1,123 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Query parameters that Instagram/Facebook CDNs rotate per request (signatures, expiry, routing hints).
+# Dropping them lets two shares of the same asset map to one cache key.
+VOLATILE_QUERY_PARAMS = {"oh", "oe", "signature", "efg", "ccb", "stp", "dl", "ig_cache_key"}
+
+
+def canonical_media_url(url):
+    """Returns url with volatile CDN query parameters removed and the rest sorted."""
+    parts = urlsplit(url)
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in VOLATILE_QUERY_PARAMS and not key.startswith("_nc_")
+    )
+    return urlunsplit((parts.scheme, parts.netloc.lower(), parts.path, urlencode(query), ""))
+
+
+def _attachment_expiry(attachment_url, ttl):
+    """Discord signs attachment URLs with a hex 'ex' timestamp; never trust a link past that."""
+    expires_at = time.time() + ttl
+    for key, value in parse_qsl(urlsplit(attachment_url).query):
+        if key == "ex":
+            try:
+                expires_at = min(expires_at, int(value, 16) - 60)
+            except ValueError:
+                pass
+    return expires_at
+
+
+class MediaCache:
+    """
+    Byte-bounded LRU cache of downloaded media, keyed by canonical URL and by content hash.
+
+    Besides the bytes themselves, the cache remembers the Discord attachment URL each piece of media was
+    uploaded as. A later share of the same reel (same canonical URL, or different URL but identical content)
+    can then link the existing attachment instead of downloading and uploading it again.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, attachment_ttl=12 * 60 * 60):
+        self.max_bytes = max_bytes
+        self.attachment_ttl = attachment_ttl
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.attachment_hits = 0
+        self._entries = OrderedDict()  # canonical url -> (digest, data)
+        self._url_digests = {}  # canonical url -> digest, kept after the bytes are evicted
+        self._attachments = {}  # digest -> (attachment url, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """Returns the cached bytes for url, or None."""
+        key = canonical_media_url(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, url, data):
+        """
+        Caches the bytes downloaded from url.
+
+        Returns:
+            str: The SHA-256 digest of the data.
+        """
+        key = canonical_media_url(url)
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._url_digests[key] = digest
+            while len(self._url_digests) > 4096:
+                self._url_digests.pop(next(iter(self._url_digests)))
+            if len(data) > self.max_bytes:
+                return digest
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old[1])
+            self._entries[key] = (digest, data)
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+        return digest
+
+    def attachment_url(self, url=None, digest=None):
+        """Returns a still-valid Discord attachment URL for the media at url (or with this digest), if any."""
+        with self._lock:
+            if digest is None:
+                digest = self._url_digests.get(canonical_media_url(url))
+            attachment = self._attachments.get(digest)
+            if attachment is None:
+                return None
+            if attachment[1] <= time.time():
+                del self._attachments[digest]
+                return None
+            self.attachment_hits += 1
+            return attachment[0]
+
+    def remember_attachment(self, url, attachment_url):
+        """Records that the media at url was uploaded to Discord as attachment_url."""
+        with self._lock:
+            digest = self._url_digests.get(canonical_media_url(url))
+            if digest is not None:
+                self._attachments[digest] = (attachment_url, _attachment_expiry(attachment_url, self.attachment_ttl))
+                while len(self._attachments) > 4096:
+                    self._attachments.pop(next(iter(self._attachments)))
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "attachment_hits": self.attachment_hits,
+        }
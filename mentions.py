@@ -0,0 +1,55 @@
+import re
+
+# Regular expression to find @username mentions
+MENTION_PATTERN = re.compile(r'@(\w+)')
+
+
+class MentionResolver:
+    """
+    Case-insensitive index over DISCORD_USER_IDS for @mention replacement and DM routing.
+
+    Built once whenever secrets are loaded, so both lookups are a single dict access no matter how many
+    users are configured, and both use the same casefolded matching.
+    """
+
+    def __init__(self, user_ids):
+        self.user_ids = user_ids or {}
+        self._index = {name.casefold(): (name, user_id) for name, user_id in self.user_ids.items()}
+
+    def lookup(self, name):
+        """Returns (configured name, Discord user ID) for name, or None if it isn't a known user."""
+        return self._index.get(name.casefold())
+
+    def replace_mentions(self, message_text):
+        """
+        Replace @mentions of known users with Discord mention format <@USER_ID>
+        Args:
+            message_text (str): The message text to parse
+        Returns:
+            str: The message text with known @mentions replaced; unknown ones are left as-is
+        """
+        if not message_text:
+            return message_text
+
+        def replace_mention(match):
+            user = self._index.get(match.group(1).casefold())
+            return f"<@{user[1]}>" if user else match.group(0)
+
+        return MENTION_PATTERN.sub(replace_mention, message_text)
+
+    def route(self, message_text):
+        """
+        Works out whether a message starts with a user's name and should be sent to them as a DM.
+
+        Returns:
+            tuple: (configured name, Discord user ID, remaining message or None), or None if the first word
+                   isn't a known user
+        """
+        words = message_text.split() if message_text else []
+        if not words:
+            return None
+        user = self._index.get(words[0].casefold())
+        if user is None:
+            return None
+        remainder = ' '.join(words[1:]) or None
+        return user[0], user[1], remainder
@@ -0,0 +1,309 @@
+"""
+Minimal in-process metrics with Prometheus text exposition.
+
+Counters and histograms are plain dicts of numbers behind one lock per metric, and label lookups are cached
+per label combination, so recording a sample costs a dict lookup and an addition. Gauges are callbacks that
+are only evaluated when /metrics is scraped. Both webhook.py and aio_server.py serve render() at /metrics,
+to requests carrying METRICS_TOKEN as a bearer token (see authorized()); the service is deployed without
+Cloud Run authentication, so the endpoint is otherwise public.
+"""
+import bisect
+import hmac
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; covers cache hits (sub-millisecond) up to slow uploads and shrinks
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def authorized(authorization, token):
+    """Whether an Authorization header carries token as its bearer token. With no token configured, none does."""
+    if not token or not authorization:
+        return False
+    scheme, _, credentials = authorization.partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(credentials.strip().encode(), token.encode())
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """The set of metrics rendered by /metrics, in registration order."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        """Returns the child for one combination of label values; keep a reference to it on hot paths."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self, lock):
+        self.value = 0
+        self._lock = lock
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """A monotonically increasing count, optionally split by labels."""
+
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild(self._lock)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        with self._lock:
+            children = [(values, child.value) for values, child in self._children.items()]
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}"
+                for values, value in children]
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets, lock):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = lock
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        """Observes the wall time of the with-block, including when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(_Metric):
+    """Counts observations into fixed buckets (cumulative on export) and keeps their sum."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets, self._lock)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def samples(self):
+        with self._lock:
+            children = [(values, list(child.counts), child.sum) for values, child in self._children.items()]
+        lines = []
+        for values, counts, total in children:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, values, [("le", _format_value(float(bound)))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge(_Metric):
+    """
+    A value read at scrape time from a callback.
+
+    The callback returns a number, or for labelled gauges a dict of {label values tuple: number}.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, read, labelnames=(), registry=REGISTRY):
+        self.read = read
+        super().__init__(name, documentation, labelnames, registry)
+
+    def samples(self):
+        try:
+            value = self.read()
+        except Exception:
+            return []
+        values = value if self.labelnames else {(): value}
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(sample)}"
+                for labels, sample in values.items()]
+
+
+class CounterFunc(Gauge):
+    """A counter kept by another object (such as a cache's hit count), read at scrape time like a gauge."""
+
+    kind = "counter"
+
+
+# Instruments shared by both servers
+
+STAGE_SECONDS = Histogram(
+    "crosschat_stage_seconds", "Time spent in each stage of forwarding a message.", ["stage"]
+)
+DISCORD_ROUTE_WAIT = Histogram(
+    "crosschat_discord_queue_wait_seconds", "Time Discord sends waited in their lane before running, by route kind.",
+    ["route"]
+)
+EVENTS = Counter(
+    "crosschat_events_total", "Webhook messaging events processed, by outcome.", ["status"]
+)
+MESSAGES_SENT = Counter(
+    "crosschat_messages_sent_total", "Messages delivered to Discord.", ["context_type", "media_type", "delivery"]
+)
+DROPPED = Counter(
+    "crosschat_messages_dropped_total", "Messages that were skipped or could not be delivered, by reason.", ["reason"]
+)
+DUPLICATES = Counter(
+    "crosschat_duplicate_events_total", "Webhook events ignored because they were already received, by key type.",
+    ["key"]
+)
+COALESCED = Counter(
+    "crosschat_messages_coalesced_total", "Text messages merged into an earlier queued Discord message."
+)
+SHED = Counter(
+    "crosschat_events_shed_total", "Webhook events refused with a 503 because the service was overloaded, by reason.",
+    ["reason"]
+)
+UPSTREAM_RETRIES = Counter(
+    "crosschat_upstream_retries_total", "Calls to Instagram or Discord retried after a transient failure.",
+    ["dependency"]
+)
+CIRCUIT_REJECTED = Counter(
+    "crosschat_circuit_rejected_total", "Calls not attempted because the dependency's circuit breaker was open.",
+    ["dependency"]
+)
+DM_CHANNEL_LOOKUPS = Counter(
+    "crosschat_dm_channel_lookups_total", "DM recipients whose channel came from the cache or had to be resolved.",
+    ["result"]
+)
+LOG_SUPPRESSED = Counter(
+    "crosschat_log_records_suppressed_total", "Repetitive log lines dropped by the rate limit, by logger.", ["logger"]
+)
+MEDIA_BYTES = Counter(
+    "crosschat_media_bytes_total", "Media bytes downloaded from Instagram and uploaded to Discord.", ["direction"]
+)
+
+# Stage children used on hot paths
+USERNAME_LOOKUP = STAGE_SECONDS.labels("username_lookup")
+MEDIA_DOWNLOAD = STAGE_SECONDS.labels("media_download")
+MEDIA_SHRINK = STAGE_SECONDS.labels("media_shrink")
+DISCORD_LOGIN = STAGE_SECONDS.labels("discord_login")
+DISCORD_QUEUE_WAIT = STAGE_SECONDS.labels("discord_queue_wait")
+DISCORD_SEND = STAGE_SECONDS.labels("discord_send")
+EVENT_PROCESSING = STAGE_SECONDS.labels("event_processing")
+BYTES_DOWNLOADED = MEDIA_BYTES.labels("downloaded")
+BYTES_UPLOADED = MEDIA_BYTES.labels("uploaded")
+
+
+def register_server_gauges(pending_media, event_queue, discord_sender, media_cache, dedup_store, breakers=(),
+                           username_cache=None, username_lookups=None, registry=REGISTRY):
+    """Registers the queue depth, cache and circuit breaker gauges that both servers expose."""
+    Gauge("crosschat_pending_media", "Reels/posts waiting for a caption.", lambda: len(pending_media),
+          registry=registry)
+    Gauge("crosschat_event_queue_depth", "Webhook events queued or in progress.", event_queue.depth,
+          registry=registry)
+    Gauge("crosschat_event_queue_handed_off", "Webhook events kept in the queue until their Discord send is delivered.",
+          event_queue.handed_off, registry=registry)
+    Gauge("crosschat_discord_queued", "Sends waiting in the Discord lanes, by route kind (channel or dm).",
+          lambda: {(kind,): queued for kind, queued in discord_sender.queued_by_kind().items()},
+          labelnames=["route"], registry=registry)
+    Gauge("crosschat_media_cache_bytes", "Bytes of media held in the media cache.",
+          lambda: media_cache.total_bytes, registry=registry)
+    Gauge("crosschat_dedup_keys", "Webhook event keys remembered for duplicate detection.", lambda: len(dedup_store),
+          registry=registry)
+    if username_cache is not None:
+        Gauge("crosschat_username_cache_entries", "Instagram usernames held in the username cache.",
+              lambda: username_cache.stats()["size"], registry=registry)
+        CounterFunc("crosschat_username_cache_total",
+                    "Username cache lookups by result: hit, miss, or shared (a miss that joined a lookup in flight).",
+                    lambda: _username_cache_counts(username_cache, username_lookups),
+                    labelnames=["result"], registry=registry)
+    Gauge("crosschat_circuit_state", "Circuit breaker state per upstream dependency: 0 closed, 1 half-open, 2 open.",
+          lambda: {(breaker.name,): breaker.state_value() for breaker in breakers},
+          labelnames=["dependency"], registry=registry)
+
+
+def _username_cache_counts(username_cache, username_lookups):
+    stats = username_cache.stats()
+    counts = {("hit",): stats["hits"], ("miss",): stats["misses"]}
+    if username_lookups is not None:
+        counts[("shared",)] = username_lookups.shared
+    return counts
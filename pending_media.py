@@ -0,0 +1,170 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+def copy_outcome(source, target):
+    """Done callback body: settles the Future target with the result or exception of the Future source."""
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+class PendingMediaStore:
+    """
+    Holds reels/posts for a short time so a caption sent right after them can be attached.
+
+    Entries are indexed by sender, so looking up a sender's pending media is O(1) no matter how many other
+    senders are active. Every entry gets its own deadline; a single expiry thread sleeps on a heap of
+    deadlines and hands expired entries to on_expire outside the lock, so slow Discord sends never block
+    webhook processing. Deadlines are measured with clock (time.monotonic by default).
+    """
+
+    def __init__(self, on_expire, delay=2.0, clock=time.monotonic):
+        self.on_expire = on_expire
+        self.delay = delay
+        self.clock = clock
+        self._by_sender = {}
+        self._deadlines = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def add(self, entry):
+        """
+        Queues a media entry (a dict with at least 'sender_id') until its deadline passes.
+
+        Returns:
+            concurrent.futures.Future: Settled by sent() once the entry's send is delivered or has failed.
+        """
+        deadline = self.clock() + self.delay
+        entry['deadline'] = deadline
+        entry['taken'] = False
+        delivered = entry['delivered'] = Future()
+        with self._cond:
+            self._by_sender.setdefault(entry['sender_id'], deque()).append(entry)
+            heapq.heappush(self._deadlines, (deadline, next(self._seq), entry))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._expire_loop, name="pending-media", daemon=True)
+                self._thread.start()
+            # Wake the expiry thread only if this entry is now the earliest deadline
+            if self._deadlines[0][2] is entry:
+                self._cond.notify()
+        return delivered
+
+    def take(self, sender_id):
+        """Removes and returns the sender's oldest pending entry, or None if there isn't one."""
+        with self._cond:
+            entries = self._by_sender.get(sender_id)
+            if not entries:
+                return None
+            entry = entries.popleft()
+            if not entries:
+                del self._by_sender[sender_id]
+            # The heap entry is discarded lazily when its deadline comes up
+            entry['taken'] = True
+            return entry
+
+    def sent(self, entry, delivery):
+        """Reports the send of a taken or expired entry: add()'s future follows the delivery Future."""
+        delivery.add_done_callback(lambda future: copy_outcome(future, entry['delivered']))
+
+    def __len__(self):
+        with self._cond:
+            return sum(len(entries) for entries in self._by_sender.values())
+
+    def _pop_expired(self, now):
+        expired = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, entry = heapq.heappop(self._deadlines)
+            if entry['taken']:
+                continue
+            # Entries for one sender share the same delay, so the expired one is always the oldest
+            entries = self._by_sender[entry['sender_id']]
+            entries.popleft()
+            if not entries:
+                del self._by_sender[entry['sender_id']]
+            entry['taken'] = True
+            expired.append(entry)
+        return expired
+
+    def _expire_loop(self):
+        while True:
+            with self._cond:
+                expired = self._pop_expired(self.clock())
+                while not expired:
+                    timeout = self._deadlines[0][0] - self.clock() if self._deadlines else None
+                    self._cond.wait(timeout)
+                    expired = self._pop_expired(self.clock())
+
+            for entry in expired:
+                try:
+                    self.on_expire(entry)
+                except Exception as e:
+                    logger.error("Error flushing pending media from %s: %s", entry.get('username'), e)
+
+
+class AsyncPendingMediaStore:
+    """
+    PendingMediaStore for the asyncio server: same add/take interface, but deadlines are loop timers.
+
+    Must only be used from the event loop thread. on_expire is a plain function called on the loop; it should
+    hand off slow work (like a Discord send) rather than await it.
+    """
+
+    def __init__(self, on_expire, delay=2.0):
+        self.on_expire = on_expire
+        self.delay = delay
+        self._by_sender = {}
+
+    def add(self, entry):
+        """Queues a media entry (a dict with at least 'sender_id') until its deadline passes; see PendingMediaStore."""
+        loop = asyncio.get_running_loop()
+        entry['deadline'] = loop.time() + self.delay
+        entry['taken'] = False
+        delivered = entry['delivered'] = Future()
+        self._by_sender.setdefault(entry['sender_id'], deque()).append(entry)
+        entry['timer'] = loop.call_at(entry['deadline'], self._expire, entry)
+        return delivered
+
+    def take(self, sender_id):
+        """Removes and returns the sender's oldest pending entry, or None if there isn't one."""
+        entries = self._by_sender.get(sender_id)
+        if not entries:
+            return None
+        entry = entries.popleft()
+        if not entries:
+            del self._by_sender[sender_id]
+        entry['taken'] = True
+        entry.pop('timer').cancel()
+        return entry
+
+    sent = PendingMediaStore.sent
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._by_sender.values())
+
+    def _expire(self, entry):
+        if entry['taken']:
+            return
+        # Entries for one sender share the same delay, so the expired one is always the oldest
+        entries = self._by_sender[entry['sender_id']]
+        entries.popleft()
+        if not entries:
+            del self._by_sender[entry['sender_id']]
+        entry['taken'] = True
+        entry.pop('timer', None)
+        try:
+            self.on_expire(entry)
+        except Exception as e:
+            logger.error("Error flushing pending media from %s: %s", entry.get('username'), e)
@@ -0,0 +1,174 @@
+"""
+The part of CrossChat that doesn't depend on the server: configuration, the username and media caches, and
+what happens to a queued webhook event.
+
+The Flask/gevent app (webhook.py) and the asyncio server (aio_server.py) each build one Relay and keep only
+their I/O: the Graph API username lookup, media downloads and shrinking, with blocking calls in one and
+coroutines in the other. Cache checks, failure caching, event triage, pairing reels with captions and
+secrets reloads all happen here, so the two servers behave the same.
+"""
+import logging
+
+from forwarding import Forwarder, dispatch_message, extract_message, media_buffer, send_pending
+from metrics import DROPPED, EVENTS
+from settings import GRAPH_API_URL, USERNAME_FAILURE_TTL, Config
+from structured_logging import stage_extra
+
+logger = logging.getLogger(__name__)
+
+UNKNOWN_USER = 'Unknown User'
+
+
+def username_from_response(status, body):
+    """
+    Reads a Graph API username lookup's response, given its status and decoded JSON body (None unless the
+    status is 200).
+
+    Returns:
+        str: The username, 'Unknown User' if the account has none, or None if the lookup failed.
+    """
+    if status != 200 or not isinstance(body, dict):
+        return None
+    return body.get('username') or UNKNOWN_USER
+
+
+class Relay:
+    """
+    Holds the live configuration and the state shared by a server's handlers and workers.
+
+    Args:
+        config (Config): Configuration at startup; apply_secrets() replaces it when the secrets file changes.
+        fetch_media, shrink_media: The server's coroutine functions for the Forwarder (see forwarding.py).
+        state: Backend from shared_state.create_state, which holds reels waiting for a caption.
+        pending_delay (float): Seconds a reel/post waits for a caption.
+        asynchronous (bool): Whether the pending reel store runs on the event loop (aio_server.py).
+    """
+
+    def __init__(self, config, discord_sender, media_cache, username_cache, dm_channels, fetch_media, shrink_media,
+                 state, pending_delay, coalesce_window=0.0, asynchronous=False):
+        self.config = config
+        self.discord_sender = discord_sender
+        self.media_cache = media_cache
+        self.username_cache = username_cache
+        self.dm_channels = dm_channels
+        # Formats messages and sends them (with any reel/post) through the Discord sender
+        self.forwarder = Forwarder(discord_sender, media_cache, fetch_media, shrink_media,
+                                   coalesce_window=coalesce_window, dm_channels=dm_channels)
+        # Reels/posts waiting up to pending_delay seconds for a caption, indexed by sender
+        self.pending_reels = state.pending_store(on_expire=self.send_pending_reel, delay=pending_delay,
+                                                 asynchronous=asynchronous)
+
+    def cached_username(self, sender_id):
+        """Returns the cached username of sender_id, or None if it has to be looked up."""
+        return self.username_cache.get(sender_id)
+
+    def username_request(self, sender_id):
+        """Returns the (url, params) of the Graph API lookup of sender_id's username, with the live access token."""
+        return f"{GRAPH_API_URL}/{sender_id}", {'fields': 'username', 'access_token': self.config.instagram_access_token}
+
+    def store_username(self, sender_id, username):
+        """
+        Caches the result of a Graph API lookup. Failed lookups (None) are cached briefly as 'Unknown User'
+        so a flaky sender doesn't hammer the API.
+
+        Returns:
+            str: The username to show.
+        """
+        if username is None:
+            self.username_cache.set(sender_id, UNKNOWN_USER, ttl=USERNAME_FAILURE_TTL)
+            return UNKNOWN_USER
+        self.username_cache.set(sender_id, username)
+        return username
+
+    def cached_media(self, url, media_type="reel", budget=None):
+        """
+        Returns media for url from the media cache, charging its size to budget (a ByteBudget).
+
+        Returns:
+            tuple: (buffer, file_size) on a hit, (None, file_size) if budget runs out, or None on a miss.
+        """
+        data = self.media_cache.get(url)
+        if data is None:
+            return None
+        if budget is not None and not budget.take(len(data)):
+            return None, len(data)
+        return media_buffer(url, media_type, data), len(data)
+
+    def store_media(self, url, media_type, buffer, file_size):
+        """
+        Caches a finished download; takes and returns the (buffer, file_size) tuple of the server's download_reel.
+        """
+        if buffer is None:
+            return buffer, file_size
+        data = buffer.getvalue()
+        self.media_cache.put(url, data)
+        return media_buffer(url, media_type, data), len(data)
+
+    def screen_event(self, messaging):
+        """
+        First step of processing a messaging event, before the username lookup.
+
+        Returns:
+            str: The event's status if it needs no further processing (it's from our bot), else None.
+        """
+        if messaging['sender']['id'] == str(self.config.instagram_bot_user_id):
+            DROPPED.labels("bot_message").inc()
+            return 'skipped bot message'
+        return None
+
+    def dispatch_event(self, messaging, username):
+        """
+        Sends a screened messaging event from username to Discord, or holds its reel/post for a caption.
+
+        Returns:
+            tuple: (status, delivery) as returned by forwarding.dispatch_message; delivery is None if the event
+                   is done with.
+        """
+        # If it's not a supported type, do not send anything
+        content = extract_message(messaging)
+        if content is None:
+            logger.info("Unsupported message type from %s, skipping send.", username)
+            DROPPED.labels("unsupported_type").inc()
+            return 'unsupported type, skipped', None
+
+        message_text, media = content
+        return dispatch_message(
+            messaging['sender']['id'], username, message_text, media,
+            pending=self.pending_reels, send=self.send_message_to_discord, mentions=self.config.mentions
+        )
+
+    def record_event(self, messaging, status, started):
+        """Counts and logs a processed event; started is the time.perf_counter() its processing began at."""
+        EVENTS.labels(status).inc()
+        sender_id = messaging['sender']['id']
+        logger.info("Webhook event from %s: %s", sender_id, status,
+                    extra=stage_extra("event_processing", started, sender_id=sender_id, status=status))
+
+    def send_pending_reel(self, reel):
+        """Sends a reel/post whose caption window expired without a follow-up message."""
+        send_pending(reel, self.send_message_to_discord, self.pending_reels, reel.get('message_text'))
+        logger.info("Processed reel/post from %s", reel['username'])
+
+    def send_message_to_discord(self, username, message_text, media=(), sender_id=None):
+        """
+        Queues a message for Discord with the Instagram username, message content and any [url, media_type] media.
+
+        Returns:
+            concurrent.futures.Future: Resolves once the message has been delivered (or failed).
+        """
+        return self.forwarder.submit(self.config, username, message_text, media, sender_id=sender_id)
+
+    def apply_secrets(self, new_secrets):
+        """Swaps in configuration from a changed secrets file without disturbing in-flight requests."""
+        new_config = Config.from_secrets(new_secrets)
+        if new_config == self.config:
+            return
+        old_config, self.config = self.config, new_config
+        logger.info("Reloaded secrets from file.")
+
+        if (new_config.discord_user_ids != old_config.discord_user_ids
+                or new_config.discord_bot_token != old_config.discord_bot_token):
+            # Recipients were remapped, or a new bot would have different DM channels
+            self.dm_channels.clear()
+        if new_config.discord_bot_token != old_config.discord_bot_token:
+            self.discord_sender.set_token(new_config.discord_bot_token)
@@ -0,0 +1,189 @@
+"""
+Retries and circuit breakers for calls to Instagram and Discord.
+
+Each upstream dependency gets a CircuitBreaker. After failure_threshold consecutive failures it opens and
+calls fail fast with CircuitOpenError for reset_timeout seconds, so a degraded CDN or API costs callers
+nothing while it recovers. Then a single probe call is let through (half-open): success closes the breaker,
+failure opens it again. Callers catch CircuitOpenError and degrade: a temporary link instead of an upload,
+'Unknown User' instead of a username.
+
+retry_call/async_retry_call retry idempotent calls (Graph API and CDN GETs) with jittered exponential backoff
+and report the outcome to the dependency's breaker. Only connection errors, timeouts and UpstreamError (raised
+by the call for a 5xx or 429 reply) are retried or count as failures; any other reply means the upstream is up.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+
+from metrics import CIRCUIT_REJECTED, UPSTREAM_RETRIES
+
+logger = logging.getLogger(__name__)
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose circuit breaker is open."""
+
+    def __init__(self, name):
+        super().__init__(f"{name} circuit breaker is open")
+        self.name = name
+
+
+class UpstreamError(Exception):
+    """A reply that means the upstream is struggling (5xx, 429); retried and counted against its breaker."""
+
+
+def is_retryable_status(status):
+    return status == 429 or status >= 500
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker for one upstream dependency. Thread-safe.
+
+    Callers ask allow() before each call and then report record_success() or record_failure().
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0  # times the breaker has opened
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Returns True if a call may go ahead; once the open period is over, only one probe at a time."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    CIRCUIT_REJECTED.labels(self.name).inc()
+                    return False
+                self.state = HALF_OPEN
+                logger.info("%s circuit breaker half-open, probing", self.name)
+            if self._probing:
+                CIRCUIT_REJECTED.labels(self.name).inc()
+                return False
+            self._probing = True
+            return True
+
+    def retry_after(self):
+        """Seconds until allow() may let a call through again (0 when closed)."""
+        with self._lock:
+            if self.state == OPEN:
+                return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+            # Half-open with a probe in flight: check back shortly
+            return 0.5 if self.state == HALF_OPEN and self._probing else 0.0
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info("%s circuit breaker closed", self.name)
+            self.state = CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def release(self):
+        """Ends an allowed call that neither succeeded nor failed upstream, freeing the half-open probe slot."""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened += 1
+                self._opened_at = time.monotonic()
+                logger.warning("%s circuit breaker open for %gs after %d consecutive failure(s)",
+                               self.name, self.reset_timeout, self.failures)
+
+    def state_value(self):
+        """The state as a number for the crosschat_circuit_state gauge: 0 closed, 1 half-open, 2 open."""
+        return {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}[self.state]
+
+
+class RetryPolicy:
+    """
+    How often and how patiently to retry an idempotent call.
+
+    Delays use full jitter (a random wait up to base_delay * 2**retry, capped at max_delay) so callers that
+    failed together don't retry in lockstep.
+    """
+
+    def __init__(self, retries=2, base_delay=0.25, max_delay=2.0, retry_on=()):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Exceptions besides UpstreamError that mean "try again", e.g. requests.RequestException
+        self.retry_on = (UpstreamError,) + tuple(retry_on)
+
+    def delay(self, retry):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+
+def _describe(error):
+    # Not str(error) for request errors: their message includes the URL, which may carry an access token
+    return f"{type(error).__name__}: {error}" if isinstance(error, UpstreamError) else type(error).__name__
+
+
+def retry_call(breaker, policy, fn):
+    """
+    Calls fn() through breaker, retrying policy.retry_on exceptions with backoff.
+
+    Raises:
+        CircuitOpenError: If the breaker is open; fn isn't called.
+        Exception: Whatever the last attempt raised once retries are used up.
+    """
+    if not breaker.allow():
+        raise CircuitOpenError(breaker.name)
+    try:
+        for retry in range(policy.retries + 1):
+            try:
+                result = fn()
+            except policy.retry_on as e:
+                if retry == policy.retries:
+                    breaker.record_failure()
+                    raise
+                UPSTREAM_RETRIES.labels(breaker.name).inc()
+                logger.info("Retrying %s call after %s", breaker.name, _describe(e))
+                time.sleep(policy.delay(retry))
+            else:
+                breaker.record_success()
+                return result
+    except BaseException:
+        # Also covers errors that aren't upstream failures: don't leave a half-open probe outstanding
+        breaker.release()
+        raise
+
+
+async def async_retry_call(breaker, policy, fn):
+    """retry_call for coroutine functions: awaits fn() and sleeps on the event loop between attempts."""
+    if not breaker.allow():
+        raise CircuitOpenError(breaker.name)
+    try:
+        for retry in range(policy.retries + 1):
+            try:
+                result = await fn()
+            except policy.retry_on as e:
+                if retry == policy.retries:
+                    breaker.record_failure()
+                    raise
+                UPSTREAM_RETRIES.labels(breaker.name).inc()
+                logger.info("Retrying %s call after %s", breaker.name, _describe(e))
+                await asyncio.sleep(policy.delay(retry))
+            else:
+                breaker.record_success()
+                return result
+    except BaseException:
+        breaker.release()
+        raise
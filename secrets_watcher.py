@@ -0,0 +1,57 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SecretsWatcher:
+    """
+    Polls the mounted secrets file and reports new contents when it changes.
+
+    Cloud Run refreshes secret volumes that point at the 'latest' version in place, so a token rotated by
+    key_refresh shows up here without a redeploy. A change is detected from the file's mtime, size and inode
+    (which also catches symlink swaps); the file is then re-read with `load`, and `on_change` is called with
+    the result. Unreadable or half-written files are skipped and retried on the next poll.
+    """
+
+    def __init__(self, path, load, on_change, interval=30.0):
+        self.path = path
+        self.load = load
+        self.on_change = on_change
+        self.interval = interval
+        self._signature = self._stat()
+        self._thread = None
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="secrets-watcher", daemon=True)
+            self._thread.start()
+
+    def check(self):
+        """Reloads the file if it changed since the last check. Returns True if on_change was called."""
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return False
+        data = self.load(self.path)
+        if data is None:
+            return False
+        self._signature = signature
+        self.on_change(data)
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception as e:
+                logger.error("Error reloading secrets from %s: %s", self.path, e)
@@ -0,0 +1,145 @@
+"""
+Configuration shared by the Flask/gevent app (webhook.py) and the asyncio server (aio_server.py).
+"""
+from dataclasses import dataclass, field
+import json
+import os
+
+from mentions import MentionResolver
+
+SECRETS_PATH = os.environ.get("SECRETS_PATH", "/etc/secrets/mysecrets.json")
+
+# Constants
+MAX_DISCORD_FILE_SIZE = 10 * 1024 * 1024  # 10MB in bytes
+MAX_DISCORD_FILES = 10  # attachments Discord accepts on one message
+DISCORD_MESSAGE_LIMIT = 2000  # characters in one Discord message
+# Max seconds between a sender's texts for them to be merged into one Discord message while sends are queued;
+# 0 sends every text separately
+COALESCE_WINDOW = float(os.environ.get('COALESCE_WINDOW', 2.0))
+# Total upload size of one message; the per-file limit unless the server's boost level allows more
+MAX_DISCORD_UPLOAD_SIZE = int(os.environ.get('MAX_DISCORD_UPLOAD_SIZE', MAX_DISCORD_FILE_SIZE))
+MEDIA_BATCH_BYTES = int(os.environ.get('MEDIA_BATCH_BYTES', 40 * 1024 * 1024))  # download budget per message
+MEDIA_BATCH_TIMEOUT = float(os.environ.get('MEDIA_BATCH_TIMEOUT', 60))  # seconds to download a message's media
+MEDIA_DOWNLOAD_TIMEOUT = (5, 30)  # (connect, read) seconds for media downloads
+GRAPH_API_TIMEOUT = (5, 10)  # (connect, read) seconds for Instagram Graph API calls
+DISCORD_SEND_TIMEOUT = float(os.environ.get('DISCORD_SEND_TIMEOUT', 60))  # seconds for one Discord post, uploads included
+DISCORD_API_TIMEOUT = float(os.environ.get('DISCORD_API_TIMEOUT', 10))  # seconds for other Discord calls (fetch_user)
+# Retries of idempotent Graph API and CDN requests after connection errors, timeouts and 5xx/429 replies,
+# with jittered exponential backoff from RETRY_BASE_DELAY up to RETRY_MAX_DELAY seconds (see resilience.py)
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+RETRY_BASE_DELAY = 0.25
+RETRY_MAX_DELAY = 2.0
+# Consecutive failures that open a dependency's circuit breaker, and seconds it stays open before a probe
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
+MEDIA_CACHE_BYTES = int(os.environ.get('MEDIA_CACHE_BYTES', 64 * 1024 * 1024))  # memory budget for cached media
+SHRINK_WORKERS = int(os.environ.get('SHRINK_WORKERS', 2))  # processes for shrinking oversized media, 0 disables
+SHRINK_TIME_BUDGET = float(os.environ.get('SHRINK_TIME_BUDGET', 60))  # seconds allowed per shrink job
+# Largest download accepted for shrinking. Each shrink job holds one scratch file of up to this size in /tmp,
+# which is memory on Cloud Run, so SHRINK_WORKERS * SHRINK_MAX_INPUT_BYTES bounds it
+SHRINK_MAX_INPUT_BYTES = int(os.environ.get('SHRINK_MAX_INPUT_BYTES', 50 * 1024 * 1024))
+USERNAME_CACHE_TTL = 6 * 60 * 60  # seconds to trust a resolved Instagram username
+USERNAME_FAILURE_TTL = 60  # seconds before retrying a failed username lookup
+PENDING_REEL_DELAY = 2.0  # seconds to wait for a caption after a reel/post
+SECRETS_POLL_INTERVAL = float(os.environ.get('SECRETS_POLL_INTERVAL', 30))  # seconds between secrets file checks
+# SQLite queue of accepted webhook events that aren't delivered yet. The default under /tmp survives the process
+# restarting, but on Cloud Run /tmp is in memory: the queue counts against the memory limit and is lost with the
+# instance when it is shut down or scaled in. Only a path on a persistent local disk survives that.
+EVENT_QUEUE_PATH = os.environ.get('EVENT_QUEUE_PATH', '/tmp/crosschat/events.db')
+EVENT_WORKERS = int(os.environ.get('EVENT_WORKERS', 8))  # concurrent webhook event handlers
+# Load shedding (see load_shedding.py): webhook POSTs are answered 503 with Retry-After once the backlog of
+# queued events plus queued Discord sends reaches MAX_BACKLOG, and POSTs carrying reels/posts once it reaches
+# MEDIA_BACKLOG or MAX_PENDING_MEDIA reels/posts are waiting for a caption, so text keeps flowing longest
+MAX_BACKLOG = int(os.environ.get('MAX_BACKLOG', 2000))
+MEDIA_BACKLOG = int(os.environ.get('MEDIA_BACKLOG', 500))
+MAX_PENDING_MEDIA = int(os.environ.get('MAX_PENDING_MEDIA', 200))
+SHED_RETRY_AFTER = int(os.environ.get('SHED_RETRY_AFTER', 30))  # seconds Instagram is asked to wait before retrying
+# Discord sends with media (and so downloads) in progress at once; capped one below the sender's slots so the
+# rest are kept for text
+MEDIA_SEND_CONCURRENCY = int(os.environ.get('MEDIA_SEND_CONCURRENCY', 4))
+DEDUP_TTL = float(os.environ.get('DEDUP_TTL', 24 * 60 * 60))  # seconds to remember a webhook event for retries
+DEDUP_MAX_ENTRIES = int(os.environ.get('DEDUP_MAX_ENTRIES', 50000))  # webhook events remembered at most
+DEDUP_PATH = os.environ.get('DEDUP_PATH')  # SQLite file to keep seen events across restarts; unset keeps them in memory
+DM_CHANNEL_CACHE_PATH = os.environ.get('DM_CHANNEL_CACHE_PATH')  # SQLite file to keep DM channel ids across restarts
+# redis://host:6379/0 to share pending media and dedup state between instances (see shared_state.py)
+STATE_BACKEND_URL = os.environ.get('STATE_BACKEND_URL')
+STATE_KEY_PREFIX = os.environ.get('STATE_KEY_PREFIX', 'crosschat:')
+# Seconds a sender's event waits for their previous one to be processed on another instance (Redis backend only)
+EVENT_ORDER_TIMEOUT = float(os.environ.get('EVENT_ORDER_TIMEOUT', 15))
+# Bearer token /metrics requires (see metrics.authorized); while unset, /metrics answers 404
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Logging (see structured_logging.py): "text" or "json" lines, and INFO/DEBUG lines let through per call site
+# every LOG_RATE_WINDOW seconds (0 disables the limit)
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_RATE_LIMIT = int(os.environ.get('LOG_RATE_LIMIT', 50))
+LOG_RATE_WINDOW = float(os.environ.get('LOG_RATE_WINDOW', 10))
+
+# Upstream endpoints; only overridden to point the service at local stand-ins (see benchmarks/loadtest.py)
+GRAPH_API_URL = os.environ.get('GRAPH_API_URL', 'https://graph.instagram.com')
+DISCORD_API_BASE = os.environ.get('DISCORD_API_BASE')  # e.g. http://127.0.0.1:9000/api/v10
+DISCORD_GATEWAY_URL = os.environ.get('DISCORD_GATEWAY_URL')  # e.g. ws://127.0.0.1:9000/gateway
+
+
+def get_secrets_from_file(file_path=SECRETS_PATH):
+    """
+    Reads secrets from a JSON file mounted by Cloud Run Secret Manager.
+
+    Args:
+        file_path (str): The path to the mounted secrets file.
+                         Defaults to "/etc/secrets/mysecrets.json".
+
+    Returns:
+        dict: A dictionary containing the loaded secrets, or None if an error occurs.
+    """
+    try:
+        with open(file_path, 'r') as f:
+            secrets = json.load(f)
+            return secrets
+    except FileNotFoundError:
+        print(f"Error: Secret file not found at {file_path}")
+        return None
+    except json.JSONDecodeError:
+        print(f"Error: Could not decode JSON from {file_path}")
+        return None
+
+
+@dataclass(frozen=True)
+class Config:
+    """
+    Immutable snapshot of the settings loaded from the secrets file.
+
+    Each server's Relay (relay.py) holds the current snapshot as relay.config and swaps it for a new one when
+    the secrets file changes. Code that reads several settings takes one reference to it first, so a request
+    never mixes old and new values.
+    """
+    discord_bot_token: str = None
+    discord_channel_id: int = None
+    instagram_bot_user_id: int = None
+    instagram_access_token: str = None
+    verify_token: str = None
+    discord_user_ids: dict = field(default_factory=dict)
+    mentions: MentionResolver = field(default=MentionResolver({}), compare=False, repr=False)
+
+    @classmethod
+    def from_secrets(cls, secrets):
+        user_ids = secrets.get("DISCORD_USER_IDS") or {}
+        return cls(
+            discord_bot_token=secrets.get("DISCORD_BOT_TOKEN"),
+            discord_channel_id=secrets.get("DISCORD_CHANNEL_ID"),
+            instagram_bot_user_id=secrets.get("INSTAGRAM_BOT_USER_ID"),
+            instagram_access_token=secrets.get("INSTAGRAM_ACCESS_TOKEN"),
+            verify_token=secrets.get("VERIFY_TOKEN"),
+            discord_user_ids=user_ids,
+            mentions=MentionResolver(user_ids),
+        )
+
+
+def load_config(logger, path=SECRETS_PATH):
+    """Builds the startup Config from the secrets file, falling back to an empty one if it can't be read."""
+    secrets = get_secrets_from_file(path)
+    if secrets:
+        logger.info("Successfully loaded secrets from file.")
+        return Config.from_secrets(secrets)
+    logger.error("Failed to load secrets from file. Application may not function correctly.")
+    return Config()
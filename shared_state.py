@@ -0,0 +1,366 @@
+"""
+Where the state that pairs and deduplicates messages lives: in this process, or in Redis shared by every instance.
+
+The pending reel/post store and the dedup store decide which instance sends what. A reel is sent by
+whichever instance takes it with its caption or claims it when its caption window expires, and a webhook
+event is queued by whichever instance sees it first. Kept in process memory, that only holds while the
+service runs as a single instance. With STATE_BACKEND_URL set to a redis:// URL, every instance reads and
+claims the same entries, so a reel and its caption can arrive at different instances and Instagram's retries
+are recognised wherever they land. Each take, claim and dedup check is one atomic Redis script, so one instance
+at a time holds a reel, and a sequence number per sender makes every instance process a sender's events in
+the order they were queued, so a caption isn't handled before the reel it follows.
+
+Delivery is at least once: an entry stays in Redis until its send is delivered, and its webhook event stays
+in the adding instance's event queue until then, so a reel can go out twice if an instance stops mid-send
+but isn't lost.
+
+The Redis backend needs the optional `redis` package and a single Redis node (not Redis Cluster). Its calls
+are short blocking round trips: gevent makes them cooperative in webhook.py, and aio_server.py makes them
+inline on its loop, as it does with the SQLite event queue.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+from dedup import DedupStore
+from pending_media import AsyncPendingMediaStore, PendingMediaStore, copy_outcome
+
+logger = logging.getLogger(__name__)
+
+# Seconds a send's outcome waits in Redis for the instance that added the entry
+_RESULT_TTL = 60 * 60
+
+# Returns a 1/0 per key (ARGV[4:]): 1 if it wasn't seen within its ttl and has now been recorded
+_DEDUP_ADD = """
+local now = tonumber(ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local fresh = {}
+for i = 4, #ARGV do
+    if redis.call('ZSCORE', KEYS[1], ARGV[i]) then
+        fresh[#fresh + 1] = 0
+    else
+        redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[i])
+        fresh[#fresh + 1] = 1
+    end
+end
+local excess = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[3])
+if excess > 0 then
+    redis.call('ZPOPMIN', KEYS[1], excess)
+end
+return fresh
+"""
+
+# The pending store's scripts. Entry ids are "<hex>:<sender_id>"; KEYS are always the deadlines sorted set
+# (id -> deadline), the entries hash (id -> JSON), the senders hash (sender_id -> JSON list of pending ids, oldest
+# first) and the in-flight sorted set (id -> lease deadline) of entries being sent.
+
+# Adds entry ARGV[4] with id ARGV[1], deadline ARGV[2] and sender ARGV[3]
+_PENDING_ADD = """
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[4])
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+local ids = cjson.decode(redis.call('HGET', KEYS[3], ARGV[3]) or '[]')
+ids[#ids + 1] = ARGV[1]
+redis.call('HSET', KEYS[3], ARGV[3], cjson.encode(ids))
+"""
+
+# Removes id from its sender's list of pending ids
+_PENDING_UNLINK = """
+local function unlink(id)
+    local sender = string.match(id, '^%x+:(.*)$')
+    local ids = cjson.decode(redis.call('HGET', KEYS[3], sender) or '[]')
+    for i, other in ipairs(ids) do
+        if other == id then
+            table.remove(ids, i)
+            break
+        end
+    end
+    if #ids == 0 then
+        redis.call('HDEL', KEYS[3], sender)
+    else
+        redis.call('HSET', KEYS[3], sender, cjson.encode(ids))
+    end
+end
+"""
+
+# Moves sender ARGV[1]'s oldest pending entry in flight until ARGV[2] and returns it
+_PENDING_TAKE = _PENDING_UNLINK + """
+local ids = cjson.decode(redis.call('HGET', KEYS[3], ARGV[1]) or '[]')
+local id = ids[1]
+if not id then
+    return false
+end
+unlink(id)
+redis.call('ZREM', KEYS[1], id)
+redis.call('ZADD', KEYS[4], ARGV[2], id)
+return redis.call('HGET', KEYS[2], id)
+"""
+
+# Claims up to ARGV[2] entries whose deadline (or, for entries in flight, lease) has passed by ARGV[1], putting
+# them in flight until ARGV[3]. An expired lease means the instance sending the entry stopped.
+_PENDING_CLAIM_EXPIRED = _PENDING_UNLINK + """
+local claimed = {}
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))) do
+    unlink(id)
+    redis.call('ZREM', KEYS[1], id)
+    redis.call('ZADD', KEYS[4], ARGV[3], id)
+    claimed[#claimed + 1] = redis.call('HGET', KEYS[2], id)
+end
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))) do
+    redis.call('ZADD', KEYS[4], ARGV[3], id)
+    claimed[#claimed + 1] = redis.call('HGET', KEYS[2], id)
+end
+return claimed
+"""
+
+
+class MemoryState:
+    """The default backend: stores that live in this process."""
+
+    def dedup_store(self, maxsize, ttl, path=None):
+        return DedupStore(maxsize=maxsize, ttl=ttl, path=path)
+
+    def pending_store(self, on_expire, delay, asynchronous=False):
+        store_class = AsyncPendingMediaStore if asynchronous else PendingMediaStore
+        return store_class(on_expire=on_expire, delay=delay)
+
+    def sequencer(self):
+        # One instance's event queue already keeps each sender's events in order
+        return None
+
+
+class RedisState:
+    """Backend whose stores live in Redis, shared by every instance pointed at the same server."""
+
+    def __init__(self, url, prefix="crosschat:"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND_URL is a Redis URL but the redis package is not installed")
+        self.client = redis.Redis.from_url(url, socket_timeout=5, socket_connect_timeout=5, health_check_interval=30)
+        self.prefix = prefix
+
+    def dedup_store(self, maxsize, ttl, path=None):
+        # Redis persists the keys itself, so path (the local SQLite copy) isn't used
+        return RedisDedupStore(self.client, self.prefix, maxsize=maxsize, ttl=ttl)
+
+    def pending_store(self, on_expire, delay, asynchronous=False):
+        return RedisPendingMediaStore(self.client, self.prefix, on_expire=on_expire, delay=delay,
+                                      asynchronous=asynchronous)
+
+    def sequencer(self):
+        return RedisSequencer(self.client, self.prefix)
+
+
+def create_state(url=None, prefix="crosschat:"):
+    """Returns the state backend for url: RedisState for redis:// or rediss:// URLs, MemoryState if unset."""
+    if not url or url == "memory":
+        return MemoryState()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        logger.info("Sharing pending media and dedup state through Redis")
+        return RedisState(url, prefix)
+    raise ValueError(f"Unsupported STATE_BACKEND_URL: {url}")
+
+
+class RedisDedupStore:
+    """DedupStore kept in a Redis sorted set (key -> expiry), bounded to maxsize keys across all instances."""
+
+    def __init__(self, client, prefix, maxsize=50000, ttl=24 * 60 * 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._client = client
+        self._key = f"{prefix}dedup"
+        self._add = client.register_script(_DEDUP_ADD)
+
+    def add_many(self, keys):
+        """Records keys as seen; returns True for each new key and False for each duplicate (see DedupStore)."""
+        if not keys:
+            return []
+        fresh = self._add(keys=[self._key], args=[time.time(), self.ttl, self.maxsize, *keys])
+        return [bool(flag) for flag in fresh]
+
+    def discard_many(self, keys):
+        """Forgets keys again, e.g. when the events they belong to could not be queued."""
+        if keys:
+            self._client.zrem(self._key, *keys)
+
+    def __len__(self):
+        return self._client.zcard(self._key)
+
+
+class RedisPendingMediaStore:
+    """
+    PendingMediaStore kept in Redis: entries in a hash, indexed by sender and by deadline.
+
+    Same add/take/sent interface as the in-process stores. Entries must be JSON-serialisable. Deadlines are wall
+    clock times so all instances agree on them. Once an instance has added an entry it polls every
+    poll_interval seconds, claiming expired entries and passing them to on_expire. A thread does the polling,
+    or with asynchronous=True a task on the running loop.
+
+    A taken or claimed entry stays in Redis, in flight, until sent() sees its send finish. If the instance
+    sending it stops first, its lease (lease seconds) runs out and any polling instance claims it again. The
+    future add() returned settles with the send's outcome even when another instance sent the entry: the
+    outcome is left in Redis for the adding instance's poller to pick up.
+    """
+
+    def __init__(self, client, prefix, on_expire, delay=2.0, poll_interval=0.1, lease=300.0, asynchronous=False):
+        self.on_expire = on_expire
+        self.delay = delay
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.asynchronous = asynchronous
+        self._client = client
+        self._prefix = f"{prefix}pending:"
+        self._keys = [self._prefix + name for name in ("deadlines", "entries", "senders", "in-flight")]
+        self._add = client.register_script(_PENDING_ADD)
+        self._take = client.register_script(_PENDING_TAKE)
+        self._claim_expired = client.register_script(_PENDING_CLAIM_EXPIRED)
+        # Futures returned by add() whose entries haven't been sent yet, by entry id
+        self._waiting = {}
+        self._poller = None
+        self._start_lock = threading.Lock()
+
+    def add(self, entry):
+        """
+        Queues a media entry (a dict with at least 'sender_id') until its deadline passes.
+
+        Returns:
+            concurrent.futures.Future: Settled once the entry's send, by any instance, is delivered or has failed.
+        """
+        entry['id'] = f"{uuid.uuid4().hex}:{entry['sender_id']}"
+        entry['deadline'] = time.time() + self.delay
+        delivered = self._waiting[entry['id']] = Future()
+        self._add(keys=self._keys, args=[entry['id'], entry['deadline'], entry['sender_id'], json.dumps(entry)])
+        self._start_poller()
+        return delivered
+
+    def take(self, sender_id):
+        """Takes the sender's oldest pending entry and returns it, or None if there isn't one."""
+        data = self._take(keys=self._keys, args=[sender_id, time.time() + self.lease])
+        return json.loads(data) if data else None
+
+    def sent(self, entry, delivery):
+        """Reports the send of a taken or claimed entry; once delivery is done the entry leaves Redis."""
+        delivery.add_done_callback(lambda future: self._finish(entry['id'], future))
+
+    def __len__(self):
+        """Entries pending across all instances, not counting those being sent."""
+        return self._client.zcard(self._keys[0])
+
+    def _result_key(self, entry_id):
+        return f"{self._prefix}result:{entry_id}"
+
+    def _finish(self, entry_id, future):
+        failed = future.cancelled() or future.exception() is not None
+        delivered = self._waiting.pop(entry_id, None)
+        try:
+            with self._client.pipeline(transaction=True) as pipe:
+                pipe.zrem(self._keys[3], entry_id)
+                pipe.hdel(self._keys[1], entry_id)
+                if delivered is None:
+                    # Added by another instance, whose poller passes the outcome on to the entry's event
+                    pipe.set(self._result_key(entry_id), "failed" if failed else "delivered", ex=_RESULT_TTL)
+                pipe.execute()
+        except Exception as e:
+            logger.error("Error finishing pending media %s in Redis: %s", entry_id, e)
+        if delivered is not None:
+            copy_outcome(future, delivered)
+
+    def _collect_results(self):
+        entry_ids = list(self._waiting)
+        if not entry_ids:
+            return
+        outcomes = self._client.mget([self._result_key(entry_id) for entry_id in entry_ids])
+        for entry_id, outcome in zip(entry_ids, outcomes):
+            if outcome is None:
+                continue
+            self._client.delete(self._result_key(entry_id))
+            delivered = self._waiting.pop(entry_id, None)
+            if delivered is None:
+                continue
+            if outcome == b"delivered":
+                delivered.set_result(None)
+            else:
+                delivered.set_exception(RuntimeError("Pending media send failed on another instance"))
+
+    def _flush_expired(self):
+        now = time.time()
+        expired = self._claim_expired(keys=self._keys, args=[now, 100, now + self.lease])
+        for data in expired:
+            entry = json.loads(data)
+            try:
+                self.on_expire(entry)
+            except Exception as e:
+                logger.error("Error flushing pending media from %s: %s", entry.get('username'), e)
+        self._collect_results()
+
+    def _start_poller(self):
+        with self._start_lock:
+            if self._poller is not None:
+                return
+            if self.asynchronous:
+                self._poller = asyncio.get_running_loop().create_task(self._poll_async())
+            else:
+                self._poller = threading.Thread(target=self._poll_loop, name="pending-media", daemon=True)
+                self._poller.start()
+
+    def _poll_loop(self):
+        while True:
+            try:
+                self._flush_expired()
+            except Exception as e:
+                logger.error("Error polling pending media in Redis: %s", e)
+            time.sleep(self.poll_interval)
+
+    async def _poll_async(self):
+        while True:
+            try:
+                self._flush_expired()
+            except Exception as e:
+                logger.error("Error polling pending media in Redis: %s", e)
+            await asyncio.sleep(self.poll_interval)
+
+
+class RedisSequencer:
+    """
+    Keeps each sender's webhook events in order across instances.
+
+    Every instance has its own event queue, so a reel can be queued on one instance and its caption on
+    another. assign() numbers a sender's events in Redis as they are queued; a worker waits until ready() says
+    the sender's previous event has been through finish() on whichever instance had it.
+    """
+
+    def __init__(self, client, prefix, ttl=24 * 60 * 60):
+        self.ttl = ttl
+        self._client = client
+        self._prefix = f"{prefix}sequence:"
+
+    def assign(self, events):
+        """Numbers the messaging events, storing each one's number in it under '_sequence'."""
+        with self._client.pipeline(transaction=False) as pipe:
+            for messaging in events:
+                key = self._prefix + str(messaging['sender']['id'])
+                pipe.incr(key)
+                pipe.expire(key, self.ttl)
+            numbers = pipe.execute()[::2]
+        for messaging, number in zip(events, numbers):
+            messaging['_sequence'] = number
+
+    def _done_key(self, messaging, number):
+        return f"{self._prefix}{messaging['sender']['id']}:{number}"
+
+    def ready(self, messaging):
+        """Whether the sender's event before this one has finished (or this one wasn't numbered)."""
+        number = messaging.get('_sequence')
+        if not number or number == 1:
+            return True
+        return bool(self._client.exists(self._done_key(messaging, number - 1)))
+
+    def finish(self, messaging):
+        """Marks the event as processed, letting the sender's next event go."""
+        number = messaging.get('_sequence')
+        if number:
+            self._client.set(self._done_key(messaging, number), 1, ex=self.ttl)
@@ -0,0 +1,166 @@
+import asyncio
+import contextlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
+
+from metrics import MEDIA_SHRINK
+
+logger = logging.getLogger(__name__)
+
+AUDIO_BITRATE = 64_000  # bits/s kept for the audio track of re-encoded video
+SIZE_HEADROOM = 0.9  # aim below the limit to leave room for container overhead
+
+
+def _probe_duration(ffprobe, path, timeout):
+    result = subprocess.run(
+        [ffprobe, "-v", "error", "-show_entries", "format=duration", "-of", "default=nw=1:nk=1", path],
+        capture_output=True, text=True, timeout=timeout, check=True
+    )
+    return float(result.stdout.strip())
+
+
+def _shrink_video(ffmpeg, ffprobe, src, dst, target_size, deadline):
+    duration = _probe_duration(ffprobe, src, max(1.0, deadline - time.monotonic()))
+    video_bitrate = int(target_size * 8 * SIZE_HEADROOM / duration) - AUDIO_BITRATE
+    if video_bitrate < 100_000:
+        return False  # Too long to fit at a watchable bitrate
+    subprocess.run(
+        [ffmpeg, "-y", "-v", "error", "-i", src,
+         "-vf", "scale=-2:'min(720,ih)'",
+         "-c:v", "libx264", "-preset", "veryfast",
+         "-b:v", str(video_bitrate), "-maxrate", str(video_bitrate), "-bufsize", str(video_bitrate * 2),
+         "-c:a", "aac", "-b:a", str(AUDIO_BITRATE),
+         "-movflags", "+faststart", dst],
+        capture_output=True, timeout=max(1.0, deadline - time.monotonic()), check=True
+    )
+    return True
+
+
+def _shrink_image(ffmpeg, src, dst, source_size, target_size, deadline):
+    # Pixel count scales roughly with file size, so shrink each side by the square root of the ratio
+    factor = min(0.9, (target_size * SIZE_HEADROOM / source_size) ** 0.5)
+    while factor > 0.05:
+        subprocess.run(
+            [ffmpeg, "-y", "-v", "error", "-i", src, "-vf", f"scale=trunc(iw*{factor:.3f}/2)*2:-2", "-q:v", "4", dst],
+            capture_output=True, timeout=max(1.0, deadline - time.monotonic()), check=True
+        )
+        if os.path.getsize(dst) < target_size:
+            return True
+        factor *= 0.7
+    return False
+
+
+def output_extension(media_type):
+    """The extension of shrunk media: reels are re-encoded to MP4 and posts to JPEG, whatever their input."""
+    return ".mp4" if media_type == "reel" else ".jpg"
+
+
+def shrink_file(src, media_type, target_size, time_budget):
+    """
+    Re-encodes the media at src so it fits under target_size bytes, giving up once time_budget runs out.
+
+    Returns:
+        tuple: (data, extension) of the shrunk media (see output_extension), or None if it could not be
+               brought under the limit.
+    """
+    deadline = time.monotonic() + time_budget
+    ffmpeg = shutil.which("ffmpeg")
+    ffprobe = shutil.which("ffprobe")
+    source_size = os.path.getsize(src)
+    suffix = output_extension(media_type)
+    fd, dst = tempfile.mkstemp(suffix=suffix, prefix="shrunk_")
+    os.close(fd)
+    try:
+        if media_type == "reel":
+            ok = _shrink_video(ffmpeg, ffprobe, src, dst, target_size, deadline)
+        else:
+            ok = _shrink_image(ffmpeg, src, dst, source_size, target_size, deadline)
+        if not ok or os.path.getsize(dst) >= target_size:
+            return None
+        with open(dst, "rb") as f:
+            return f.read(), suffix
+    finally:
+        os.unlink(dst)
+
+
+class MediaShrinker:
+    """
+    Shrinks oversized media below Discord's upload limit using a bounded pool of ffmpeg processes.
+
+    The CPU-heavy encoding always happens in separate ffmpeg processes; at most `workers` jobs run at once
+    and further jobs wait for a slot. A job holds its slot from before its input is downloaded to a scratch
+    file until ffmpeg is done, so at most workers * max_input_size bytes of scratch files exist at a time.
+    Waiting on a child process yields to other greenlets, so webhook handling keeps going while media is
+    re-encoded. Each job is limited by a time budget; callers fall back to sending a link whenever shrink()
+    returns None. Timings of recent jobs are kept for monitoring.
+    """
+
+    SLOT_POLL_INTERVAL = 0.05  # seconds between async_slot()'s attempts to take a slot
+
+    def __init__(self, workers=2, time_budget=60.0, max_input_size=50 * 1024 * 1024):
+        self.workers = workers
+        self.time_budget = time_budget
+        self.max_input_size = max_input_size
+        self.jobs = deque(maxlen=100)
+        self._slots = threading.BoundedSemaphore(max(workers, 1))
+
+    def available(self):
+        """True when shrinking is enabled and ffmpeg/ffprobe are installed."""
+        return self.workers > 0 and shutil.which("ffmpeg") is not None and shutil.which("ffprobe") is not None
+
+    def accepts(self, file_size):
+        """Whether media of file_size bytes can be shrunk: shrinking is available and it's under max_input_size."""
+        return file_size < self.max_input_size and self.available()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Holds one of the `workers` job slots; download the input and call shrink() inside it."""
+        with self._slots:
+            yield
+
+    @contextlib.asynccontextmanager
+    async def async_slot(self):
+        """slot() for coroutines: polls for a free slot instead of blocking the event loop."""
+        while not self._slots.acquire(blocking=False):
+            await asyncio.sleep(self.SLOT_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def shrink(self, src, media_type, target_size):
+        """
+        Shrinks the file at src below target_size bytes. The caller must hold a slot (see slot()).
+
+        Returns:
+            tuple: (data, extension) as from shrink_file, or None if shrinking failed, timed out or wasn't possible.
+        """
+        source_size = os.path.getsize(src)
+        outcome, result = "failed", None
+        started = time.monotonic()
+        try:
+            result = shrink_file(src, media_type, target_size, self.time_budget)
+            outcome = "shrunk" if result is not None else "too_large"
+        except subprocess.TimeoutExpired:
+            outcome = "timeout"
+        except Exception as e:
+            logger.error("Error shrinking %s: %s", media_type, e)
+        finally:
+            elapsed = time.monotonic() - started
+            MEDIA_SHRINK.observe(elapsed)
+            self.jobs.append({
+                "media_type": media_type,
+                "input_bytes": source_size,
+                "output_bytes": len(result[0]) if result else None,
+                "seconds": elapsed,
+                "outcome": outcome,
+            })
+            logger.info("Shrink %s %d -> %s bytes: %s in %.2fs", media_type, source_size,
+                        len(result[0]) if result else '-', outcome, elapsed)
+        return result
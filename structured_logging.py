@@ -0,0 +1,223 @@
+"""
+Log pipeline shared by the Flask/gevent app (webhook.py) and the asyncio server (aio_server.py).
+
+Request handlers and workers only put log records on a queue. A background OS thread formats them and writes
+them to stderr. Under gevent that has to be a native thread: a greenlet writing to a slow stdout pipe would
+hold up every other request. Records are formatted in that thread, so call sites log with %-style arguments
+(logger.info("Sent %s", x)) instead of f-strings and pay nothing for formatting on the request path.
+
+LOG_FORMAT=json writes one JSON object per line. Besides the message, it carries the fields of the record's
+log context (event_id of the webhook event being processed, see log_context()) and any `extra` fields such as
+stage and duration_ms, so an event can be followed from the webhook to Discord. The field names follow Cloud
+Logging's structured log format.
+
+Repetitive lines are rate limited per call site. INFO and DEBUG records beyond rate_limit per rate_window
+seconds are dropped and counted in crosschat_log_records_suppressed_total. The next line let through from
+that call site says how many were dropped.
+"""
+import atexit
+import contextlib
+import contextvars
+import importlib
+import json
+import logging
+import logging.handlers
+import sys
+import threading
+import time
+
+from metrics import LOG_SUPPRESSED
+
+_context = contextvars.ContextVar("log_context", default={})
+
+# Attributes every LogRecord has; anything else on a record came from `extra` or the log context
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """
+    Adds fields (e.g. event_id) to every record logged inside the block by the current thread, greenlet or
+    asyncio task, and by tasks it starts.
+    """
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def bind_log_context(job):
+    """
+    Wraps a coroutine function so it runs with the caller's log context, for work queued to another task
+    (such as a Discord send) that belongs to the event being processed.
+    """
+    fields = _context.get()
+    if not fields:
+        return job
+
+    async def bound(*args, **kwargs):
+        token = _context.set({**_context.get(), **fields})
+        try:
+            return await job(*args, **kwargs)
+        finally:
+            _context.reset(token)
+
+    return bound
+
+
+def stage_extra(stage, started, **fields):
+    """`extra` fields for a record closing a timed stage: its name and duration since started (perf_counter)."""
+    return {"stage": stage, "duration_ms": round((time.perf_counter() - started) * 1000, 1), **fields}
+
+
+class ContextFilter(logging.Filter):
+    """Copies the log context onto records when they are logged; explicit `extra` fields take precedence."""
+
+    def filter(self, record):
+        for key, value in _context.get().items():
+            record.__dict__.setdefault(key, value)
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most `limit` records from each call site through every `window` seconds.
+
+    Only applies below WARNING; warnings and errors always go through. The first record let through after
+    some were dropped gets their number as its `suppressed` attribute.
+    """
+
+    def __init__(self, limit, window):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._sites = {}  # (pathname, lineno) -> [window_start, records_let_through, records_dropped]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or now - site[0] >= self.window:
+                if site is not None and site[2]:
+                    record.suppressed = site[2]
+                self._sites[key] = [now, 1, 0]
+                return True
+            if site[1] < self.limit:
+                site[1] += 1
+                return True
+            site[2] += 1
+        LOG_SUPPRESSED.labels(record.name).inc()
+        return False
+
+
+class TextFormatter(logging.Formatter):
+    """The usual LEVEL:logger:message lines, noting how many similar lines were rate limited."""
+
+    def format(self, record):
+        line = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        return f"{line} ({suppressed} similar line(s) suppressed)" if suppressed else line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, severity, logger, message, then context and `extra` fields."""
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "severity": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The stdlib QueueHandler formats the message here, on the logging thread; leave it to the writer
+        return record
+
+
+class _LogWriter:
+    """Drains the record queue into a handler on a native thread."""
+
+    def __init__(self, records, handler):
+        self.records = records
+        self.handler = handler
+        self._stopped = _native("_thread", "allocate_lock")()
+
+    def start(self):
+        self._stopped.acquire()
+        _native("_thread", "start_new_thread")(self._run, ())
+
+    def _run(self):
+        try:
+            while True:
+                record = self.records.get()
+                if record is None:
+                    return
+                self.handler.handle(record)
+        finally:
+            self._stopped.release()
+
+    def stop(self, timeout=5.0):
+        """Writes out the records queued so far, waiting up to timeout seconds."""
+        self.records.put(None)
+        if self._stopped.acquire(timeout=timeout):
+            self._stopped.release()
+
+
+def _native(module, name):
+    """module.name, or the original if gevent has monkey-patched it (the writer must block its own thread)."""
+    monkey = sys.modules.get("gevent.monkey")
+    if monkey is not None and monkey.is_module_patched(module):
+        return monkey.get_original(module, name)
+    return getattr(importlib.import_module(module), name)
+
+
+def configure_logging(fmt="text", level=logging.INFO, rate_limit=0, rate_window=10.0, stream=None):
+    """
+    Sends the root logger's records through the background writer. Like logging.basicConfig, does nothing
+    if the root logger already has handlers.
+
+    Args:
+        fmt (str): "text" for LEVEL:logger:message lines, "json" for one JSON object per line.
+        level (int | str): Root logger level.
+        rate_limit (int): Records let through per call site every rate_window seconds below WARNING; 0 for all.
+        rate_window (float): Seconds per rate limit window.
+        stream: Where the writer writes; stderr by default.
+
+    Returns:
+        _LogWriter: The running writer, or None if logging was already configured.
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    # Only the writer thread takes this lock; a gevent lock can't be used from a native thread
+    handler.lock = _native("_thread", "RLock")()
+    handler.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter(logging.BASIC_FORMAT))
+
+    records = _native("queue", "SimpleQueue")()
+    queue_handler = _QueueHandler(records)
+    queue_handler.addFilter(ContextFilter())
+    if rate_limit > 0:
+        queue_handler.addFilter(RateLimitFilter(rate_limit, rate_window))
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+
+    writer = _LogWriter(records, handler)
+    writer.start()
+    atexit.register(writer.stop)
+    return writer
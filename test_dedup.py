@@ -0,0 +1,86 @@
+import pytest
+
+from dedup import DedupStore
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def test_duplicates_recognised(clock):
+    store = DedupStore(maxsize=10, ttl=60, clock=clock)
+    assert store.add_many(["a", "b", "a"]) == [True, True, False]
+    assert store.add_many(["b", "c"]) == [False, True]
+
+
+def test_keys_expire_after_ttl(clock):
+    store = DedupStore(maxsize=10, ttl=60, clock=clock)
+    store.add_many(["a"])
+    clock.now += 59
+    assert store.add_many(["a"]) == [False]
+    clock.now += 2
+    assert store.add_many(["a"]) == [True]
+
+
+def test_expired_keys_evicted(clock):
+    store = DedupStore(maxsize=10, ttl=60, clock=clock)
+    store.add_many(["a", "b"])
+    clock.now += 61
+    store.add_many(["c"])
+    assert len(store) == 1
+
+
+def test_oldest_key_evicted_at_maxsize(clock):
+    store = DedupStore(maxsize=2, ttl=60, clock=clock)
+    store.add_many(["a"])
+    clock.now += 1
+    store.add_many(["b"])
+    clock.now += 1
+    store.add_many(["c"])
+    assert len(store) == 2
+    assert store.add_many(["b", "c", "a"]) == [False, False, True]
+
+
+def test_discarded_keys_are_new_again(clock):
+    store = DedupStore(maxsize=10, ttl=60, clock=clock)
+    store.add_many(["a"])
+    store.discard_many(["a"])
+    assert store.add_many(["a"]) == [True]
+
+
+def test_keys_survive_reopen(tmp_path, clock):
+    path = str(tmp_path / "seen.db")
+    store = DedupStore(maxsize=10, ttl=60, path=path, clock=clock)
+    store.add_many(["a", "b"])
+    store.discard_many(["b"])
+
+    reopened = DedupStore(maxsize=10, ttl=60, path=path, clock=clock)
+    assert len(reopened) == 1
+    assert reopened.add_many(["a", "b"]) == [False, True]
+
+
+def test_expired_keys_not_reloaded(tmp_path, clock):
+    path = str(tmp_path / "seen.db")
+    DedupStore(maxsize=10, ttl=60, path=path, clock=clock).add_many(["a"])
+    clock.now += 61
+    reopened = DedupStore(maxsize=10, ttl=60, path=path, clock=clock)
+    assert len(reopened) == 0
+
+
+def test_reopen_keeps_newest_maxsize_keys(tmp_path, clock):
+    path = str(tmp_path / "seen.db")
+    store = DedupStore(maxsize=10, ttl=60, path=path, clock=clock)
+    for key in "abc":
+        store.add_many([key])
+        clock.now += 1
+    reopened = DedupStore(maxsize=2, ttl=60, path=path, clock=clock)
+    assert reopened.add_many(["a", "b", "c"]) == [True, False, False]
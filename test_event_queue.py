@@ -0,0 +1,127 @@
+import sqlite3
+from concurrent.futures import Future
+
+import pytest
+
+from event_queue import EventQueue, settle
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = EventQueue(str(tmp_path / "events.db"), max_attempts=2, retry_delay=0)
+    yield queue
+    queue.close()
+
+
+def put(queue, *senders):
+    return queue.put_many([(sender_id, {"n": index}) for index, sender_id in enumerate(senders)])
+
+
+def test_sender_events_claimed_one_at_a_time(queue):
+    first, second, other = put(queue, "a", "a", "b")
+    assert queue.claim(timeout=0)[0] == first
+    # a's second event waits for the first; b's is independent
+    assert queue.claim(timeout=0)[0] == other
+    assert queue.claim(timeout=0) is None
+    queue.ack(first)
+    assert queue.claim(timeout=0)[0] == second
+
+
+def test_handed_off_event_unblocks_sender(queue):
+    first, second = put(queue, "a", "a")
+    queue.claim(timeout=0)
+    queue.hand_off(first)
+    assert queue.claim(timeout=0)[0] == second
+    assert (queue.depth(), queue.handed_off()) == (1, 1)
+
+
+def test_handed_off_event_resumed_after_restart(queue, tmp_path):
+    event_id, = put(queue, "a")
+    queue.claim(timeout=0)
+    queue.hand_off(event_id)
+    queue.close()
+
+    restarted = EventQueue(queue.path)
+    assert restarted.claim(timeout=0)[0] == event_id
+    restarted.close()
+
+
+def test_running_owners_events_not_resumed(queue):
+    event_id, = put(queue, "a")
+    queue.claim(timeout=0)
+    queue.hand_off(event_id)
+
+    # Another process opening the same file while this one still runs
+    other = EventQueue(queue.path)
+    assert other.claim(timeout=0) is None
+    assert other.handed_off() == 1
+    other.close()
+
+
+def test_released_event_backs_off(tmp_path):
+    queue = EventQueue(str(tmp_path / "events.db"), retry_delay=60)
+    event_id, = put(queue, "a")
+    queue.claim(timeout=0)
+    queue.release(event_id)
+    assert queue.claim(timeout=0) is None
+    assert 59 < queue.next_retry() <= 60
+    queue.close()
+
+
+def test_backoff_doubles_per_attempt(tmp_path, monkeypatch):
+    queue = EventQueue(str(tmp_path / "events.db"), max_attempts=5, retry_delay=1, max_retry_delay=3)
+    event_id, = put(queue, "a")
+    now = [1000.0]
+    monkeypatch.setattr("event_queue.time.time", lambda: now[0])
+    delays = []
+    for _ in range(3):
+        assert queue.claim(timeout=0)[0] == event_id
+        queue.release(event_id)
+        delays.append(queue.next_retry())
+        now[0] += delays[-1]
+    assert delays == [1, 2, 3]
+    queue.close()
+
+
+def test_opens_queue_without_backoff_columns(tmp_path):
+    path = str(tmp_path / "events.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE events (id INTEGER PRIMARY KEY AUTOINCREMENT, sender_id TEXT, payload TEXT NOT NULL,"
+                 " claimed INTEGER NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL)")
+    conn.execute("INSERT INTO events (sender_id, payload, claimed, created_at) VALUES ('a', '{}', 2, 0)")
+    conn.commit()
+    conn.close()
+
+    queue = EventQueue(path)
+    assert queue.claim(timeout=0)[1] == {}
+    queue.close()
+
+
+def test_settle_without_delivery_acks(queue):
+    event_id, = put(queue, "a")
+    queue.claim(timeout=0)
+    settle(queue, event_id, None)
+    assert (queue.depth(), queue.handed_off()) == (0, 0)
+
+
+def test_settle_acks_on_delivery(queue):
+    event_id, = put(queue, "a")
+    queue.claim(timeout=0)
+    delivery = Future()
+    settle(queue, event_id, delivery)
+    assert queue.handed_off() == 1
+    delivery.set_result(None)
+    assert (queue.depth(), queue.handed_off()) == (0, 0)
+
+
+def test_settle_releases_failed_delivery_until_attempts_run_out(queue):
+    event_id, = put(queue, "a")
+    released = []
+    for attempt in range(2):
+        assert queue.claim(timeout=0)[0] == event_id
+        delivery = Future()
+        settle(queue, event_id, delivery, on_release=lambda: released.append(attempt))
+        delivery.set_exception(RuntimeError("Discord is down"))
+    assert released == [0, 1]
+    # Dropped after max_attempts
+    assert (queue.depth(), queue.handed_off()) == (0, 0)
@@ -0,0 +1,137 @@
+import asyncio
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from forwarding import Forwarder, media_buffer
+from media_cache import MediaCache
+from settings import Config
+
+CONFIG = Config.from_secrets({"DISCORD_CHANNEL_ID": 1, "DISCORD_USER_IDS": {}})
+REEL = [["https://cdn/a.mp4", "reel"]]
+
+
+class FakeChannel:
+    def __init__(self):
+        self.sent = []
+        self.fail = False
+
+    async def send(self, content=None, files=()):
+        if self.fail:
+            raise RuntimeError("Discord is down")
+        self.sent.append(content)
+
+
+class FakeClient:
+    def __init__(self):
+        self.channel = FakeChannel()
+
+    def get_channel(self, channel_id):
+        return self.channel
+
+
+class FakeSender:
+    """Queues jobs like DiscordSender.submit; run() delivers them in order, holding a job until its after is done."""
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, job, route="default", heavy=False, after=None):
+        future = Future()
+        self.jobs.append((job, route, heavy, after, future))
+        return future
+
+    async def call(self, awaitable, timeout):
+        return await awaitable
+
+    def run(self, client):
+        while self.jobs:
+            ready = next(item for item in self.jobs if item[3] is None or item[3].done())
+            self.jobs.remove(ready)
+            job, _, _, _, future = ready
+            try:
+                future.set_result(asyncio.run(job(client)))
+            except Exception as e:
+                future.set_exception(e)
+
+
+async def unavailable(url, media_type, budget):
+    # Sends the media as a temporary link, so no discord.File is involved
+    raise ConnectionError("CDN unavailable")
+
+
+async def unused(*args):
+    raise AssertionError("nothing should be shrunk")
+
+
+@pytest.fixture
+def sender():
+    return FakeSender()
+
+
+def forwarder(sender, coalesce_window=60.0):
+    return Forwarder(sender, MediaCache(max_bytes=1024), unavailable, unused, coalesce_window=coalesce_window)
+
+
+def test_texts_merged_within_window(sender):
+    fwd = forwarder(sender)
+    first = fwd.submit(CONFIG, "alice", "one", sender_id="1")
+    second = fwd.submit(CONFIG, "alice", "two", sender_id="1")
+    assert first is second
+    client = FakeClient()
+    sender.run(client)
+    assert len(client.channel.sent) == 1
+    assert "one" in client.channel.sent[0] and "two" in client.channel.sent[0]
+
+
+def test_texts_not_merged_after_window(sender):
+    fwd = forwarder(sender, coalesce_window=0.01)
+    first = fwd.submit(CONFIG, "alice", "one", sender_id="1")
+    time.sleep(0.05)
+    assert fwd.submit(CONFIG, "alice", "two", sender_id="1") is not first
+    assert len(sender.jobs) == 2
+
+
+def test_merge_stops_at_message_limit(sender):
+    fwd = forwarder(sender)
+    first = fwd.submit(CONFIG, "alice", "a" * 1200, sender_id="1")
+    second = fwd.submit(CONFIG, "alice", "b" * 900, sender_id="1")
+    assert second is not first
+    client = FakeClient()
+    sender.run(client)
+    assert len(client.channel.sent) == 2
+    assert all(len(content) <= 2000 for content in client.channel.sent)
+
+
+def test_text_after_media_follows_it(sender):
+    fwd = forwarder(sender)
+    earlier = fwd.submit(CONFIG, "alice", "before", sender_id="1")
+    media = fwd.submit(CONFIG, "alice", None, REEL, sender_id="1")
+    later = fwd.submit(CONFIG, "alice", "after", sender_id="1")
+    routes = {future: (route, heavy, after) for _, route, heavy, after, future in sender.jobs}
+    # The media waits for the earlier text; the later text queues behind the media in its lane
+    assert routes[media] == (("channel", 1, "media"), True, earlier)
+    assert routes[later][0] == ("channel", 1, "media")
+
+    client = FakeClient()
+    sender.run(client)
+    sent = client.channel.sent
+    assert "before" in sent[0] and "temporary link" in sent[1] and "after" in sent[2]
+
+
+def test_failure_reaches_future_and_media_still_runs_after_it(sender):
+    fwd = forwarder(sender)
+    earlier = fwd.submit(CONFIG, "alice", "before", sender_id="1")
+    media = fwd.submit(CONFIG, "alice", None, REEL, sender_id="1")
+    client = FakeClient()
+    client.channel.fail = True
+    sender.run(client)
+    assert isinstance(earlier.exception(), RuntimeError)
+    # A failed earlier send doesn't hold up the media waiting on it; its own failure is reported separately
+    assert isinstance(media.exception(), RuntimeError)
+
+
+def test_shrunk_media_named_from_output_format():
+    assert media_buffer("https://cdn/p.png", "post", b"data").name == "post.png"
+    assert media_buffer("https://cdn/p.png", "post", b"data", ext=".jpg").name == "post.jpg"
@@ -0,0 +1,84 @@
+import pytest
+
+from load_shedding import LoadShedder
+
+
+class FakeQueue:
+    def __init__(self):
+        self.events = 0
+
+    def depth(self):
+        return self.events
+
+
+class FakeSender:
+    def __init__(self):
+        self.sends = 0
+
+    def queued(self):
+        return self.sends
+
+
+def text(mid="m1"):
+    return {"sender": {"id": "1"}, "message": {"mid": mid, "text": "hi"}}
+
+
+def reel(mid="m2"):
+    return {"sender": {"id": "1"},
+            "message": {"mid": mid, "attachments": [{"type": "ig_reel", "payload": {"url": "https://cdn/a.mp4"}}]}}
+
+
+@pytest.fixture
+def queue():
+    return FakeQueue()
+
+
+@pytest.fixture
+def sender():
+    return FakeSender()
+
+
+@pytest.fixture
+def pending():
+    return []
+
+
+@pytest.fixture
+def shedder(queue, sender, pending):
+    return LoadShedder(queue, sender, pending, max_backlog=100, media_backlog=10, max_pending_media=3,
+                       retry_after=45)
+
+
+def test_accepts_below_thresholds(shedder):
+    assert shedder.check([text(), reel()]) is None
+    assert shedder.check([]) is None
+
+
+def test_backlog_counts_queue_and_discord_lanes(shedder, queue, sender):
+    queue.events, sender.sends = 60, 40
+    assert shedder.backlog() == 100
+    assert shedder.check([text()]) == "backlog"
+
+
+def test_media_refused_first(shedder, queue):
+    queue.events = 10
+    assert shedder.check([reel()]) == "media_backlog"
+    # Text keeps flowing until MAX_BACKLOG
+    assert shedder.check([text()]) is None
+    # One reel refuses the whole POST, since Instagram redelivers all of it
+    assert shedder.check([text(), reel()]) == "media_backlog"
+
+
+def test_pending_media_limit(shedder, pending):
+    pending.extend([{}] * 3)
+    assert shedder.check([reel()]) == "pending_media"
+    assert shedder.check([text()]) is None
+
+
+def test_malformed_events_dont_count_as_media(shedder, queue):
+    queue.events = 10
+    assert shedder.check([{"sender": {}}, text()]) is None
+
+
+def test_retry_after_header(shedder):
+    assert shedder.refusal_headers() == {"Retry-After": "45"}
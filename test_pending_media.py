@@ -0,0 +1,123 @@
+import asyncio
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from pending_media import AsyncPendingMediaStore, PendingMediaStore
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def reel(sender_id, url):
+    return {'sender_id': sender_id, 'media': [[url, "reel"]]}
+
+
+def urls(entries):
+    return [entry['media'][0][0] for entry in entries]
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def expired():
+    return []
+
+
+@pytest.fixture
+def store(clock, expired):
+    return PendingMediaStore(on_expire=expired.append, delay=60, clock=clock)
+
+
+def advance(store, clock, seconds):
+    """Moves the store's clock on and wakes its expiry thread, as if the time had passed."""
+    clock.now += seconds
+    with store._cond:
+        store._cond.notify()
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_take_returns_senders_entries_oldest_first(store):
+    store.add(reel("1", "a"))
+    store.add(reel("2", "b"))
+    store.add(reel("1", "c"))
+    assert len(store) == 3
+    assert urls([store.take("1"), store.take("1")]) == ["a", "c"]
+    assert store.take("1") is None
+    assert len(store) == 1
+
+
+def test_entries_expire_in_deadline_order(store, clock, expired):
+    store.add(reel("1", "a"))
+    clock.now += 1
+    store.add(reel("2", "b"))
+    clock.now += 1
+    store.add(reel("1", "c"))
+    advance(store, clock, 59.5)
+    wait_for(lambda: len(expired) == 2)
+    assert urls(expired) == ["a", "b"]
+    advance(store, clock, 1)
+    wait_for(lambda: len(expired) == 3)
+    assert urls(expired) == ["a", "b", "c"]
+    assert len(store) == 0
+
+
+def test_taken_entry_doesnt_expire(store, clock, expired):
+    store.add(reel("1", "a"))
+    store.add(reel("2", "b"))
+    store.take("1")
+    advance(store, clock, 61)
+    wait_for(lambda: len(expired) == 1)
+    assert urls(expired) == ["b"]
+
+
+def test_add_future_follows_the_send(store):
+    delivered = store.add(reel("1", "a"))
+    delivery = Future()
+    store.sent(store.take("1"), delivery)
+    assert not delivered.done()
+    delivery.set_exception(RuntimeError("Discord is down"))
+    assert isinstance(delivered.exception(), RuntimeError)
+
+
+def test_async_store_take_and_expiry():
+    expired = []
+
+    async def scenario():
+        store = AsyncPendingMediaStore(on_expire=expired.append, delay=0.05)
+        store.add(reel("1", "a"))
+        store.add(reel("2", "b"))
+        store.add(reel("1", "c"))
+        assert urls([store.take("1")]) == ["a"]
+        await asyncio.sleep(0.2)
+        return len(store)
+
+    assert asyncio.run(scenario()) == 0
+    assert urls(expired) == ["b", "c"]
+
+
+def test_async_store_add_future_follows_the_send():
+    async def scenario():
+        store = AsyncPendingMediaStore(on_expire=lambda entry: None, delay=60)
+        delivered = store.add(reel("1", "a"))
+        delivery = Future()
+        store.sent(store.take("1"), delivery)
+        delivery.set_result(None)
+        return delivered
+
+    assert asyncio.run(scenario()).result() is None
@@ -0,0 +1,152 @@
+import io
+from concurrent.futures import Future
+
+import pytest
+
+from caching import TTLCache
+from forwarding import ByteBudget
+from media_cache import MediaCache
+from relay import UNKNOWN_USER, Relay, username_from_response
+from settings import Config
+from shared_state import MemoryState
+
+SECRETS = {"DISCORD_BOT_TOKEN": "bot", "DISCORD_CHANNEL_ID": 1, "INSTAGRAM_BOT_USER_ID": 99,
+           "DISCORD_USER_IDS": {"alice": 5}}
+
+
+class FakeSender:
+    def __init__(self):
+        self.tokens = []
+
+    def set_token(self, token):
+        self.tokens.append(token)
+
+
+class FakeDMChannels:
+    def __init__(self):
+        self.cleared = 0
+
+    def clear(self):
+        self.cleared += 1
+
+
+class FakeForwarder:
+    """Records submitted messages; each gets a Future the test resolves."""
+
+    def __init__(self):
+        self.sent = []
+
+    def submit(self, cfg, username, message_text, media, sender_id=None):
+        future = Future()
+        self.sent.append(((username, message_text, media, sender_id), future))
+        return future
+
+
+async def unused(*args):
+    raise AssertionError("no media should be fetched")
+
+
+@pytest.fixture
+def relay():
+    relay = Relay(Config.from_secrets(SECRETS), FakeSender(), MediaCache(max_bytes=1024), TTLCache(ttl=60),
+                  FakeDMChannels(), unused, unused, MemoryState(), pending_delay=60)
+    relay.forwarder = FakeForwarder()
+    return relay
+
+
+def event(sender_id, **message):
+    return {"sender": {"id": sender_id}, "message": message}
+
+
+def test_username_cached(relay):
+    assert relay.cached_username("1") is None
+    assert relay.store_username("1", "alice") == "alice"
+    assert relay.cached_username("1") == "alice"
+
+
+def test_failed_username_lookup_cached_as_unknown(relay):
+    assert relay.store_username("1", None) == UNKNOWN_USER
+    assert relay.cached_username("1") == UNKNOWN_USER
+
+
+def test_username_from_response():
+    assert username_from_response(200, {"username": "alice"}) == "alice"
+    assert username_from_response(200, {}) == UNKNOWN_USER
+    assert username_from_response(400, None) is None
+
+
+def test_username_request_uses_live_token(relay):
+    relay.apply_secrets({**SECRETS, "INSTAGRAM_ACCESS_TOKEN": "new"})
+    url, params = relay.username_request("1")
+    assert url.endswith("/1") and params["access_token"] == "new"
+
+
+def test_media_cache_round_trip(relay):
+    assert relay.cached_media("https://cdn/a.mp4") is None
+    assert relay.store_media("https://cdn/a.mp4", "reel", None, 2048) == (None, 2048)
+    buffer, size = relay.store_media("https://cdn/a.mp4", "reel", io.BytesIO(b"abc"), 3)
+    assert (buffer.read(), size) == (b"abc", 3)
+    buffer, size = relay.cached_media("https://cdn/a.mp4", "reel")
+    assert (buffer.read(), size, buffer.name) == (b"abc", 3, "reel.mp4")
+
+
+def test_cached_media_charged_to_budget(relay):
+    relay.store_media("https://cdn/a.mp4", "reel", io.BytesIO(b"abc"), 3)
+    assert relay.cached_media("https://cdn/a.mp4", "reel", ByteBudget(2)) == (None, 3)
+
+
+def test_screen_event_skips_bot(relay):
+    assert relay.screen_event(event("99", text="hi")) == "skipped bot message"
+    assert relay.screen_event(event("1", text="hi")) is None
+
+
+REEL = event("1", attachments=[{"type": "ig_reel", "payload": {"url": "https://cdn/a.mp4"}}])
+
+
+def test_dispatch_unsupported_event(relay):
+    status, delivery = relay.dispatch_event(event("1", attachments=[{"type": "audio"}]), "alice")
+    assert (status, delivery) == ("unsupported type, skipped", None)
+    assert relay.forwarder.sent == []
+
+
+def test_text_delivery_is_the_send(relay):
+    status, delivery = relay.dispatch_event(event("1", text="hi"), "alice")
+    assert status == "success"
+    assert delivery is relay.forwarder.sent[0][1]
+
+
+def test_reel_delivered_with_its_caption(relay):
+    status, reel_delivery = relay.dispatch_event(REEL, "alice")
+    assert status == "pending reel/post"
+    assert len(relay.pending_reels) == 1
+    assert not reel_delivery.done()
+
+    status, caption_delivery = relay.dispatch_event(event("1", text="look"), "alice")
+    assert status == "sent to server"
+    (message, send), = relay.forwarder.sent
+    assert message == ("alice", "look", [["https://cdn/a.mp4", "reel"]], "1")
+    assert caption_delivery is send
+    # The reel's event waits for the same send as its caption's
+    send.set_result(None)
+    assert reel_delivery.result() is None
+
+
+def test_expired_reel_failure_reaches_its_event(relay):
+    _, reel_delivery = relay.dispatch_event(REEL, "alice")
+    relay.send_pending_reel(relay.pending_reels.take("1"))
+    (message, send), = relay.forwarder.sent
+    assert message == ("alice", None, [["https://cdn/a.mp4", "reel"]], "1")
+    send.set_exception(RuntimeError("Discord is down"))
+    assert isinstance(reel_delivery.exception(), RuntimeError)
+
+
+def test_apply_secrets(relay):
+    relay.apply_secrets(SECRETS)
+    assert (relay.discord_sender.tokens, relay.dm_channels.cleared) == ([], 0)
+
+    relay.apply_secrets({**SECRETS, "DISCORD_USER_IDS": {"bob": 6}})
+    assert relay.config.discord_user_ids == {"bob": 6}
+    assert (relay.discord_sender.tokens, relay.dm_channels.cleared) == ([], 1)
+
+    relay.apply_secrets({**SECRETS, "DISCORD_USER_IDS": {"bob": 6}, "DISCORD_BOT_TOKEN": "new"})
+    assert (relay.discord_sender.tokens, relay.dm_channels.cleared) == (["new"], 2)
@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+
+from resilience import (
+    CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, RetryPolicy, UpstreamError, async_retry_call,
+    is_retryable_status, retry_call,
+)
+
+NO_DELAY = RetryPolicy(retries=2, base_delay=0, max_delay=0)
+
+
+def test_breaker_opens_after_threshold_and_rejects():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    assert breaker.state == CLOSED and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN and breaker.opened == 1
+    assert not breaker.allow()
+    assert 59 < breaker.retry_after() <= 60
+
+
+def test_breaker_half_open_lets_one_probe_through():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # Only one probe at a time while half-open
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.allow() and breaker.allow()
+
+
+def test_failed_probe_opens_breaker_again():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN and breaker.opened == 2
+
+
+def test_released_probe_frees_the_slot():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+
+
+@pytest.mark.parametrize("status, retryable", [(500, True), (503, True), (429, True), (404, False), (400, False)])
+def test_retryable_status(status, retryable):
+    assert is_retryable_status(status) is retryable
+
+
+def reply(*statuses):
+    """An upstream call that answers with the given statuses in turn, raising UpstreamError like the servers do."""
+    calls = []
+
+    def call():
+        status = statuses[len(calls)]
+        calls.append(status)
+        if is_retryable_status(status):
+            raise UpstreamError(f"HTTP {status}")
+        return status
+
+    return call, calls
+
+
+def test_5xx_and_429_retried_then_succeed():
+    breaker = CircuitBreaker("test", failure_threshold=1)
+    call, calls = reply(503, 429, 200)
+    assert retry_call(breaker, NO_DELAY, call) == 200
+    assert calls == [503, 429, 200]
+    assert breaker.state == CLOSED
+
+
+def test_4xx_not_retried_and_not_a_failure():
+    breaker = CircuitBreaker("test", failure_threshold=1)
+    call, calls = reply(404)
+    assert retry_call(breaker, NO_DELAY, call) == 404
+    assert calls == [404]
+    assert breaker.failures == 0
+
+
+def test_exhausted_retries_count_one_failure():
+    breaker = CircuitBreaker("test", failure_threshold=1)
+    call, calls = reply(500, 500, 500)
+    with pytest.raises(UpstreamError):
+        retry_call(breaker, NO_DELAY, call)
+    assert len(calls) == 3
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        retry_call(breaker, NO_DELAY, call)
+
+
+def test_other_errors_not_retried_and_free_the_probe():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    calls = []
+
+    def call():
+        calls.append(1)
+        raise ValueError("bad JSON")
+
+    with pytest.raises(ValueError):
+        retry_call(breaker, NO_DELAY, call)
+    assert calls == [1]
+    assert breaker.state == HALF_OPEN and breaker.allow()
+
+
+def test_async_retry_call_retries_5xx():
+    breaker = CircuitBreaker("test")
+    call, calls = reply(502, 200)
+
+    async def fn():
+        return call()
+
+    assert asyncio.run(async_retry_call(breaker, NO_DELAY, fn)) == 200
+    assert calls == [502, 200]
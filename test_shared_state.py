@@ -0,0 +1,110 @@
+from concurrent.futures import Future
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from shared_state import RedisDedupStore, RedisPendingMediaStore, RedisSequencer  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis()
+
+
+def pending_store(client, expired, **kwargs):
+    store = RedisPendingMediaStore(client, "test:", on_expire=expired.append, delay=60, **kwargs)
+    # Tests drive _flush_expired() themselves
+    store._poller = "disabled"
+    return store
+
+
+def reel(sender_id, url):
+    return {'sender_id': sender_id, 'media': [[url, "reel"]], 'username': "alice", 'message_text': None}
+
+
+def test_take_returns_senders_entries_oldest_first(client):
+    store = pending_store(client, [])
+    store.add(reel("1", "a"))
+    store.add(reel("2", "b"))
+    store.add(reel("1", "c"))
+    assert len(store) == 3
+    assert store.take("1")['media'] == [["a", "reel"]]
+    assert store.take("1")['media'] == [["c", "reel"]]
+    assert store.take("1") is None
+    assert len(store) == 1
+
+
+def test_claim_expired_skips_taken_entries(client):
+    expired = []
+    store = pending_store(client, expired)
+    store.add(reel("1", "a"))
+    store.add(reel("1", "b"))
+    store.take("1")
+    client.zadd(store._keys[0], {entry_id: 0 for entry_id in client.zrange(store._keys[0], 0, -1)})
+    store._flush_expired()
+    assert [entry['media'] for entry in expired] == [[["b", "reel"]]]
+    assert store.take("1") is None
+    assert len(store) == 0
+
+
+def test_delivered_send_settles_add_future_and_leaves_redis(client):
+    store = pending_store(client, [])
+    delivered = store.add(reel("1", "a"))
+    delivery = Future()
+    store.sent(store.take("1"), delivery)
+    assert not delivered.done()
+    delivery.set_result(None)
+    assert delivered.result() is None
+    assert client.hlen(store._keys[1]) == 0 and client.zcard(store._keys[3]) == 0
+
+
+def test_failed_send_reported_to_adding_instance(client):
+    adding, sending = pending_store(client, []), pending_store(client, [])
+    delivered = adding.add(reel("1", "a"))
+    delivery = Future()
+    sending.sent(sending.take("1"), delivery)
+    delivery.set_exception(RuntimeError("Discord is down"))
+    assert not delivered.done()
+    adding._flush_expired()
+    assert isinstance(delivered.exception(), RuntimeError)
+
+
+def test_entry_reclaimed_when_sender_lease_runs_out(client):
+    expired = []
+    store = pending_store(client, expired, lease=0)
+    store.add(reel("1", "a"))
+    store.take("1")
+    store._flush_expired()
+    assert [entry['media'] for entry in expired] == [[["a", "reel"]]]
+
+
+def test_dedup_add_many(client):
+    store = RedisDedupStore(client, "test:", maxsize=10, ttl=60)
+    assert store.add_many(["a", "b"]) == [True, True]
+    assert store.add_many(["a", "c"]) == [False, True]
+    store.discard_many(["a"])
+    assert store.add_many(["a"]) == [True]
+
+
+def test_dedup_keys_expire_after_ttl(client):
+    store = RedisDedupStore(client, "test:", maxsize=10, ttl=-1)
+    assert store.add_many(["a"]) == [True]
+    assert store.add_many(["a"]) == [True]
+
+
+def test_dedup_bounded_to_maxsize(client):
+    store = RedisDedupStore(client, "test:", maxsize=2, ttl=60)
+    store.add_many(["a", "b", "c"])
+    assert len(store) == 2
+    # The oldest key was evicted
+    assert store.add_many(["a"]) == [True]
+
+
+def test_sequencer_orders_senders_events(client):
+    sequencer = RedisSequencer(client, "test:")
+    first, second, other = ({'sender': {'id': sender_id}} for sender_id in ("1", "1", "2"))
+    sequencer.assign([first, second, other])
+    assert [sequencer.ready(event) for event in (first, second, other)] == [True, False, True]
+    sequencer.finish(first)
+    assert sequencer.ready(second)
@@ -0,0 +1,69 @@
+import pytest
+
+from zero_width import (
+    ZERO_WIDTH_MARKER, decode_invisible, decode_many, encode_invisible, encode_sender_tag, find_sender_ids,
+)
+
+
+def tagged(username, sender_id, message="hello"):
+    """A forwarded message as format_message_parts builds it: the tag sits right after the username."""
+    return f"> **From**: {username}{encode_sender_tag(sender_id)}\n> **Message**: {message}"
+
+
+@pytest.mark.parametrize("sender_id", ["0", "1", "9081726354", "17841400000000000", "1234567890123456789"])
+def test_round_trip(sender_id):
+    assert decode_invisible("name" + encode_sender_tag(sender_id) + " trailing text") == sender_id
+
+
+def test_encoding_is_invisible():
+    encoded = encode_invisible("0123456789")
+    assert len(encoded) == 10
+    assert not any(char.isprintable() and not char.isspace() and char.isascii() for char in encoded)
+
+
+@pytest.mark.parametrize("sender_id", ["0", "007", "000123", "0000000000"])
+def test_leading_zeros_after_marker(sender_id):
+    # '0' encodes as the marker's own character, so the ID's zeros run straight on from the marker
+    assert encode_sender_tag(sender_id).startswith(ZERO_WIDTH_MARKER + "\u200b")
+    assert decode_invisible(tagged("user", sender_id)) == sender_id
+    assert find_sender_ids(tagged("user", sender_id)) == [sender_id]
+
+
+def test_integer_sender_id():
+    assert decode_invisible(encode_sender_tag(17841400000000000)) == "17841400000000000"
+
+
+@pytest.mark.parametrize("text, digits", [("12-34 56", "123456"), ("abc", ""), ("", ""), ("\u0661\u0662\u0663", "")])
+def test_non_digits_are_dropped(text, digits):
+    assert encode_invisible(text) == encode_invisible(digits)
+    assert decode_invisible(encode_sender_tag(text)) == digits
+
+
+@pytest.mark.parametrize("text", [None, "", "plain message", "\u200b\u200c only two marker chars"])
+def test_decode_without_marker(text):
+    assert decode_invisible(text) == ""
+
+
+def test_decode_stops_at_first_visible_character():
+    assert decode_invisible(encode_sender_tag("42") + "7" + encode_invisible("99")) == "42"
+
+
+def test_decode_uses_first_tag():
+    text = tagged("first", "111") + "\n" + tagged("second", "222")
+    assert decode_invisible(text) == "111"
+
+
+def test_decode_many():
+    history = [tagged("a", "1001"), "just chatting", None, "", tagged("b", "0042"), tagged("c", "17841400000000000")]
+    assert decode_many(history) == ["1001", "", "", "", "0042", "17841400000000000"]
+    assert decode_many(history) == [decode_invisible(text) for text in history]
+
+
+def test_find_sender_ids_over_joined_history():
+    ids = ["1001", "0042", "17841400000000000", "1001"]
+    history = []
+    for index, sender_id in enumerate(ids):
+        history.append(tagged(f"user{index}", sender_id, f"message {index}"))
+        history.append(f"untagged reply {index}")
+    assert find_sender_ids("\n".join(history)) == ids
+    assert find_sender_ids("no tags at all") == []
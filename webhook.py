@@ -1,71 +1,41 @@
+# Patch the standard library before anything else imports socket/ssl/threading
+from gevent import monkey
+monkey.patch_all()
+
+import asyncio
 import os
-import discord
-import threading
+import tempfile
 import time
-import re
 from flask import Flask, request, jsonify
-import grequests
 import logging
 import requests
-from pathlib import Path
-from gevent import monkey
-from collections import deque
-import json
-monkey.patch_all()
+from requests.adapters import HTTPAdapter
+from caching import SingleFlight
+from components import ServerIO, build_components
+from dedup import queue_new_events
+from event_queue import EventWorkerPool
+from forwarding import MediaDownload, media_buffer, media_filename, messaging_events
+from metrics import CONTENT_TYPE, EVENT_PROCESSING, MEDIA_DOWNLOAD, REGISTRY, USERNAME_LOOKUP, authorized
+from relay import username_from_response
+from resilience import CircuitOpenError, UpstreamError, is_retryable_status, retry_call
+from settings import (
+    GRAPH_API_TIMEOUT, LOG_FORMAT, LOG_LEVEL, LOG_RATE_LIMIT, LOG_RATE_WINDOW, MAX_DISCORD_FILE_SIZE,
+    MEDIA_DOWNLOAD_TIMEOUT, METRICS_TOKEN, load_config,
+)
+from structured_logging import configure_logging
 
 app = Flask(__name__)
-logging.basicConfig(level=logging.INFO)
+# Log lines are written by a background thread, so a slow stdout never blocks a greenlet serving a request
+configure_logging(LOG_FORMAT, LOG_LEVEL, rate_limit=LOG_RATE_LIMIT, rate_window=LOG_RATE_WINDOW)
 logger = logging.getLogger(__name__)
 
+# Only the startup configuration; the live one is relay.config, which is replaced when the secrets file changes
+initial_config = load_config(logger)
 
-def get_secrets_from_file(file_path="/etc/secrets/mysecrets.json"):
-    """
-    Reads secrets from a JSON file mounted by Cloud Run Secret Manager.
-
-    Args:
-        file_path (str): The path to the mounted secrets file.
-                         Defaults to "/etc/secrets/mysecrets.json".
-
-    Returns:
-        dict: A dictionary containing the loaded secrets, or None if an error occurs.
-    """
-    try:
-        with open(file_path, 'r') as f:
-            secrets = json.load(f)
-            return secrets
-    except FileNotFoundError:
-        print(f"Error: Secret file not found at {file_path}")
-        return None
-    except json.JSONDecodeError:
-        print(f"Error: Could not decode JSON from {file_path}")
-        return None
-
-
-secrets = get_secrets_from_file()
-
-if secrets:
-    DISCORD_BOT_TOKEN = secrets.get("DISCORD_BOT_TOKEN")
-    DISCORD_CHANNEL_ID = secrets.get("DISCORD_CHANNEL_ID")
-    INSTAGRAM_BOT_USER_ID = secrets.get("INSTAGRAM_BOT_USER_ID")
-    INSTAGRAM_ACCESS_TOKEN = secrets.get("INSTAGRAM_ACCESS_TOKEN")
-    VERIFY_TOKEN = secrets.get("VERIFY_TOKEN")
-    DISCORD_USER_IDS = secrets.get("DISCORD_USER_IDS")
-
-    logger.info("Successfully loaded secrets from file.")
-else:
-    logger.error("Failed to load secrets from file. Application may not function correctly.")
-
-# Constants
-MAX_DISCORD_FILE_SIZE = 10 * 1024 * 1024  # 10MB in bytes
-
-# Thread-safe queue for pending reels/posts
-pending_reels = deque()
-pending_reels_lock = threading.Lock()
-timer_running = False
-
-# Discord client management
-is_discord_client_running = False
-discord_client_lock = threading.Lock()
+# Pooled HTTP session for Graph API calls and media downloads
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+http_session.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
 
 
 # Function to verify webhook (for Instagram)
@@ -75,491 +45,242 @@ def verify_webhook():
     challenge = request.args.get('hub.challenge')
     verify_token = request.args.get('hub.verify_token')
 
-    if verify_token == VERIFY_TOKEN:
+    cfg = relay.config
+    if cfg.verify_token and verify_token == cfg.verify_token:
         return challenge
     else:
         return 'Verification failed', 403
 
 
-def get_instagram_username(sender_id):
-    """Safely retrieve Instagram username from sender ID."""
-    try:
-        url = f"https://graph.instagram.com/{sender_id}?fields=username&access_token={INSTAGRAM_ACCESS_TOKEN}"
-        req = grequests.get(url)
-        response = grequests.map([req])[0]
-        if response and response.status_code == 200:
-            return response.json().get('username', 'Unknown User')
-        return 'Unknown User'
-    except Exception as e:
-        logger.error(f"Error getting username: {e}")
-        return 'Unknown User'
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Serves stage latencies, delivery counters and queue depths in the Prometheus text format."""
+    if not METRICS_TOKEN:
+        return 'Not found', 404
+    if not authorized(request.headers.get('Authorization'), METRICS_TOKEN):
+        return 'Unauthorized', 401, {'WWW-Authenticate': 'Bearer'}
+    return REGISTRY.render(), 200, {'Content-Type': CONTENT_TYPE}
 
 
-def download_reel(url, media_type="reel"):
+def get_instagram_username(sender_id):
     """
-    Downloads a reel or post and returns the path if size is under 10MB, otherwise returns None.
-    Returns: (file_path, file_size) or (None, None) if download failed or file too large
+    Safely retrieve Instagram username from sender ID.
+
+    Results are cached per sender (see Relay.store_username), and concurrent lookups for the same sender share
+    one Graph API request.
     """
-    try:
-        # Create a temporary directory for downloads
-        temp_dir = Path("/tmp/reels")
-        temp_dir.mkdir(exist_ok=True)
-
-        # Determine extension and filename based on media_type
-        ext = ".mp4"
-        if media_type == "post":
-            ext = None
-            for possible in [".jpg", ".jpeg", ".png"]:
-                if url.lower().endswith(possible):
-                    ext = possible
-                    break
-            if not ext:
-                ext = ".jpg"
-        temp_file = temp_dir / f"reel_{threading.get_ident()}{ext}"
-
-        # Check if the URL is reachable before downloading (avoid 404/private content)
-        head_response = requests.head(url, allow_redirects=True)
-        if head_response.status_code == 404:
-            logger.info(f"{media_type.capitalize()} URL returned 404 (likely private/deleted): {url}")
-            return None, None
-        elif head_response.status_code != 200:
-            logger.error(f"{media_type.capitalize()} URL returned status {head_response.status_code}: {url}")
-            return None, None
-
-        # Stream the download to check size
-        response = requests.get(url, stream=True)
-        if response.status_code != 200:
-            logger.error(f"Failed to download {media_type}. Status code: {response.status_code}")
-            return None, None
-
-        # Get content length if available
-        content_length = response.headers.get('content-length')
-        if content_length and int(content_length) >= MAX_DISCORD_FILE_SIZE:
-            logger.info(f"{media_type.capitalize()} too large: {int(content_length)} bytes")
-            return None, int(content_length)
-
-        # Download the file while checking size
-        total_size = 0
-        with open(temp_file, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                total_size += len(chunk)
-                if total_size >= MAX_DISCORD_FILE_SIZE:
-                    f.close()
-                    temp_file.unlink()  # Delete the partial file
-                    logger.info(f"{media_type.capitalize()} too large: {total_size} bytes")
-                    return None, total_size
-                f.write(chunk)
-
-        return str(temp_file), total_size
-    except Exception as e:
-        logger.error(f"Error downloading {media_type}: {str(e)}")
-        if 'temp_file' in locals() and temp_file.exists():
-            temp_file.unlink()
-        return None, None
+    username = relay.cached_username(sender_id)
+    if username is not None:
+        return username
+    return username_lookups.do(sender_id, lambda: _lookup_instagram_username(sender_id))
 
 
-# === Zero-width encoding utilities ===
-def encode_invisible(text):
-    mapping = {
-        '0': '\u200b',  # zero-width space
-        '1': '\u200c',  # zero-width non-joiner
-        '2': '\u200d',  # zero-width joiner
-        '3': '\u2060',  # word joiner
-        '4': '\u2061',  # function application
-        '5': '\u2062',  # invisible times
-        '6': '\u2063',  # invisible separator
-        '7': '\u2064',  # invisible plus
-        '8': '\u206a',  # inhibit symmetric swapping
-        '9': '\u206b',  # activate symmetric swapping
-    }
-    return ''.join(mapping[d] for d in str(text) if d in mapping)
+def _lookup_instagram_username(sender_id):
+    with USERNAME_LOOKUP.time():
+        username = _fetch_instagram_username(sender_id)
+    return relay.store_username(sender_id, username)
 
 
-# A marker to find the encoded sender_id easily
-ZERO_WIDTH_MARKER = '\u200b\u200b\u200b'  # 3x zero-width space
+def _fetch_instagram_username(sender_id):
+    """Fetches the username from the Graph API, returning None if the lookup fails or the API is unavailable."""
+    url, params = relay.username_request(sender_id)
 
+    def get():
+        response = http_session.get(url, params=params, timeout=GRAPH_API_TIMEOUT)
+        if is_retryable_status(response.status_code):
+            raise UpstreamError(f"HTTP {response.status_code}")
+        return response
 
-def parse_mentions(message_text):
+    try:
+        response = retry_call(graph_breaker, http_retries, get)
+        return username_from_response(response.status_code, response.json() if response.status_code == 200 else None)
+    except CircuitOpenError:
+        return None
+    except Exception as e:
+        # Only the type: request errors quote the URL, and with it the access token
+        logger.error("Error getting username: %s", type(e).__name__)
+        return None
+
+
+def fetch_media(url, media_type="reel", budget=None):
     """
-    Parse message text for @mentions and replace them with Discord mention format <@USER_ID>
-    Args:
-        message_text (str): The message text to parse
-    Returns:
-        str: The message text with @mentions replaced with Discord mention format
+    Returns media for url from the media cache, downloading (and caching) it on a miss.
+    Returns: the same (buffer, file_size) tuple as download_reel
+    Raises: on a miss, the same errors as download_reel
     """
-    if not message_text:
-        return message_text
+    cached = relay.cached_media(url, media_type, budget)
+    if cached is not None:
+        return cached
+    with MEDIA_DOWNLOAD.time():
+        buffer, file_size = download_reel(url, media_type, budget)
+    return relay.store_media(url, media_type, buffer, file_size)
 
-    # Regular expression to find @username mentions
-    mention_pattern = r'@(\w+)'
 
-    def replace_mention(match):
-        username = match.group(1)
-        # Create a case-insensitive lookup for usernames
-        for discord_username, user_id in DISCORD_USER_IDS.items():
-            if username.lower() == discord_username.lower():
-                # Replace with Discord mention format <@USER_ID>
-                return f"<@{user_id}>"
-        # If not found, return the original @username
-        return match.group(0)
+def open_media(url):
+    """
+    Starts a streaming GET for media through the CDN's breaker, retrying connection errors, timeouts and 5xx
+    replies before any of the body is read.
+    Returns: the requests.Response, to be used as a context manager
+    """
+    def get():
+        response = http_session.get(url, stream=True, timeout=MEDIA_DOWNLOAD_TIMEOUT)
+        if is_retryable_status(response.status_code):
+            response.close()
+            raise UpstreamError(f"HTTP {response.status_code}")
+        return response
 
-    # Replace all @mentions in the message
-    return re.sub(mention_pattern, replace_mention, message_text)
+    return retry_call(cdn_breaker, http_retries, get)
 
 
-@app.route('/webhook', methods=['POST'])
-def handle_webhook():
-    """Handles incoming webhook events from Instagram and sends human-readable messages to Discord."""
-    global timer_running
+def download_reel(url, media_type="reel", budget=None):
+    """
+    Downloads a reel or post into memory if its size is under 10MB (see forwarding.MediaDownload).
+
+    Uses a single pooled GET that is abandoned as soon as the size limit is crossed, and keeps the data in an
+    in-memory buffer that can be handed straight to discord.File, so nothing is written to /tmp.
+    Returns: (buffer, file_size), (None, file_size) if the file is too large or budget (a ByteBudget) runs out,
+             or (None, None) if download failed
+    Raises: CircuitOpenError while the CDN's breaker is open, or the last connection error, timeout or
+            UpstreamError once its retries are used up, so the caller can fall back to a link
+    """
+    download = MediaDownload(url, media_type, budget=budget)
     try:
-        data = request.get_json()
-
-        # Extract relevant data
-        messaging = data['entry'][0]['messaging'][0]
-        sender_id = messaging['sender']['id']
-
-        # Get username
-        username = get_instagram_username(sender_id)
-
-        # Initialize message variables
-        message_text = None
-        reel_url = None
-        media_type = None
-
-        # Skip if the message is from our bot
-        if sender_id == str(INSTAGRAM_BOT_USER_ID):
-            return jsonify({'status': 'skipped bot message'}), 200
-
-        # Extract message content and reel URL if present
-        is_supported = False
-        if 'message' in messaging:
-            message = messaging['message']
-            message_text = message.get('text', '')
-
-            if 'attachments' in message:
-                for attachment in message['attachments']:
-                    if attachment['type'] == 'ig_reel':
-                        reel_url = attachment['payload']['url']
-                        media_type = "reel"
-                        is_supported = True
-                    elif attachment['type'] == 'share':
-                        reel_url = attachment['payload']['url']
-                        media_type = "post"
-                        is_supported = True
-
-        # If we have a message_text but no attachments (text only), allow
-        if message_text and not media_type:
-            is_supported = True
-
-        # If it's not a supported type, do not send anything
-        if not is_supported:
-            logger.info(f"Unsupported message type from {username}, skipping send.")
-            return jsonify({'status': 'unsupported type, skipped'}), 200
-
-        # Handle reel/post logic
-        if reel_url:
-            # Find the most recent pending reel for this sender (if any)
-            current_pending_reel = None
-            with pending_reels_lock:
-                for reel in pending_reels:
-                    if reel['sender_id'] == sender_id:
-                        current_pending_reel = reel
-                        break
-
-            if current_pending_reel:
-                # If there's already a pending reel from this sender and we got a message text,
-                # update that reel with the message text
-                if message_text:
-                    with pending_reels_lock:
-                        pending_reels.remove(current_pending_reel)
-                        send_message_to_discord(
-                            username=current_pending_reel['username'],
-                            message_text=message_text,
-                            reel_url=current_pending_reel['url'],
-                            media_type=current_pending_reel['media_type'],
-                            sender_id=current_pending_reel['sender_id']
-                        )
-                    return jsonify({'status': 'sent with text'}), 200
-
-            # Add the new reel to the queue
-            new_reel = {
-                'url': reel_url,
-                'username': username,
-                'media_type': media_type,
-                'sender_id': sender_id,
-                'message_text': None,
-                'timestamp': threading.Event()
-            }
-
-            with pending_reels_lock:
-                pending_reels.append(new_reel)
-
-                # Start the timer if not already running
-                if not timer_running:
-                    timer_running = True
-                    threading.Timer(2.0, process_pending_reels).start()
-
-            return jsonify({'status': 'pending reel/post'}), 200
-
-        # Check if this is a message text for a pending reel
-        if message_text:
-            # Find the most recent pending reel for this sender (if any)
-            current_pending_reel = None
-            with pending_reels_lock:
-                for reel in pending_reels:
-                    if reel['sender_id'] == sender_id:
-                        current_pending_reel = reel
-                        break
-
-            if current_pending_reel:
-                # If there's a pending reel from this sender, update it with the message text
-                # and remove it from the queue
-                with pending_reels_lock:
-                    pending_reels.remove(current_pending_reel)
-
-                # Check if it's a user mention
-                if message_text in DISCORD_USER_IDS:
-                    send_message_to_discord(
-                        username=current_pending_reel['username'],
-                        message_text=message_text,
-                        reel_url=current_pending_reel['url'],
-                        media_type=current_pending_reel['media_type'],
-                        sender_id=current_pending_reel['sender_id']
-                    )
-                    return jsonify({'status': 'sent to user'}), 200
-                else:
-                    # Regular message text with the reel
-                    send_message_to_discord(
-                        username=current_pending_reel['username'],
-                        message_text=message_text,
-                        reel_url=current_pending_reel['url'],
-                        media_type=current_pending_reel['media_type'],
-                        sender_id=current_pending_reel['sender_id']
-                    )
-                    return jsonify({'status': 'sent to server'}), 200
-            else:
-                # Just a regular text message without a reel
-                send_message_to_discord(username, message_text, None, media_type="post", sender_id=sender_id)
-                return jsonify({'status': 'success'}), 200
-
-        # Handle regular messages
-        send_message_to_discord(username, message_text, None, media_type="post", sender_id=sender_id)
-        return jsonify({'status': 'success'}), 200
-
+        with open_media(url) as response:
+            if not download.start(response.status_code, response.headers.get('content-length')):
+                return None, download.size or None
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                if not download.write(chunk):
+                    return None, download.size
+        return download.result()
+    except CircuitOpenError:
+        raise
+    except http_retries.retry_on as e:
+        logger.error("Error downloading %s, CDN unavailable: %s: %s", media_type, type(e).__name__, e)
+        raise
     except Exception as e:
-        logger.error(f"Error in webhook: {e}")
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        logger.error("Error downloading %s: %s", media_type, e)
+        return None, None
+
 
+def shrink_oversize_media(url, media_type, file_size):
+    """
+    Downloads media that is over Discord's limit to a scratch file and shrinks it in the process pool.
+    Returns: an in-memory buffer ready for discord.File, or None to fall back to sending a link
+    """
+    if not media_shrinker.accepts(file_size):
+        return None
 
-def process_pending_reels():
-    """Processes all pending reels/posts in the queue."""
-    global timer_running
+    suffix = os.path.splitext(media_filename(url, media_type))[1]
+    try:
+        # The slot is taken before downloading, so only jobs about to run have a scratch file.
+        # ffmpeg needs a seekable input file, so this path (unlike download_reel) goes through /tmp
+        with media_shrinker.slot(), tempfile.NamedTemporaryFile(suffix=suffix, prefix="oversize_") as scratch:
+            download = MediaDownload(url, media_type, max_size=media_shrinker.max_input_size, out=scratch)
+            with open_media(url) as response:
+                if not download.start(response.status_code, response.headers.get('content-length')):
+                    return None
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    if not download.write(chunk):
+                        return None
+            scratch.flush()
+            shrunk = media_shrinker.shrink(scratch.name, media_type, MAX_DISCORD_FILE_SIZE)
+    except Exception as e:
+        logger.error("Error preparing %s for shrinking: %s", media_type, e)
+        return None
+
+    if shrunk is None:
+        return None
+    # Named from the shrinker's output format, not the URL: an oversized PNG comes back as a JPEG
+    data, ext = shrunk
+    return media_buffer(url, media_type, data, ext=ext)
 
-    with pending_reels_lock:
-        # Reset the timer running flag
-        timer_running = False
 
-        # Process all pending reels
-        while pending_reels:
-            reel = pending_reels.popleft()
+@app.route('/webhook', methods=['POST'])
+def handle_webhook():
+    """
+    Accepts incoming webhook events from Instagram and queues them for delivery to Discord.
+
+    Instagram batches several entries and messaging events into one POST under load. Every event is validated
+    and written to the durable event queue before we respond, so Instagram gets its 200 without waiting on the
+    username lookup, media download or Discord. The worker pool then processes each sender's events in order,
+    with different senders handled concurrently. Events Instagram already delivered (it retries slow responses)
+    are recognised by message id and not queued again. The response carries one status per event, in payload
+    order; a malformed event is reported as 'invalid' without costing the other events of its POST. While the
+    service is overloaded the POST is refused with a 503 and Retry-After (see load_shedding.py).
+    """
+    try:
+        try:
+            events = messaging_events(request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
 
-            # Send the reel to Discord
-            send_message_to_discord(
-                username=reel['username'],
-                message_text=reel.get('message_text'),
-                reel_url=reel['url'],
-                media_type=reel.get('media_type', 'reel'),
-                sender_id=reel['sender_id']
-            )
+        reason = load_shedder.check(events)
+        if reason:
+            return (jsonify({'status': 'overloaded', 'message': reason}), 503,
+                    load_shedder.refusal_headers())
 
-            logger.info(f"Processed reel/post from {reel['username']}")
+        results = queue_new_events(event_queue, dedup_store, events, sequencer)
+        return jsonify({'status': 'queued', 'events': results}), 200
 
-        logger.info("All pending reels/posts processed")
+    except Exception as e:
+        logger.error("Error in webhook: %s", e)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
-def send_message_to_discord(username, message_text, reel_url, media_type="reel", sender_id=None):
-    """Sends a message to Discord with the Instagram username and message content."""
-    global is_discord_client_running
+def handle_queued_event(messaging):
+    """
+    Worker pool entry point: processes one queued messaging event.
 
-    intents = discord.Intents.default()
-    intents.message_content = True
-    client = discord.Client(intents=intents)
+    Returns:
+        concurrent.futures.Future: The event's delivery, which the pool waits on before acking the event,
+                                   or None if there is nothing to deliver.
+    """
+    started = time.perf_counter()
+    with EVENT_PROCESSING.time():
+        status, delivery = process_messaging_event(messaging)
+    relay.record_event(messaging, status, started)
+    return delivery
 
-    @client.event
-    async def on_ready():
-        try:
-            # --- CASE 1: DM to a user by specifying their name ---
-            first_word = message_text.split()[0] if message_text else ''
-            if first_word in DISCORD_USER_IDS:
-                user = await client.fetch_user(DISCORD_USER_IDS[first_word])
-                if user:
-                    # If message is just the name, don't send any message text
-                    actual_message = None if message_text.strip() == first_word else ' '.join(message_text.split()[1:])
-                    await send_reel_with_context(
-                        user, username, actual_message, reel_url,
-                        context_type="dm",
-                        media_type=media_type,
-                        sender_id=sender_id
-                    )
-                    logger.info(f"Sent DM to {first_word}")
-                return
-
-            # --- CASE 2: Server, reel only (no message) ---
-            if reel_url and not message_text:
-                channel = client.get_channel(DISCORD_CHANNEL_ID)
-                if channel:
-                    await send_reel_with_context(
-                        channel, username, None, reel_url,
-                        context_type="server_no_message",
-                        media_type=media_type,
-                        sender_id=sender_id
-                    )
-                    logger.info("Sent reel only to server")
-                return
-
-            # --- CASE 3: Server, reel with message ---
-            if reel_url and message_text:
-                channel = client.get_channel(DISCORD_CHANNEL_ID)
-                if channel:
-                    await send_reel_with_context(
-                        channel, username, message_text, reel_url,
-                        context_type="server_with_message",
-                        media_type=media_type,
-                        sender_id=sender_id
-                    )
-                    logger.info("Sent reel + message to server")
-                return
-
-            # --- REGULAR MESSAGE (no reel, just text) ---
-            channel = client.get_channel(DISCORD_CHANNEL_ID)
-            if channel:
-                await send_reel_with_context(
-                    channel, username, message_text, None,
-                    context_type="server_text_only",
-                    media_type=media_type,
-                    sender_id=sender_id
-                )
-                logger.info("Sent regular message to server")
-        except Exception as e:
-            logger.error(f"Error sending Discord message: {e}")
-        finally:
-            logger.info("Closing Discord client")
-            await client.close()
-
-    def run_discord_client():
-        global is_discord_client_running
-
-        # Wait until no other Discord client is running
-        while True:
-            with discord_client_lock:
-                if not is_discord_client_running:
-                    is_discord_client_running = True
-                    break
-            # Wait a short time before checking again
-            time.sleep(0.1)
 
-        try:
-            client.run(DISCORD_BOT_TOKEN)
-        except Exception as e:
-            logger.error(f"Error running Discord client: {e}")
-        finally:
-            # Mark that this client is no longer running
-            with discord_client_lock:
-                is_discord_client_running = False
+def process_messaging_event(messaging):
+    """
+    Processes a single Instagram messaging event.
 
-    try:
-        threading.Thread(target=run_discord_client).start()
-    except Exception as e:
-        logger.error(f"Error starting Discord client thread: {e}")
-        # Make sure to release the lock if we fail to start the thread
-        with discord_client_lock:
-            is_discord_client_running = False
-
-
-async def send_reel_with_context(target, username, message_text, reel_url, context_type="server_with_message", media_type="reel", sender_id=None):
-    """Send message (and optional reel/post) in a single message, with context_type for clarity."""
-    message_parts = []
-
-    # --- DM CASE ---
-    if context_type == "dm":
-        if username:
-            if sender_id:
-                message_parts.append(f"**From**: {username}{ZERO_WIDTH_MARKER + encode_invisible(sender_id)}")
-            else:
-                message_parts.append(f"**From**: {username}")
-        if message_text:
-            # Parse message for @mentions
-            parsed_message = parse_mentions(message_text)
-            message_parts.append(f"**Message**: {parsed_message}")
-
-    # --- SERVER, REEL ONLY ---
-    elif context_type == "server_no_message":
-        if username:
-            if sender_id:
-                message_parts.append(f"**From**: {username}{ZERO_WIDTH_MARKER + encode_invisible(sender_id)}")
-            else:
-                message_parts.append(f"**From**: {username}")
-
-    # --- SERVER, REEL WITH MESSAGE ---
-    elif context_type == "server_with_message":
-        if username:
-            if sender_id:
-                message_parts.append(f"**From**: {username}{ZERO_WIDTH_MARKER + encode_invisible(sender_id)}")
-            else:
-                message_parts.append(f"**From**: {username}")
-        if message_text:
-            # Parse message for @mentions
-            parsed_message = parse_mentions(message_text)
-            message_parts.append(f"**Message**: {parsed_message}")
-
-    # --- SERVER, TEXT ONLY ---
-    elif context_type == "server_text_only":
-        if username:
-            if sender_id:
-                message_parts.append(f"**From**: {username}{ZERO_WIDTH_MARKER + encode_invisible(sender_id)}")
-            else:
-                message_parts.append(f"**From**: {username}")
-        if message_text:
-            # Parse message for @mentions
-            parsed_message = parse_mentions(message_text)
-            message_parts.append(f"**Message**: {parsed_message}")
-
-    # Prefix every message with '> ' to make it a quote in Discord
-    quoted_message = '> ' + '\n> '.join(message_parts) if message_parts else None
-
-    # --- Send the reel/post if present ---
-    if reel_url:
-        file_path, file_size = download_reel(reel_url, media_type)
-        # If download failed (post is private, deleted, etc)
-        if file_size is None:
-            return 0
-        if file_path:
-            try:
-                await target.send(
-                    content=quoted_message,
-                    file=discord.File(file_path)
-                )
-                logger.info(f"Sent {media_type} as file ({file_size} bytes) with context [{context_type}]")
-            except Exception as e:
-                logger.error(f"Error sending file: {str(e)}")
-                message_parts.append(f"File is bigger than 10MB, sending [__temporary link__]({reel_url}) instead")
-                # Re-quote with new lines
-                quoted_message = '> ' + '\n> '.join(message_parts)
-                await target.send(quoted_message)
-            finally:
-                Path(file_path).unlink()
-        else:
-            message_parts.append(f"-# File is bigger than 10MB, sending [__temporary link__]({reel_url}) instead")
-            quoted_message = '> ' + '\n> '.join(message_parts)
-            await target.send(quoted_message)
-            if file_size:
-                logger.info(f"Sent {media_type} as link (original size: {file_size} bytes) [{context_type}]")
-            else:
-                logger.info(f"Sent {media_type} as link (download failed) [{context_type}]")
-    else:
-        # For regular messages without reel/post
-        await target.send(quoted_message)
-        logger.info(f"Sent regular message [{context_type}]")
+    Returns:
+        tuple: (status, delivery), see Relay.dispatch_event.
+    """
+    # Skip our bot's own messages before spending a username lookup on them
+    status = relay.screen_event(messaging)
+    if status is not None:
+        return status, None
+    return relay.dispatch_event(messaging, get_instagram_username(messaging['sender']['id']))
+
+
+async def fetch_media_off_loop(url, media_type, budget=None):
+    # Download off the Discord event loop so other queued sends keep flowing
+    return await asyncio.to_thread(fetch_media, url, media_type, budget)
+
+
+async def shrink_media_off_loop(url, media_type, file_size):
+    return await asyncio.to_thread(shrink_oversize_media, url, media_type, file_size)
+
+
+# Caches, breakers, queues and the Relay, built as in aio_server.py; this module adds the I/O
+components = build_components(initial_config, ServerIO(
+    fetch_media=fetch_media_off_loop, shrink_media=shrink_media_off_loop, handle_event=handle_queued_event,
+    worker_pool=EventWorkerPool, single_flight=SingleFlight, retry_on=(requests.ConnectionError, requests.Timeout),
+))
+# The live configuration is relay.config, which is replaced when the secrets file changes
+relay = components.relay
+discord_sender = components.discord_sender
+media_shrinker = components.media_shrinker
+username_lookups = components.username_lookups
+graph_breaker, cdn_breaker, http_retries = components.graph_breaker, components.cdn_breaker, components.http_retries
+dedup_store, event_queue, sequencer = components.dedup_store, components.event_queue, components.sequencer
+load_shedder = components.load_shedder
+
+components.secrets_watcher.start()
+components.event_workers.start()
 
 
 if __name__ == '__main__':
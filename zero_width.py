@@ -0,0 +1,83 @@
+"""
+Zero-width encoding of Instagram sender IDs.
+
+Forwarded messages carry the sender's ID as invisible characters right after their username, prefixed by
+ZERO_WIDTH_MARKER, so a reply from Discord can be routed back to them. The character table must stay in
+sync with encodeMap/decodeMap in discord_handler_go/function.go.
+"""
+import re
+
+# Digit -> zero-width character
+DIGIT_TO_ZERO_WIDTH = {
+    '0': '\u200b',  # zero-width space
+    '1': '\u200c',  # zero-width non-joiner
+    '2': '\u200d',  # zero-width joiner
+    '3': '\u2060',  # word joiner
+    '4': '\u2061',  # function application
+    '5': '\u2062',  # invisible times
+    '6': '\u2063',  # invisible separator
+    '7': '\u2064',  # invisible plus
+    '8': '\u206a',  # inhibit symmetric swapping
+    '9': '\u206b',  # activate symmetric swapping
+}
+
+# A marker to find the encoded sender_id easily
+ZERO_WIDTH_MARKER = '\u200b\u200b\u200b'  # 3x zero-width space
+
+_ENCODE_TABLE = str.maketrans(DIGIT_TO_ZERO_WIDTH)
+_DECODE_TABLE = str.maketrans({char: digit for digit, char in DIGIT_TO_ZERO_WIDTH.items()})
+_NON_DIGITS = re.compile(r'[^0-9]')
+# The marker followed by the longest run of encoded digits, like decodeInvisible in the Go handler
+_ENCODED_ID = re.compile(ZERO_WIDTH_MARKER + '([' + ''.join(DIGIT_TO_ZERO_WIDTH.values()) + ']*)')
+
+
+def encode_invisible(text):
+    """Encodes the digits of text as zero-width characters; anything else is dropped."""
+    text = str(text)
+    if not (text.isascii() and text.isdigit()):
+        text = _NON_DIGITS.sub('', text)
+    return text.translate(_ENCODE_TABLE)
+
+
+def encode_sender_tag(sender_id):
+    """Returns the marker plus encoded ID that gets appended after a username."""
+    return ZERO_WIDTH_MARKER + encode_invisible(sender_id)
+
+
+def decode_invisible(text):
+    """
+    Extracts the sender ID encoded after the first ZERO_WIDTH_MARKER in text.
+
+    Returns:
+        str: The decoded digits, or '' if text carries no marker.
+    """
+    if not text or ZERO_WIDTH_MARKER not in text:
+        return ''
+    match = _ENCODED_ID.search(text)
+    return match.group(1).translate(_DECODE_TABLE)
+
+
+def decode_many(texts):
+    """
+    Decodes the sender ID from each message in a batch, e.g. a page of channel history.
+
+    Returns:
+        list: One decoded ID per message, '' for messages without a marker.
+    """
+    search = _ENCODED_ID.search
+    table = _DECODE_TABLE
+    results = []
+    for text in texts:
+        match = search(text) if text and ZERO_WIDTH_MARKER in text else None
+        results.append(match.group(1).translate(table) if match else '')
+    return results
+
+
+def find_sender_ids(text):
+    """
+    Scans a large blob of text (such as a whole channel backfill joined together) in one pass.
+
+    Returns:
+        list: Every encoded sender ID found, in order of appearance.
+    """
+    return [encoded.translate(_DECODE_TABLE) for encoded in _ENCODED_ID.findall(text)]